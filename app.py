@@ -1,8 +1,57 @@
-from flask import Flask, request, jsonify, render_template
-from query_clinical_trials import get_clinical_trials
+import os
+import time
+import logging
+import functools
+import threading
+from flask import Flask, request, jsonify, render_template, g, Response
 import json
 
+# LOG_LEVEL=DEBUG shows each query's parsed search params, filters and result counts
+logging.basicConfig(level = os.getenv("LOG_LEVEL", "INFO"), format = "%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+from query_clinical_trials import get_clinical_trials, get_clinical_trials_batch, stream_clinical_trials, decode_cursor, warm_up
+from geocoding import GeocodingUnavailable
+import metrics
+from profiler import SamplingProfiler, write_folded
+
 app = Flask(__name__)
+logger = logging.getLogger(__name__)
+
+# set PROFILE_SLOW_REQUEST_SECONDS to sample every request, keeping profiles of the slower ones
+PROFILE_SLOW_REQUEST_SECONDS = float(os.getenv("PROFILE_SLOW_REQUEST_SECONDS", 0))
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+
+MAX_BATCH_QUERIES = 1000
+UNPROFILED_ENDPOINTS = {'metrics_endpoint', 'healthz', 'readyz'}
+
+# WARM_UP=0 leaves the clients and caches to the first search (or readiness probe)
+WARM_UP = os.getenv("WARM_UP", "1") == "1"
+WARM_UP_RETRY_SECONDS = 5
+_ready = threading.Event()
+_warm_up_lock = threading.Lock()
+_warm_up_thread = None
+
+def warm_up_until_ready():
+    # retried, so a worker started during a qdrant outage recovers on its own
+    while True:
+        try:
+            warm_up()
+            _ready.set()
+            return
+        except Exception as e:
+            logger.warning("warm-up failed, retrying in %ds: %s", WARM_UP_RETRY_SECONDS, e)
+            time.sleep(WARM_UP_RETRY_SECONDS)
+
+def start_warm_up():
+    # in the background, so the worker serves (and answers probes) right away; one at a time
+    global _warm_up_thread
+    with _warm_up_lock:
+        if not _ready.is_set() and (_warm_up_thread is None or not _warm_up_thread.is_alive()):
+            _warm_up_thread = threading.Thread(target = warm_up_until_ready, daemon = True)
+            _warm_up_thread.start()
+
+if WARM_UP:
+    start_warm_up()
 
 @app.route('/')
 def index():
@@ -12,25 +61,111 @@ def index():
 @app.route('/search', methods=['POST'])
 def search():
     query = request.json.get('query', '')
-    if not query:
+    # "load more": the next_cursor of the previous page, which carries the parsed query
+    cursor = request.json.get('cursor')
+    if not query and not cursor:
         return jsonify({'error': 'No query provided'}), 400
+    if cursor:
+        try:
+            decode_cursor(cursor)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+    
+    # "stream": true answers with NDJSON events (see stream_search) instead of one JSON body
+    if request.json.get('stream'):
+        # X-Accel-Buffering: no keeps nginx from holding events back until the end
+        return Response(stream_search(query, cursor), mimetype = 'application/x-ndjson', headers = {'X-Accel-Buffering': 'no'})
+
+    try:
+        response = get_clinical_trials(query, n_results = 10, cursor = cursor)
+        return jsonify(response)
+    except TimeoutError:
+        return jsonify({'error': 'Search timed out'}), 504
+    except GeocodingUnavailable as e:
+        # the location exists, we just can't look it up right now
+        return jsonify({'error': str(e)}), 503
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+def stream_search(query, cursor):
+    """
+    One JSON object per line: the parsed query and search location as soon
+    as they are known, then the results. Errors come as an "error" event,
+    since the 200 status has already been sent
+    """
+    try:
+        for event in stream_clinical_trials(query, n_results = 10, cursor = cursor):
+            yield json.dumps(event) + '\n'
+    except TimeoutError:
+        yield json.dumps({'event': 'error', 'error': 'Search timed out'}) + '\n'
+    except GeocodingUnavailable as e:
+        yield json.dumps({'event': 'error', 'error': str(e), 'retryable': True}) + '\n'
+    except Exception as e:
+        yield json.dumps({'event': 'error', 'error': str(e)}) + '\n'
+
+# saved-search alerts and partner integrations: many queries in one call,
+# answered with one response per query, in the same order
+@app.route('/search/batch', methods=['POST'])
+def search_batch():
+    queries = request.json.get('queries', [])
+    if not isinstance(queries, list) or not queries or not all(isinstance(query, str) and query for query in queries):
+        return jsonify({'error': 'queries must be a non-empty list of queries'}), 400
+    if len(queries) > MAX_BATCH_QUERIES:
+        return jsonify({'error': f'at most {MAX_BATCH_QUERIES} queries per batch'}), 400
     
     try:
-        results = get_clinical_trials(query, n_results = 10)
-        
-        # Process the lat_lon field to ensure proper JSON serialization
-        for result in results:
-            if 'lat_lon' in result:
-                # lat_lon is already a string representation of a list from the query_clinical_trials.py
-                # We don't need to modify it since our JavaScript will parse it
-                pass
-            else:
-                # If lat_lon isn't in the result, add an empty array
-                result['lat_lon'] = '[]'
-                
-        return jsonify(results)
+        responses = get_clinical_trials_batch(queries, n_results = 10)
+        return jsonify({'responses': responses})
+    except TimeoutError:
+        return jsonify({'error': 'Search timed out'}), 504
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/metrics')
+def metrics_endpoint():
+    return Response(metrics.render(), mimetype = 'text/plain; version=0.0.4')
+
+# liveness: the process is up, whatever the state of qdrant and openai
+@app.route('/healthz')
+def healthz():
+    return jsonify({'status': 'ok'})
+
+# readiness: warmed up and the collection reachable. A probe only checks:
+# the warm-up runs in the background (started here if WARM_UP=0), as its
+# qdrant and openai calls would outlast the probe's timeout
+@app.route('/readyz')
+def readyz():
+    if not _ready.is_set():
+        start_warm_up()
+        return jsonify({'status': 'not ready'}), 503
+    return jsonify({'status': 'ready'})
+
+@app.before_request
+def start_profiler():
+    if PROFILE_SLOW_REQUEST_SECONDS and request.endpoint not in UNPROFILED_ENDPOINTS:
+        g.request_start = time.perf_counter()
+        g.profiler = SamplingProfiler().start()
+
+def finish_profile(profiler, request_start, path, endpoint):
+    samples = profiler.stop()
+    elapsed = time.perf_counter() - request_start
+    if elapsed >= PROFILE_SLOW_REQUEST_SECONDS:
+        profile_path = write_folded(samples, os.path.join(PROFILE_DIR, f"{time.strftime('%Y%m%d-%H%M%S')}-{endpoint}-{elapsed:.2f}s.folded"))
+        logger.warning("slow request %s took %.2fs, profile in %s", path, elapsed, profile_path)
+
+@app.after_request
+def profile_stream_until_closed(response):
+    # a streamed body (e.g. /search with "stream": true) is generated after
+    # teardown_request, so its profile ends when the server closes the stream
+    if response.is_streamed and 'profiler' in g:
+        response.call_on_close(functools.partial(finish_profile, g.pop('profiler'), g.request_start, request.path, request.endpoint))
+    return response
+
+@app.teardown_request
+def stop_profiler(exception = None):
+    profiler = g.pop('profiler', None)
+    if profiler is not None:
+        finish_profile(profiler, g.request_start, request.path, request.endpoint)
+
 if __name__ == '__main__':
     app.run(debug=True)
\ No newline at end of file
@@ -0,0 +1,164 @@
+"""
+Local stand-in for the ClinicalTrials.gov v2 studies API
+
+Three modes:
+- record: proxy requests to the real API and save every response under --fixtures
+- replay: answer from the saved responses only (fails on anything not recorded)
+- synthetic: generate --synthetic N deterministic studies, honoring the status
+  and date RANGE filters and paginating with nextPageToken
+
+usage:
+    python -m benchmarks.ctgov_fixture_server --mode record --fixtures fixtures/ctgov
+    CLINICALTRIALS_API_URL=http://localhost:8002/api/v2/studies python get_clinical_trials.py
+    python -m benchmarks.ctgov_fixture_server --mode replay --fixtures fixtures/ctgov
+"""
+import os
+import re
+import json
+import random
+import hashlib
+import datetime
+import argparse
+import functools
+import urllib.request
+from urllib.parse import urlsplit, parse_qsl, urlencode
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+UPSTREAM_URL = "https://clinicaltrials.gov/api/v2/studies"
+DATE_FIELDS = {
+    "StudyFirstPostDate": "studyFirstPostDateStruct",
+    "LastUpdatePostDate": "lastUpdatePostDateStruct",
+}
+CONDITIONS = ["breast cancer", "asthma", "alzheimer's disease", "type 2 diabetes", "depression", "heart failure", "lung cancer", "migraine"]
+SITES = [[42.36, -71.06], [40.71, -74.01], [41.88, -87.63], [29.76, -95.37], [34.05, -118.24], [47.61, -122.33], [39.95, -75.17], [25.76, -80.19]]
+
+def fixture_key(query):
+    return hashlib.sha256(urlencode(sorted(query)).encode("utf-8")).hexdigest()
+
+@functools.lru_cache(maxsize = None)
+def synthetic_study(i):
+    rng = random.Random(i)
+    condition = rng.choice(CONDITIONS)
+    first_post = datetime.date(1995, 1, 1) + datetime.timedelta(days = rng.randrange(365 * 31))
+    last_update = first_post + datetime.timedelta(days = rng.randrange(365 * 2))
+    return {
+        "protocolSection": {
+            "identificationModule": {
+                "nctId": f"NCT{i:08d}",
+                "briefTitle": f"Study {i} of {condition}",
+                "officialTitle": f"A randomized study {i} of a new treatment for {condition}",
+            },
+            "statusModule": {
+                "overallStatus": rng.choice(["RECRUITING", "NOT_YET_RECRUITING", "COMPLETED", "ACTIVE_NOT_RECRUITING"]),
+                "startDateStruct": {"date": first_post.strftime("%Y-%m")},
+                "completionDateStruct": {"date": (first_post + datetime.timedelta(days = 1000)).isoformat()},
+                "studyFirstPostDateStruct": {"date": first_post.isoformat()},
+                "lastUpdatePostDateStruct": {"date": last_update.isoformat()},
+            },
+            "contactsLocationsModule": {
+                "centralContacts": [{"name": f"Contact {i}"}],
+                "overallOfficials": [{"name": f"Investigator {i % 97}"}],
+                "locations": [
+                    {"geoPoint": {"lat": lat + rng.uniform(-0.5, 0.5), "lon": lon + rng.uniform(-0.5, 0.5)}}
+                    for lat, lon in rng.sample(SITES, rng.randint(1, 4))
+                ],
+            },
+            "sponsorCollaboratorsModule": {
+                "leadSponsor": {"name": f"Sponsor {i % 53}"},
+                "collaborators": [],
+            },
+            "descriptionModule": {
+                "briefSummary": f"This study evaluates a treatment for {condition}.",
+                "detailedDescription": f"Participants with {condition} will be followed. " * rng.randint(1, 50),
+            },
+            "conditionsModule": {"conditions": [condition]},
+            "designModule": {
+                "studyType": rng.choice(["INTERVENTIONAL", "OBSERVATIONAL"]),
+                "phases": [rng.choice(["PHASE1", "PHASE2", "PHASE3"])],
+            },
+            "eligibilityModule": {
+                "eligibilityCriteria": "Inclusion Criteria: ...",
+                "sex": rng.choice(["ALL", "FEMALE", "MALE"]),
+                "stdAges": rng.choice([["CHILD"], ["ADULT", "OLDER_ADULT"], ["CHILD", "ADULT", "OLDER_ADULT"]]),
+            },
+        }
+    }
+
+def synthetic_page(query, n_studies):
+    params = dict(query)
+    statuses = params.get("filter.overallStatus", "").split("|") if params.get("filter.overallStatus") else None
+    date_field, min_date, max_date = "StudyFirstPostDate", "MIN", "MAX"
+    match = re.match(r"AREA\[(\w+)\]RANGE\[([^,]+),\s*([^\]]+)\]", params.get("filter.advanced", ""))
+    if match:
+        date_field, min_date, max_date = match.groups()
+
+    matches = []
+    for i in range(1, n_studies + 1):
+        study = synthetic_study(i)
+        status_module = study["protocolSection"]["statusModule"]
+        date = status_module[DATE_FIELDS[date_field]]["date"]
+        if statuses and status_module["overallStatus"] not in statuses:
+            continue
+        if (min_date == "MIN" or date >= min_date) and (max_date == "MAX" or date <= max_date):
+            matches.append(study)
+
+    offset = int(params.get("pageToken", 0))
+    page_size = int(params.get("pageSize", 10))
+    page = {"studies": matches[offset:offset + page_size]}
+    if offset == 0 and params.get("countTotal") == "true":
+        page["totalCount"] = len(matches)
+    if offset + page_size < len(matches):
+        page["nextPageToken"] = str(offset + page_size)
+    return page
+
+class FixtureHandler(BaseHTTPRequestHandler):
+    mode = "synthetic"
+    fixtures = "fixtures/ctgov"
+    n_studies = 1000
+
+    def send_json(self, status, body):
+        data = body if isinstance(body, bytes) else json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        query = parse_qsl(urlsplit(self.path).query)
+        path = os.path.join(self.fixtures, fixture_key(query) + ".json")
+
+        if self.mode == "synthetic":
+            return self.send_json(200, synthetic_page(query, self.n_studies))
+        if self.mode == "record":
+            with urllib.request.urlopen(f"{UPSTREAM_URL}?{urlencode(query)}", timeout = 60) as response:
+                data = response.read()
+            os.makedirs(self.fixtures, exist_ok = True)
+            with open(path, "wb") as f:
+                f.write(data)
+            return self.send_json(200, data)
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                return self.send_json(200, f.read())
+        self.send_json(404, {"error": f"no recorded response for {urlencode(query)}"})
+
+    def log_message(self, format, *args):
+        pass
+
+def serve(port = 8002, mode = "synthetic", fixtures = "fixtures/ctgov", n_studies = 1000):
+    FixtureHandler.mode = mode
+    FixtureHandler.fixtures = fixtures
+    FixtureHandler.n_studies = n_studies
+    return ThreadingHTTPServer(("localhost", port), FixtureHandler)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type = int, default = 8002)
+    parser.add_argument("--mode", choices = ["record", "replay", "synthetic"], default = "synthetic")
+    parser.add_argument("--fixtures", default = "fixtures/ctgov")
+    parser.add_argument("--synthetic", type = int, default = 1000, help = "number of synthetic studies")
+    args = parser.parse_args()
+
+    server = serve(args.port, args.mode, args.fixtures, args.synthetic)
+    print(f"clinicaltrials.gov fixture server ({args.mode}) on http://localhost:{args.port}/api/v2/studies")
+    server.serve_forever()
@@ -0,0 +1,66 @@
+"""
+Throughput of the embedding backends, and how well the local model's
+neighbours agree with the openai ones (recall@k of the local top-k against
+the openai top-k, for a sample of trials used as queries)
+
+usage:
+    python -m benchmarks.embedding_backends --parquet studies_looking_for_participants_20250518_with_embedding.parquet
+    OPENAI_BASE_URL=http://localhost:8001/v1 python -m benchmarks.embedding_backends --backends openai local
+
+The openai vectors are read from the keywords_embeddings column when the
+parquet has one, otherwise they are embedded (and timed) like the others.
+That column holds a list of chunk vectors per trial (a single vector in
+parquets written before chunking); each trial is compared by its first
+chunk, the start of its keywords, which is what the other backends embed.
+"""
+import time
+import argparse
+import numpy as np
+import pandas as pd
+from utils import get_embeddings, get_embedding_backend
+
+def top_k(vectors, queries, k):
+    vectors = vectors / np.linalg.norm(vectors, axis = 1, keepdims = True)
+    scores = vectors[queries] @ vectors.T
+    scores[np.arange(len(queries)), queries] = -np.inf  # a trial is not its own neighbour
+    return np.argsort(-scores, axis = 1)[:, :k]
+
+def first_chunk(embeddings):
+    # parquet reads a list of vectors back as an array of arrays
+    return np.stack(list(embeddings))[0] if embeddings.dtype == object else embeddings
+
+def recall_at_k(reference, candidate):
+    return np.mean([len(set(r) & set(c)) / len(r) for r, c in zip(reference, candidate)])
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--parquet", default = "studies_looking_for_participants_20250518_with_embedding.parquet")
+    parser.add_argument("--n-trials", type = int, default = 2000)
+    parser.add_argument("--backends", nargs = "+", default = ["local"])
+    parser.add_argument("--max-workers", type = int, default = 4)
+    parser.add_argument("--n-queries", type = int, default = 200)
+    parser.add_argument("--k", type = int, default = 10)
+    args = parser.parse_args()
+
+    df = pd.read_parquet(args.parquet).head(args.n_trials)
+    texts = df["keywords"].tolist()
+    vectors = {}
+    if "keywords_embeddings" in df:
+        vectors["openai"] = np.stack([first_chunk(embeddings) for embeddings in df["keywords_embeddings"]])
+
+    print(f"{'backend':>8} {'model':>28} {'dims':>5} {'seconds':>8} {'trials/sec':>11}")
+    for name in args.backends:
+        if name in vectors:
+            continue
+        backend = get_embedding_backend(name)
+        start = time.perf_counter()
+        vectors[name] = np.array(get_embeddings(texts, backend = backend, max_workers = args.max_workers, use_cache = False))
+        elapsed = time.perf_counter() - start
+        print(f"{name:>8} {backend.model:>28} {vectors[name].shape[1]:>5} {elapsed:>8.1f} {len(texts) / elapsed:>11.1f}")
+
+    if "openai" in vectors and len(vectors) > 1:
+        queries = np.random.default_rng(0).choice(len(texts), size = min(args.n_queries, len(texts)), replace = False)
+        reference = top_k(vectors["openai"], queries, args.k)
+        for name, candidate in vectors.items():
+            if name != "openai":
+                print(f"recall@{args.k} of {name} vs openai neighbours: {recall_at_k(reference, top_k(candidate, queries, args.k)):.3f}")
@@ -0,0 +1,57 @@
+"""
+Local stand-in for the Nominatim search API, for geocoding offline
+
+usage:
+    python -m benchmarks.fake_nominatim_server --port 8003 --latency-ms 300
+    NOMINATIM_URL=http://localhost:8003/search python app.py
+
+Every location gets a deterministic point in the continental US, except ones
+containing "nowhere", which are not found. geocoding.py still spaces remote
+calls 1 second apart, so most lookups should be answered by its gazetteer.
+"""
+import json
+import time
+import random
+import hashlib
+import argparse
+from urllib.parse import urlsplit, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+def fake_location(query):
+    rng = random.Random(hashlib.sha256(query.lower().encode("utf-8")).digest())
+    return [round(rng.uniform(25.0, 49.0), 6), round(rng.uniform(-124.0, -67.0), 6)]
+
+class FakeNominatimHandler(BaseHTTPRequestHandler):
+    latency_ms = 0
+
+    def do_GET(self):
+        time.sleep(self.latency_ms / 1000)
+        query = parse_qs(urlsplit(self.path).query).get("q", [""])[0]
+        results = []
+        if query and "nowhere" not in query.lower():
+            lat, lon = fake_location(query)
+            results.append({"lat": str(lat), "lon": str(lon), "display_name": query})
+
+        data = json.dumps(results).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+def serve(port = 8003, latency_ms = 0):
+    FakeNominatimHandler.latency_ms = latency_ms
+    return ThreadingHTTPServer(("localhost", port), FakeNominatimHandler)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type = int, default = 8003)
+    parser.add_argument("--latency-ms", type = int, default = 0)
+    args = parser.parse_args()
+
+    server = serve(args.port, args.latency_ms)
+    print(f"fake nominatim server on http://localhost:{args.port}/search")
+    server.serve_forever()
@@ -0,0 +1,149 @@
+"""
+Local stand-in for the OpenAI embeddings and chat completions APIs, for
+running ingest and search offline
+
+usage:
+    python -m benchmarks.fake_openai_server --port 8001 --latency-ms 200 --rate-limit-prob 0.05
+    OPENAI_BASE_URL=http://localhost:8001/v1 OPENAI_API_KEY=fake python put_clinical_trials_into_qdrant_db.py
+
+Embeddings are deterministic per (model, text), so repeated runs return the same vectors.
+Chat completions answer the search intent prompt of query_clinical_trials.py
+with a keyword-rule parse of the last user message (see fake_intent).
+"""
+import re
+import json
+import time
+import math
+import random
+import hashlib
+import argparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+def fake_embedding(text, model = "text-embedding-3-small", dimensions = 1536):
+    seed = hashlib.sha256(f"{model}\n{text}".encode("utf-8")).digest()
+    rng = random.Random(seed)
+    vector = [rng.gauss(0, 1) for _ in range(dimensions)]
+    norm = math.sqrt(sum(v * v for v in vector))
+    return [v / norm for v in vector]
+
+SEX_WORDS = {"FEMALE": r"women|woman|female|females", "MALE": r"men|man|male|males"}
+AGE_WORDS = {
+    "OLDER_ADULT": r"older adults?|elderly|seniors?|geriatric",
+    "CHILD": r"child|children|pediatric|paediatric|kids?",
+    "ADULT": r"adults?",
+}
+TYPE_WORDS = {"OBSERVATIONAL": r"observational", "INTERVENTIONAL": r"interventional"}
+FILLER_WORDS = r"clinical|trials?|studies|study|for|in|with|near|around|of|recruiting"
+LOCATION_PATTERN = re.compile(
+    r"^(?P<rest>.*)(?:within (?P<miles>\d+) miles? of |\b(?:in|near|around) )"
+    r"(?P<location>\d{5}|[A-Za-z][A-Za-z. ]*?(?:, ?[A-Za-z]{2,})?)\s*$",
+    re.IGNORECASE
+)
+
+def first_match(words, text):
+    for value, pattern in words.items():
+        if re.search(rf"\b(?:{pattern})\b", text, re.IGNORECASE):
+            return value, re.sub(rf"\b(?:{pattern})\b", " ", text, flags = re.IGNORECASE)
+    return "", text
+
+def fake_intent(query):
+    """
+    Deterministic stand-in for the LLM parse: a trailing "in X", "near X" or
+    "within N miles of X" is the location, and sex, age and study type come
+    from the words the system prompt lists; what is left is the semantic phrase
+    """
+    location, distance_miles = "", 50
+    match = LOCATION_PATTERN.search(query)
+    demographic = "|".join(list(SEX_WORDS.values()) + list(AGE_WORDS.values()))
+    if match and not re.fullmatch(demographic, match.group("location").strip(), re.IGNORECASE):
+        location = match.group("location").strip()
+        distance_miles = int(match.group("miles") or 50)
+        query = match.group("rest")
+
+    criteria_sex, query = first_match(SEX_WORDS, query)
+    criteria_age, query = first_match(AGE_WORDS, query)
+    type, query = first_match(TYPE_WORDS, query)
+    semantic_phrases = re.sub(rf"\b(?:{FILLER_WORDS})\b", " ", query, flags = re.IGNORECASE)
+    return {
+        "type": type,
+        "criteria_sex": criteria_sex,
+        "criteria_age": criteria_age,
+        "location": location,
+        "distance_miles": distance_miles,
+        "semantic_phrases": " ".join(semantic_phrases.split()),
+    }
+
+class FakeOpenAIHandler(BaseHTTPRequestHandler):
+    latency_ms = 0
+    chat_latency_ms = 0
+    rate_limit_prob = 0.0
+    dimensions = 1536
+
+    def send_json(self, status, body):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        is_chat = self.path.rstrip("/").endswith("/chat/completions")
+        time.sleep((self.chat_latency_ms if is_chat else self.latency_ms) / 1000)
+
+        if random.random() < self.rate_limit_prob:
+            return self.send_json(429, {"error": {"message": "rate limited", "type": "rate_limit_error"}})
+
+        if self.path.rstrip("/").endswith("/embeddings"):
+            inputs = body["input"] if isinstance(body["input"], list) else [body["input"]]
+            model = body.get("model", "text-embedding-3-small")
+            return self.send_json(200, {
+                "object": "list",
+                "model": model,
+                "data": [
+                    {"object": "embedding", "index": i, "embedding": fake_embedding(str(text), model, self.dimensions)}
+                    for i, text in enumerate(inputs)
+                    ],
+                "usage": {"prompt_tokens": 0, "total_tokens": 0}
+                })
+
+        if is_chat:
+            user_message = [message["content"] for message in body["messages"] if message["role"] == "user"][-1]
+            return self.send_json(200, {
+                "id": "chatcmpl-" + hashlib.sha256(user_message.encode("utf-8")).hexdigest()[:24],
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": body.get("model", "gpt-4.1-nano"),
+                "choices": [{
+                    "index": 0,
+                    "message": {"role": "assistant", "content": json.dumps(fake_intent(user_message)), "refusal": None},
+                    "finish_reason": "stop"
+                    }],
+                "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
+                })
+
+        self.send_json(404, {"error": {"message": f"unknown path {self.path}"}})
+
+    def log_message(self, format, *args):
+        pass
+
+def serve(port = 8001, latency_ms = 0, rate_limit_prob = 0.0, dimensions = 1536, chat_latency_ms = 0):
+    FakeOpenAIHandler.latency_ms = latency_ms
+    FakeOpenAIHandler.chat_latency_ms = chat_latency_ms
+    FakeOpenAIHandler.rate_limit_prob = rate_limit_prob
+    FakeOpenAIHandler.dimensions = dimensions
+    return ThreadingHTTPServer(("localhost", port), FakeOpenAIHandler)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type = int, default = 8001)
+    parser.add_argument("--latency-ms", type = int, default = 0, help = "per embeddings request")
+    parser.add_argument("--chat-latency-ms", type = int, default = 0, help = "per chat completion")
+    parser.add_argument("--rate-limit-prob", type = float, default = 0.0)
+    parser.add_argument("--dimensions", type = int, default = 1536)
+    args = parser.parse_args()
+
+    server = serve(args.port, args.latency_ms, args.rate_limit_prob, args.dimensions, args.chat_latency_ms)
+    print(f"fake openai server on http://localhost:{args.port}/v1")
+    server.serve_forever()
@@ -0,0 +1,100 @@
+"""
+Latency of filtered searches before (raw string payloads, no keyword
+indexes) and after (normalized keyword lists with payload indexes), for
+filters from broad to very selective
+
+usage:
+    python -m benchmarks.filtered_search --url http://localhost:6333 --synthetic 100000
+    python -m benchmarks.filtered_search --synthetic 20000 --url ""   # in-memory qdrant
+
+Both collections are filled with the same synthetic trials. In-memory
+qdrant ignores payload indexes, so only latencies against a qdrant server
+are representative. "selectivity" is the share of trials the filter keeps.
+"""
+import time
+import random
+import argparse
+import statistics
+from qdrant_client import QdrantClient, models
+from benchmarks.ctgov_fixture_server import synthetic_study
+from benchmarks.geo_search import random_vector, percentile
+from get_clinical_trials import studies_to_df
+from put_clinical_trials_into_qdrant_db import create_collection, trial_payload, nct_id_to_point_id
+
+FILTERS = {
+    "interventional": {"type": ["INTERVENTIONAL"]},
+    "female": {"criteria_sex": ["ALL", "FEMALE"]},
+    "child": {"criteria_age": ["CHILD"]},
+    "phase 3": {"phase": ["PHASE3"]},
+    "recruiting, male, phase 1": {"status": ["RECRUITING"], "criteria_sex": ["ALL", "MALE"], "phase": ["PHASE1"]},
+    "child, interventional, phase 3": {"criteria_age": ["CHILD"], "type": ["INTERVENTIONAL"], "phase": ["PHASE3"]},
+}
+
+def to_filter(conditions):
+    return models.Filter(must = [
+        models.FieldCondition(key = key, match = models.MatchAny(any = values))
+        for key, values in conditions.items()
+    ])
+
+def load(client, n_studies, batch_size = 1000):
+    """
+    "before": payloads as ingest wrote them until now, with only the vector and geo index
+    "after": normalized keyword payloads, with keyword indexes
+    """
+    client.create_collection(
+        collection_name = "before",
+        vectors_config = models.VectorParams(
+            size = 1536, distance = models.Distance.COSINE,
+            multivector_config = models.MultiVectorConfig(comparator = models.MultiVectorComparator.MAX_SIM)
+        )
+    )
+    client.create_payload_index(collection_name = "before", field_name = "locations", field_schema = models.PayloadSchemaType.GEO)
+    create_collection(client, "after")
+
+    rng = random.Random(0)
+    for start in range(1, n_studies + 1, batch_size):
+        df = studies_to_df([synthetic_study(i) for i in range(start, min(start + batch_size, n_studies + 1))])
+        df["keywords_tokens"] = 0
+        points = []
+        for row in df.to_dict("records"):
+            payload = trial_payload(row)
+            raw = {key: row[key] for key in ["type", "criteria_sex", "criteria_age", "status", "phase"]}
+            points.append((nct_id_to_point_id(row["nct_id"]), [random_vector(rng)], payload, {**payload, **raw}))
+        client.upsert(collection_name = "after", points = [models.PointStruct(id = i, vector = v, payload = p) for i, v, p, _ in points])
+        client.upsert(collection_name = "before", points = [models.PointStruct(id = i, vector = v, payload = p) for i, v, _, p in points])
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", default = "http://localhost:6333", help = "empty for an in-memory qdrant")
+    parser.add_argument("--api-key", default = None)
+    parser.add_argument("--synthetic", type = int, default = 20000)
+    parser.add_argument("--queries", type = int, default = 50)
+    parser.add_argument("--n-results", type = int, default = 10)
+    parser.add_argument("--keep", action = "store_true", help = "keep the two collections afterwards")
+    args = parser.parse_args()
+
+    client = QdrantClient(url = args.url, api_key = args.api_key) if args.url else QdrantClient(":memory:")
+    for collection_name in ["before", "after"]:
+        if client.collection_exists(collection_name):
+            client.delete_collection(collection_name)
+    load(client, args.synthetic)
+
+    rng = random.Random(1)
+    vectors = [random_vector(rng) for _ in range(args.queries)]
+
+    print(f"{args.synthetic} trials, {args.queries} queries")
+    print(f"{'filter':>32} {'selectivity':>12} {'collection':>11} {'p50 ms':>8} {'p95 ms':>8}")
+    for name, conditions in FILTERS.items():
+        query_filter = to_filter(conditions)
+        selectivity = client.count(collection_name = "after", count_filter = query_filter, exact = True).count / args.synthetic
+        for collection_name in ["before", "after"]:
+            latencies = []
+            for vector in vectors:
+                start = time.perf_counter()
+                client.query_points(collection_name = collection_name, query = [vector], limit = args.n_results, query_filter = query_filter)
+                latencies.append((time.perf_counter() - start) * 1000)
+            print(f"{name:>32} {selectivity:>12.3f} {collection_name:>11} {statistics.median(latencies):>8.1f} {percentile(latencies, 0.95):>8.1f}")
+
+    if not args.keep:
+        for collection_name in ["before", "after"]:
+            client.delete_collection(collection_name)
@@ -0,0 +1,44 @@
+"""
+Nearest-site distance for 100 results x 500 sites: scalar haversine loop vs one vectorized numpy call
+
+usage:
+    python -m benchmarks.geo_distance
+"""
+import time
+import random
+import argparse
+import numpy as np
+from geo_distance import haversine, nearest_site_distances
+
+def nearest_site_distances_scalar(point, sites_per_trial):
+    return [min((haversine(point, site) for site in sites), default = float("inf")) for sites in sites_per_trial]
+
+def best_of(f, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        f()
+        timings.append(time.perf_counter() - start)
+    return min(timings) * 1000
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--results", type = int, default = 100)
+    parser.add_argument("--sites", type = int, default = 500)
+    parser.add_argument("--repeat", type = int, default = 10)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    point = [42.36, -71.06]
+    sites_per_trial = [
+        [[rng.uniform(25, 49), rng.uniform(-124, -67)] for _ in range(args.sites)]
+        for _ in range(args.results)
+    ]
+
+    assert np.allclose(nearest_site_distances_scalar(point, sites_per_trial), nearest_site_distances(point, sites_per_trial))
+
+    scalar_ms = best_of(lambda: nearest_site_distances_scalar(point, sites_per_trial), args.repeat)
+    vector_ms = best_of(lambda: nearest_site_distances(point, sites_per_trial), args.repeat)
+    print(f"{args.results} results x {args.sites} sites")
+    print(f"scalar loop: {scalar_ms:.2f} ms")
+    print(f"numpy:       {vector_ms:.2f} ms ({scalar_ms / vector_ms:.1f}x)")
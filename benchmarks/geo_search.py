@@ -0,0 +1,101 @@
+"""
+Latency of radius searches: over-fetching and filtering by haversine in python
+(the old path) vs a geo_radius filter on the indexed "locations" payload in Qdrant
+
+usage:
+    python -m benchmarks.geo_search --url http://localhost:6333
+    python -m benchmarks.geo_search --synthetic 20000   # in-memory qdrant, no server needed
+
+In-memory qdrant ignores payload indexes and scans every point, so only
+latencies against a qdrant server are representative. "mean results" shows
+how often the old path comes back with fewer than --n-results trials.
+"""
+import math
+import time
+import random
+import argparse
+import statistics
+from qdrant_client import QdrantClient, models
+from geo_distance import haversine
+
+METERS_PER_MILE = 1609.344
+CENTERS = {
+    "Boston": [42.36, -71.06],
+    "Chicago": [41.88, -87.63],
+    "Houston": [29.76, -95.37],
+    "Denver": [39.74, -104.99],
+    "Seattle": [47.61, -122.33],
+}
+
+def search_python_geo(client, vector, center, miles, n_results, geo_buffer_factor = 10):
+    results = client.query_points(collection_name = "clinical_trials", query = [vector], limit = n_results * geo_buffer_factor).points
+    return [
+        result for result in results
+        if any(haversine(center, location) <= miles for location in result.payload["lat_lon"])
+    ][:n_results]
+
+def search_qdrant_geo(client, vector, center, miles, n_results):
+    return client.query_points(
+        collection_name = "clinical_trials",
+        query = [vector],
+        limit = n_results,
+        query_filter = models.Filter(must = [
+            models.FieldCondition(
+                key = "locations",
+                geo_radius = models.GeoRadius(
+                    center = models.GeoPoint(lat = center[0], lon = center[1]),
+                    radius = miles * METERS_PER_MILE
+                )
+            )
+        ])
+    ).points
+
+def random_vector(rng, dimensions = 1536):
+    vector = [rng.gauss(0, 1) for _ in range(dimensions)]
+    norm = math.sqrt(sum(v * v for v in vector))
+    return [v / norm for v in vector]
+
+def load_synthetic(client, n_studies, seed = 0):
+    from benchmarks.ctgov_fixture_server import synthetic_study
+    from get_clinical_trials import studies_to_df
+    from put_clinical_trials_into_qdrant_db import create_collection, upsert_trials
+
+    rng = random.Random(seed)
+    df = studies_to_df([synthetic_study(i) for i in range(1, n_studies + 1)])
+    df["keywords_tokens"] = 0
+    df["keywords_embeddings"] = [[random_vector(rng)] for _ in range(len(df))]
+    create_collection(client)
+    upsert_trials(client, df, batch_size = 1000)
+
+def percentile(values, q):
+    return sorted(values)[min(len(values) - 1, int(q * len(values)))]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", default = "http://localhost:6333")
+    parser.add_argument("--api-key", default = None)
+    parser.add_argument("--synthetic", type = int, default = 0, help = "load N synthetic trials into an in-memory qdrant")
+    parser.add_argument("--queries", type = int, default = 20)
+    parser.add_argument("--n-results", type = int, default = 10)
+    args = parser.parse_args()
+
+    if args.synthetic:
+        client = QdrantClient(":memory:")
+        load_synthetic(client, args.synthetic)
+    else:
+        client = QdrantClient(url = args.url, api_key = args.api_key)
+
+    rng = random.Random(1)
+    vectors = [random_vector(rng) for _ in range(args.queries)]
+
+    print(f"{'radius':>8} {'path':>12} {'p50 ms':>8} {'p95 ms':>8} {'mean results':>13}")
+    for miles in [10, 50, 200]:
+        for name, search in [("python geo", search_python_geo), ("qdrant geo", search_qdrant_geo)]:
+            latencies, n_found = [], []
+            for vector in vectors:
+                for center in CENTERS.values():
+                    start = time.perf_counter()
+                    results = search(client, vector, center, miles, args.n_results)
+                    latencies.append((time.perf_counter() - start) * 1000)
+                    n_found.append(len(results))
+            print(f"{miles:>8} {name:>12} {statistics.median(latencies):>8.1f} {percentile(latencies, 0.95):>8.1f} {statistics.mean(n_found):>13.1f}")
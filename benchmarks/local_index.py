@@ -0,0 +1,94 @@
+"""
+Recall and latency of the in-process index (local_index.py) against the
+Qdrant collection it was copied from, for each quantization mode, with and
+without the type/sex/age/radius filters the search uses
+
+usage:
+    python -m benchmarks.local_index --url http://localhost:6333
+    python -m benchmarks.local_index --synthetic 20000   # in-memory qdrant, no server needed
+
+Queries are stored trial vectors plus noise, so they have real neighbours.
+recall@k is the share of qdrant's top k that the local index also returns.
+"""
+import time
+import random
+import argparse
+import tempfile
+import statistics
+import numpy as np
+from qdrant_client import QdrantClient, models
+from local_index import LocalIndex, write_local_index, iter_qdrant_points, METERS_PER_MILE
+from benchmarks.geo_search import CENTERS, load_synthetic, percentile
+
+FILTERS = {
+    "none": None,
+    "interventional, female": models.Filter(must = [
+        models.FieldCondition(key = "type", match = models.MatchAny(any = ["INTERVENTIONAL"])),
+        models.FieldCondition(key = "criteria_sex", match = models.MatchAny(any = ["ALL", "FEMALE"])),
+    ]),
+    "child": models.Filter(must = [
+        models.FieldCondition(key = "criteria_age", match = models.MatchAny(any = ["CHILD"])),
+    ]),
+    "50 miles of Boston": models.Filter(must = [
+        models.FieldCondition(key = "locations", geo_radius = models.GeoRadius(
+            center = models.GeoPoint(lat = CENTERS["Boston"][0], lon = CENTERS["Boston"][1]),
+            radius = 50 * METERS_PER_MILE
+        )),
+    ]),
+}
+
+def time_searches(search, vectors, query_filter, k):
+    results, latencies = [], []
+    for vector in vectors:
+        start = time.perf_counter()
+        results.append([point.id for point in search(collection_name = "clinical_trials", query = [vector.tolist()], limit = k, query_filter = query_filter).points])
+        latencies.append((time.perf_counter() - start) * 1000)
+    return results, latencies
+
+def recall(reference, candidate):
+    return statistics.mean(len(set(r) & set(c)) / len(r) for r, c in zip(reference, candidate) if r)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", default = "http://localhost:6333")
+    parser.add_argument("--api-key", default = None)
+    parser.add_argument("--synthetic", type = int, default = 0, help = "load N synthetic trials into an in-memory qdrant")
+    parser.add_argument("--queries", type = int, default = 50)
+    parser.add_argument("--k", type = int, default = 10)
+    parser.add_argument("--noise", type = float, default = 0.5)
+    parser.add_argument("--hnsw", action = "store_true", help = "also benchmark HNSW (needs hnswlib)")
+    args = parser.parse_args()
+
+    if args.synthetic:
+        client = QdrantClient(":memory:")
+        load_synthetic(client, args.synthetic)
+    else:
+        client = QdrantClient(url = args.url, api_key = args.api_key)
+
+    points = list(iter_qdrant_points(client, "clinical_trials"))
+    path = tempfile.mkdtemp(prefix = "local_index_")
+    write_local_index(path, [p.id for p in points], [p.vector for p in points], [p.payload for p in points], hnsw = args.hnsw)
+
+    rng = random.Random(0)
+    # a trial's first chunk
+    stored = np.array([np.atleast_2d(points[rng.randrange(len(points))].vector)[0] for _ in range(args.queries)], dtype = np.float32)
+    noise = np.random.default_rng(0).normal(size = stored.shape).astype(np.float32)
+    vectors = stored / np.linalg.norm(stored, axis = 1, keepdims = True) + args.noise * noise / np.sqrt(stored.shape[1])
+
+    modes = {
+        "exact": LocalIndex(path, quantization = None),
+        "int8": LocalIndex(path, quantization = "int8", rescore_multiplier = 4),
+        "binary": LocalIndex(path, quantization = "binary"),
+    }
+    if args.hnsw:
+        modes["hnsw"] = LocalIndex(path, quantization = None, use_hnsw = True)
+
+    print(f"{len(points)} trials, {args.queries} queries, k = {args.k}")
+    print(f"{'filter':>24} {'index':>8} {'p50 ms':>8} {'p95 ms':>8} {'recall':>7}")
+    for filter_name, query_filter in FILTERS.items():
+        reference, latencies = time_searches(client.query_points, vectors, query_filter, args.k)
+        print(f"{filter_name:>24} {'qdrant':>8} {statistics.median(latencies):>8.2f} {percentile(latencies, 0.95):>8.2f} {'':>7}")
+        for name, index in modes.items():
+            index.query_points(query = [vectors[0]], limit = args.k, query_filter = query_filter)  # warm the mask cache
+            results, latencies = time_searches(index.query_points, vectors, query_filter, args.k)
+            print(f"{filter_name:>24} {name:>8} {statistics.median(latencies):>8.2f} {percentile(latencies, 0.95):>8.2f} {recall(reference, results):>7.3f}")
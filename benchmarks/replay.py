@@ -0,0 +1,193 @@
+"""
+Offline benchmark of ingest and /search: fetches trials from a fixture
+server, embeds and loads them, then replays a query log against the app
+and reports latency percentiles and throughput
+
+usage:
+    python -m benchmarks.replay --synthetic 5000 --queries 500 --concurrency 8
+    python -m benchmarks.replay --ctgov-mode replay --fixtures fixtures/ctgov --query-log queries.txt
+    python -m benchmarks.replay --qdrant-url http://localhost:6333   # search a local qdrant instead of the local index
+
+Every remote service is replaced by a local stand-in, so no network or API
+keys are needed:
+- ClinicalTrials.gov: ctgov_fixture_server (synthetic, or recorded pages)
+- OpenAI: fake_openai_server (deterministic embeddings and intent parses)
+- Nominatim: fake_nominatim_server
+- Qdrant: the in-process local index, or a qdrant server given by --qdrant-url
+
+The stand-ins' latencies are set by --llm-latency-ms, --embedding-latency-ms
+and --geocode-latency-ms, so results show the pipeline's own overhead plus
+the waits you choose, not the real services'. tiktoken's encoding must have
+been downloaded once (it is cached under TIKTOKEN_CACHE_DIR).
+
+The query log is a text file with one query per line (e.g. exported from
+the app's logs), replayed in order; without one, a synthetic log of
+conditions, demographics and places with repeats is used.
+"""
+import os
+import time
+import random
+import argparse
+import tempfile
+import threading
+import statistics
+from concurrent.futures import ThreadPoolExecutor
+from benchmarks import ctgov_fixture_server, fake_openai_server, fake_nominatim_server
+from benchmarks.geo_search import percentile
+
+PLACES = ["Boston", "Chicago, IL", "Houston", "Seattle", "new york city", "Denver, CO", "Miami", "Rochester, MN", "02115", "Springfield, IL"]
+DEMOGRAPHICS = ["", "", "for women", "for men", "in children", "for older adults", "observational"]
+
+def synthetic_query_log(n_queries, seed = 0, n_distinct = 200):
+    """
+    n_queries queries drawn from n_distinct with Zipf-like frequencies,
+    since real logs repeat their popular queries
+    """
+    rng = random.Random(seed)
+    distinct = []
+    for _ in range(n_distinct):
+        query = " ".join(filter(None, [rng.choice(ctgov_fixture_server.CONDITIONS), rng.choice(DEMOGRAPHICS)]))
+        place = rng.choice(PLACES + [""] * 5)
+        if place:
+            query += rng.choice([f" in {place}", f" near {place}", f" within {rng.choice([10, 25, 100])} miles of {place}"])
+        distinct.append(query)
+    return rng.choices(distinct, weights = [1 / rank for rank in range(1, n_distinct + 1)], k = n_queries)
+
+def start(server):
+    threading.Thread(target = server.serve_forever, daemon = True).start()
+    return server.server_address[1]
+
+def rate(n, seconds):
+    return f"{n} trials in {seconds:.1f}s ({n / max(seconds, 1e-9):.0f} trials/sec)"
+
+def ingest(work_dir, qdrant_url = None):
+    """
+    Fetch, embed and load every trial the fixture server has, timing each step
+    """
+    from get_clinical_trials import fetch_clinical_trials, iter_studies, studies_to_df
+    from put_clinical_trials_into_qdrant_db import add_embeddings, trial_payload, nct_id_to_point_id
+
+    start_time = time.perf_counter()
+    pages_dir = fetch_clinical_trials(out_dir = os.path.join(work_dir, "studies_pages"))
+    df = studies_to_df(list(iter_studies(pages_dir)))
+    fetched = time.perf_counter()
+    print(f"fetch: {rate(len(df), fetched - start_time)}")
+
+    df = add_embeddings(df)
+    embedded = time.perf_counter()
+    print(f"embed: {rate(len(df), embedded - fetched)}")
+
+    if qdrant_url:
+        from qdrant_client import QdrantClient
+        from put_clinical_trials_into_qdrant_db import COLLECTION_NAME, create_collection, upsert_trials
+        client = QdrantClient(url = qdrant_url, api_key = os.getenv("QDRANT_API_KEY"))
+        if client.collection_exists(COLLECTION_NAME):
+            print(f"load: skipped, {qdrant_url} already has a {COLLECTION_NAME} collection (searching it as is)")
+            return
+        create_collection(client)
+        upsert_trials(client, df)
+    else:
+        from local_index import write_local_index
+        from query_clinical_trials import LOCAL_INDEX_PAYLOAD_FIELDS
+        rows = df.to_dict("records")
+        write_local_index(
+            os.environ["LOCAL_INDEX_PATH"],
+            [nct_id_to_point_id(row["nct_id"]) for row in rows],
+            [row["keywords_embeddings"] for row in rows],
+            [trial_payload(row) for row in rows],
+            payload_fields = LOCAL_INDEX_PAYLOAD_FIELDS
+        )
+    print(f"load: {rate(len(df), time.perf_counter() - embedded)}")
+    print(f"ingest total: {rate(len(df), time.perf_counter() - start_time)}")
+
+def replay(queries, concurrency):
+    """
+    POST each query to /search through the Flask test client, concurrency at a time
+
+    Returns:
+    (latencies in ms, status codes, wall clock seconds)
+    """
+    from app import app
+
+    # wait out the app's warm-up, so it isn't counted in the first queries
+    deadline = time.monotonic() + 60
+    while app.test_client().get("/readyz").status_code != 200:
+        if time.monotonic() > deadline:
+            raise RuntimeError("app not ready after 60s, see the warm-up warnings")
+        time.sleep(0.1)
+
+    local = threading.local()
+    def post(query):
+        if not hasattr(local, "client"):
+            local.client = app.test_client()
+        start_time = time.perf_counter()
+        response = local.client.post("/search", json = {"query": query})
+        return (time.perf_counter() - start_time) * 1000, response.status_code
+
+    start_time = time.perf_counter()
+    with ThreadPoolExecutor(max_workers = concurrency) as executor:
+        latencies, statuses = zip(*executor.map(post, queries))
+    return list(latencies), list(statuses), time.perf_counter() - start_time
+
+def stage_means():
+    import metrics
+    return {dict(labels)["stage"]: values[-1] / values[-2] * 1000 for labels, values in sorted(metrics.STAGE_SECONDS.values.items())}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--synthetic", type = int, default = 2000, help = "number of synthetic trials (with --ctgov-mode synthetic)")
+    parser.add_argument("--ctgov-mode", choices = ["synthetic", "replay"], default = "synthetic")
+    parser.add_argument("--fixtures", default = "fixtures/ctgov", help = "recorded pages, for --ctgov-mode replay")
+    parser.add_argument("--query-log", default = None, help = "one query per line; default is a synthetic log")
+    parser.add_argument("--queries", type = int, default = 300, help = "length of the synthetic query log")
+    parser.add_argument("--concurrency", type = int, default = 8)
+    parser.add_argument("--llm-latency-ms", type = int, default = 400)
+    parser.add_argument("--embedding-latency-ms", type = int, default = 100)
+    parser.add_argument("--geocode-latency-ms", type = int, default = 300)
+    parser.add_argument("--qdrant-url", default = None, help = "search this qdrant server instead of the local index")
+    parser.add_argument("--cold", action = "store_true", help = "turn off the intent, embedding and geocode caches")
+    parser.add_argument("--work-dir", default = None, help = "for pages, index and caches; default is a new temporary directory")
+    args = parser.parse_args()
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix = "replay_")
+    openai_port = start(fake_openai_server.serve(0, args.embedding_latency_ms, chat_latency_ms = args.llm_latency_ms))
+    ctgov_port = start(ctgov_fixture_server.serve(0, args.ctgov_mode, args.fixtures, args.synthetic))
+    nominatim_port = start(fake_nominatim_server.serve(0, args.geocode_latency_ms))
+
+    # before the app's modules are imported, since they read their settings at import
+    os.environ.update({
+        "OPENAI_BASE_URL": f"http://localhost:{openai_port}/v1",
+        "OPENAI_API_KEY": "fake",
+        "EMBEDDING_BACKEND": "openai",
+        "CLINICALTRIALS_API_URL": f"http://localhost:{ctgov_port}/api/v2/studies",
+        "NOMINATIM_URL": f"http://localhost:{nominatim_port}/search",
+        "SEARCH_BACKEND": "qdrant" if args.qdrant_url else "local",
+        "QDRANT_URL": args.qdrant_url or "",
+        "LOCAL_INDEX_PATH": os.path.join(work_dir, "local_index"),
+        "EMBEDDING_CACHE_PATH": "" if args.cold else os.path.join(work_dir, "embedding_cache.sqlite3"),
+        "INTENT_CACHE_PATH": "" if args.cold else os.path.join(work_dir, "intent_cache.sqlite3"),
+        "GEOCODE_CACHE_PATH": "" if args.cold else os.path.join(work_dir, "geocode_cache.sqlite3"),
+        "PROFILE_SLOW_REQUEST_SECONDS": "0",
+        "LOG_LEVEL": os.getenv("LOG_LEVEL", "WARNING"),
+    })
+    print(f"working in {work_dir}")
+
+    ingest(work_dir, args.qdrant_url)
+
+    if args.query_log:
+        with open(args.query_log) as f:
+            queries = [line.strip() for line in f if line.strip()]
+    else:
+        queries = synthetic_query_log(args.queries)
+
+    latencies, statuses, seconds = replay(queries, args.concurrency)
+    errors = sum(status != 200 for status in statuses)
+    print(f"\n/search: {len(queries)} queries ({len(set(queries))} distinct), concurrency {args.concurrency}, {errors} errors")
+    print(f"{'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'mean ms':>8} {'queries/sec':>12}")
+    print(
+        f"{statistics.median(latencies):>8.1f} {percentile(latencies, 0.95):>8.1f} {percentile(latencies, 0.99):>8.1f}"
+        f" {statistics.mean(latencies):>8.1f} {len(queries) / seconds:>12.1f}"
+    )
+    print("\nmean ms per stage:")
+    for stage, mean in stage_means().items():
+        print(f"{stage:>16} {mean:>8.1f}")
@@ -0,0 +1,113 @@
+import time
+import sqlite3
+import hashlib
+import threading
+from array import array
+
+def hash_key(*parts):
+    return hashlib.sha256("\n".join(str(part) for part in parts).encode("utf-8")).hexdigest()
+
+def pack_vector(vector):
+    return array("f", vector).tobytes()
+
+def unpack_vector(blob):
+    vector = array("f")
+    vector.frombytes(blob)
+    return vector.tolist()
+
+class DiskCache:
+    """
+    Persistent key-value cache backed by a sqlite file
+
+    Safe to share across threads and processes (e.g. gunicorn workers) on the
+    same machine. Entries past ttl_seconds are treated as misses, and the
+    least recently used entries are evicted once there are more than max_entries.
+
+    Parameters:
+    path: sqlite file
+    max_entries: size bound, or None for unbounded
+    ttl_seconds: time to live, or None for no expiry
+    """
+    def __init__(self, path, max_entries = None, ttl_seconds = None):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout = 30, check_same_thread = False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS cache (
+                key TEXT PRIMARY KEY,
+                value BLOB NOT NULL,
+                created_at REAL NOT NULL,
+                accessed_at REAL NOT NULL
+            )""")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS cache_accessed_at ON cache (accessed_at)")
+        self._conn.commit()
+
+    def get_many(self, keys):
+        """
+        Bulk lookup
+
+        Returns:
+        dict of key to value, for the keys that were found
+        """
+        keys = list(dict.fromkeys(keys))
+        found = {}
+        now = time.time()
+        min_created_at = now - self.ttl_seconds if self.ttl_seconds else 0
+        with self._lock:
+            # stay under sqlite's limit on the number of query parameters
+            for start in range(0, len(keys), 500):
+                chunk = keys[start:start + 500]
+                rows = self._conn.execute(
+                    f"SELECT key, value FROM cache WHERE created_at >= ? AND key IN ({','.join('?' * len(chunk))})",
+                    [min_created_at, *chunk]
+                    ).fetchall()
+                found.update(rows)
+            self._conn.executemany("UPDATE cache SET accessed_at = ? WHERE key = ?", [(now, key) for key in found])
+            self._conn.commit()
+            self.hits += len(found)
+            self.misses += len(keys) - len(found)
+        return found
+
+    def get(self, key):
+        return self.get_many([key]).get(key)
+
+    def set_many(self, items):
+        """
+        Bulk insert of (key, value) pairs, then drops expired entries and
+        evicts down to max_entries
+        """
+        now = time.time()
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO cache (key, value, created_at, accessed_at) VALUES (?, ?, ?, ?)",
+                [(key, value, now, now) for key, value in items]
+                )
+            if self.ttl_seconds:
+                self._conn.execute("DELETE FROM cache WHERE created_at < ?", [now - self.ttl_seconds])
+            if self.max_entries:
+                self._conn.execute(
+                    "DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+                    [self.max_entries]
+                    )
+            self._conn.commit()
+
+    def set(self, key, value):
+        self.set_many([(key, value)])
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": len(self)
+        }
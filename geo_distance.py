@@ -0,0 +1,73 @@
+import math
+import numpy as np
+from itertools import chain
+
+EARTH_RADIUS_MILES = 3956
+
+def haversine(coord1, coord2):
+    """
+    Calculate the great-circle distance between two coordinates
+    in miles using the Haversine formula
+
+    Parameters:
+    coord1, coord2: [lat, lon] coordinates
+
+    Returns:
+    Distance in miles
+    """
+    lat1, lon1 = coord1
+    lat2, lon2 = coord2
+
+    # Convert decimal degrees to radians
+    lat1, lon1, lat2, lon2 = map(math.radians, [lat1, lon1, lat2, lon2])
+
+    # Haversine formula
+    dlon = lon2 - lon1
+    dlat = lat2 - lat1
+    a = math.sin(dlat/2)**2 + math.cos(lat1) * math.cos(lat2) * math.sin(dlon/2)**2
+    c = 2 * math.asin(math.sqrt(a))
+
+    return c * EARTH_RADIUS_MILES
+
+def haversine_many(point, coords):
+    """
+    Vectorized haversine from one point to many
+
+    Parameters:
+    point: [lat, lon]
+    coords: array-like of shape (n, 2) of [lat, lon]
+
+    Returns:
+    array of n distances in miles
+    """
+    coords = np.radians(np.asarray(coords, dtype = np.float64).reshape(-1, 2))
+    lat1, lon1 = np.radians(point)
+    lat2, lon2 = coords[:, 0], coords[:, 1]
+    a = np.sin((lat2 - lat1)/2)**2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1)/2)**2
+    return 2 * np.arcsin(np.sqrt(np.clip(a, 0, 1))) * EARTH_RADIUS_MILES
+
+def nearest_site_distances(point, sites_per_trial):
+    """
+    Distance from point to the nearest site of each trial, with all sites of
+    all trials computed in a single vectorized call
+
+    Parameters:
+    point: [lat, lon]
+    sites_per_trial: list (one per trial) of lists of [lat, lon]
+
+    Returns:
+    array with one distance in miles per trial (inf for trials without sites)
+    """
+    counts = np.array([len(sites) for sites in sites_per_trial], dtype = np.int64)
+    nearest = np.full(len(counts), np.inf)
+    if not counts.sum():
+        return nearest
+
+    # flatten straight into a float buffer, much faster than converting nested lists
+    coords = np.fromiter(chain.from_iterable(chain.from_iterable(sites_per_trial)), dtype = np.float64, count = 2 * counts.sum())
+    distances = haversine_many(point, coords)
+    has_sites = counts > 0
+    # reduceat needs the offset of each non-empty trial into the flattened sites
+    offsets = np.concatenate([[0], np.cumsum(counts)[:-1]])[has_sites]
+    nearest[has_sites] = np.minimum.reduceat(distances, offsets)
+    return nearest
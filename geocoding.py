@@ -0,0 +1,343 @@
+import os
+import re
+import csv
+import json
+import time
+import sqlite3
+import logging
+import threading
+import requests
+from cache import DiskCache
+
+logger = logging.getLogger(__name__)
+
+# tab-separated GeoNames postal code file, e.g. US.txt from https://download.geonames.org/export/zip/
+GAZETTEER_PATH = os.getenv("GAZETTEER_PATH", "US.txt")
+GEOCODE_CACHE_PATH = os.getenv("GEOCODE_CACHE_PATH", "geocode_cache.sqlite3")
+GEOCODE_CACHE_TTL_SECONDS = int(os.getenv("GEOCODE_CACHE_TTL_SECONDS", 30 * 24 * 3600))
+GEOCODE_CACHE_MAX_ENTRIES = int(os.getenv("GEOCODE_CACHE_MAX_ENTRIES", 10000))
+NOMINATIM_URL = os.getenv("NOMINATIM_URL", "https://nominatim.openstreetmap.org/search")
+NOMINATIM_TIMEOUT_SECONDS = float(os.getenv("NOMINATIM_TIMEOUT_SECONDS", 2))
+# nominatim's usage policy allows at most 1 request per second
+NOMINATIM_MIN_INTERVAL_SECONDS = 1.0
+
+STATES = {
+    "AL": ("alabama", 32.806671, -86.791130),
+    "AK": ("alaska", 61.370716, -152.404419),
+    "AZ": ("arizona", 33.729759, -111.431221),
+    "AR": ("arkansas", 34.969704, -92.373123),
+    "CA": ("california", 36.116203, -119.681564),
+    "CO": ("colorado", 39.059811, -105.311104),
+    "CT": ("connecticut", 41.597782, -72.755371),
+    "DE": ("delaware", 39.318523, -75.507141),
+    "DC": ("district of columbia", 38.897438, -77.026817),
+    "FL": ("florida", 27.766279, -81.686783),
+    "GA": ("georgia", 33.040619, -83.643074),
+    "HI": ("hawaii", 21.094318, -157.498337),
+    "ID": ("idaho", 44.240459, -114.478828),
+    "IL": ("illinois", 40.349457, -88.986137),
+    "IN": ("indiana", 39.849426, -86.258278),
+    "IA": ("iowa", 42.011539, -93.210526),
+    "KS": ("kansas", 38.526600, -96.726486),
+    "KY": ("kentucky", 37.668140, -84.670067),
+    "LA": ("louisiana", 31.169546, -91.867805),
+    "ME": ("maine", 44.693947, -69.381927),
+    "MD": ("maryland", 39.063946, -76.802101),
+    "MA": ("massachusetts", 42.230171, -71.530106),
+    "MI": ("michigan", 43.326618, -84.536095),
+    "MN": ("minnesota", 45.694454, -93.900192),
+    "MS": ("mississippi", 32.741646, -89.678696),
+    "MO": ("missouri", 38.456085, -92.288368),
+    "MT": ("montana", 46.921925, -110.454353),
+    "NE": ("nebraska", 41.125370, -98.268082),
+    "NV": ("nevada", 38.313515, -117.055374),
+    "NH": ("new hampshire", 43.452492, -71.563896),
+    "NJ": ("new jersey", 40.298904, -74.521011),
+    "NM": ("new mexico", 34.840515, -106.248482),
+    "NY": ("new york", 42.165726, -74.948051),
+    "NC": ("north carolina", 35.630066, -79.806419),
+    "ND": ("north dakota", 47.528912, -99.784012),
+    "OH": ("ohio", 40.388783, -82.764915),
+    "OK": ("oklahoma", 35.565342, -96.928917),
+    "OR": ("oregon", 44.572021, -122.070938),
+    "PA": ("pennsylvania", 40.590752, -77.209755),
+    "PR": ("puerto rico", 18.220833, -66.590149),
+    "RI": ("rhode island", 41.680893, -71.511780),
+    "SC": ("south carolina", 33.856892, -80.945007),
+    "SD": ("south dakota", 44.299782, -99.438828),
+    "TN": ("tennessee", 35.747845, -86.692345),
+    "TX": ("texas", 31.054487, -97.563461),
+    "UT": ("utah", 40.150032, -111.862434),
+    "VT": ("vermont", 44.045876, -72.710686),
+    "VA": ("virginia", 37.769337, -78.169968),
+    "WA": ("washington", 47.400902, -121.490494),
+    "WV": ("west virginia", 38.491226, -80.954453),
+    "WI": ("wisconsin", 44.268543, -89.616508),
+    "WY": ("wyoming", 42.755966, -107.302490),
+}
+
+# large cities, so common queries resolve without the gazetteer file;
+# listed cities win over states of the same name ("new york", "washington")
+CITIES = {
+    ("new york", "NY"): (40.712776, -74.005974),
+    ("new york city", "NY"): (40.712776, -74.005974),
+    ("nyc", "NY"): (40.712776, -74.005974),
+    ("los angeles", "CA"): (34.052235, -118.243683),
+    ("la", "CA"): (34.052235, -118.243683),
+    ("chicago", "IL"): (41.878113, -87.629799),
+    ("houston", "TX"): (29.760427, -95.369804),
+    ("phoenix", "AZ"): (33.448376, -112.074036),
+    ("philadelphia", "PA"): (39.952583, -75.165222),
+    ("philly", "PA"): (39.952583, -75.165222),
+    ("san antonio", "TX"): (29.424122, -98.493629),
+    ("san diego", "CA"): (32.715736, -117.161087),
+    ("dallas", "TX"): (32.776665, -96.796989),
+    ("austin", "TX"): (30.267153, -97.743057),
+    ("san jose", "CA"): (37.338207, -121.886330),
+    ("san francisco", "CA"): (37.774929, -122.419418),
+    ("seattle", "WA"): (47.606209, -122.332069),
+    ("denver", "CO"): (39.739235, -104.990250),
+    ("washington", "DC"): (38.907192, -77.036873),
+    ("washington dc", "DC"): (38.907192, -77.036873),
+    ("boston", "MA"): (42.360081, -71.058884),
+    ("nashville", "TN"): (36.162663, -86.781601),
+    ("baltimore", "MD"): (39.290386, -76.612190),
+    ("atlanta", "GA"): (33.748997, -84.387985),
+    ("miami", "FL"): (25.761681, -80.191788),
+    ("minneapolis", "MN"): (44.977753, -93.265015),
+    ("detroit", "MI"): (42.331429, -83.045753),
+    ("portland", "OR"): (45.505106, -122.675026),
+    ("las vegas", "NV"): (36.169941, -115.139832),
+    ("st louis", "MO"): (38.627003, -90.199402),
+    ("pittsburgh", "PA"): (40.440624, -79.995888),
+    ("cleveland", "OH"): (41.499321, -81.694359),
+    ("rochester", "MN"): (44.012122, -92.480201),
+    ("salt lake city", "UT"): (40.760780, -111.891045),
+    ("new orleans", "LA"): (29.951065, -90.071533),
+}
+
+stats = {"gazetteer_hits": 0, "cache_hits": 0, "remote_calls": 0, "remote_failures": 0, "remote_throttled": 0, "not_found": 0}
+
+def normalize_location(location_query):
+    location = location_query.lower().replace(".", "")
+    location = re.sub(r"\s+", " ", location).strip(" ,")
+    location = re.sub(r",? (usa|us|united states|united states of america)$", "", location)
+    return location
+
+class Gazetteer:
+    """
+    Offline lookup of US ZIP codes, cities and states
+
+    Uses the built-in STATES and CITIES, plus every ZIP code and city in the
+    GeoNames postal code file at path (if it exists), with a city placed at
+    the mean of its ZIP code centroids
+    """
+    def __init__(self, path = GAZETTEER_PATH):
+        self.entries = {}
+        state_names = {abbreviation: name for abbreviation, (name, _, _) in STATES.items()}
+
+        city_sums = {}
+        if path and os.path.exists(path):
+            with open(path, encoding = "utf-8") as f:
+                for row in csv.reader(f, delimiter = "\t"):
+                    zip_code, city, state, lat, lon = row[1], row[2].lower(), row[4], float(row[9]), float(row[10])
+                    self.entries[zip_code] = [lat, lon]
+                    total = city_sums.setdefault((city, state), [0.0, 0.0, 0])
+                    total[0] += lat
+                    total[1] += lon
+                    total[2] += 1
+
+        cities = {key: (lat / n, lon / n, n) for key, (lat, lon, n) in city_sums.items()}
+        cities.update({key: (lat, lon, float("inf")) for key, (lat, lon) in CITIES.items()})
+        # a bare city name goes to its biggest namesake (by number of ZIP codes)
+        by_name = {}
+        for (city, state), (lat, lon, n) in cities.items():
+            self.entries[f"{city}, {state.lower()}"] = [lat, lon]
+            self.entries[f"{city}, {state_names.get(state, state.lower())}"] = [lat, lon]
+            if n > by_name.get(city, (None, None, -1))[2]:
+                by_name[city] = (lat, lon, n)
+
+        for abbreviation, (name, lat, lon) in STATES.items():
+            self.entries.setdefault(name, [lat, lon])
+            self.entries.setdefault(abbreviation.lower(), [lat, lon])
+        for city, (lat, lon, n) in by_name.items():
+            if city not in self.entries or n == float("inf"):
+                self.entries[city] = [lat, lon]
+
+    def lookup(self, location):
+        """
+        Parameters:
+        location: normalized location (see normalize_location)
+
+        Returns:
+        [lat, lon] or None
+        """
+        zip_code = re.fullmatch(r"(\d{5})(-\d{4})?", location)
+        if zip_code:
+            return self.entries.get(zip_code.group(1))
+        if location in self.entries:
+            return self.entries[location]
+        # "boston ma" -> "boston, ma"
+        city, _, state = location.rpartition(" ")
+        if city and "," not in location:
+            return self.entries.get(f"{city}, {state}")
+        return None
+
+class GeocodingUnavailable(Exception):
+    """
+    Nominatim was not asked (rate limit reached) or didn't answer, unlike a
+    location it doesn't know; searching on without the radius would quietly
+    widen the search to the whole country
+    """
+
+class RateLimiter:
+    """
+    Spaces calls at least min_interval apart, giving up instead of queueing
+    when the wait would exceed max_wait
+
+    With a path, the next allowed time is kept in that sqlite file, so the
+    spacing holds across processes (e.g. gunicorn workers), not just threads
+    """
+    def __init__(self, min_interval = NOMINATIM_MIN_INTERVAL_SECONDS, max_wait = 1.0, path = None, name = "nominatim"):
+        self.min_interval = min_interval
+        self.max_wait = max_wait
+        self.name = name
+        self._lock = threading.Lock()
+        self._next_time = 0.0
+        self._conn = None
+        if path:
+            # autocommit, so the read and update below run in one explicit write transaction
+            self._conn = sqlite3.connect(path, timeout = 30, check_same_thread = False, isolation_level = None)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS rate_limit (name TEXT PRIMARY KEY, next_time REAL NOT NULL)")
+
+    def reserve(self, now):
+        """
+        Returns:
+        seconds to wait before calling; the slot is taken only if that is within max_wait
+        """
+        if self._conn is None:
+            wait = self._next_time - now
+            if wait <= self.max_wait:
+                self._next_time = max(now, self._next_time) + self.min_interval
+            return wait
+
+        # BEGIN IMMEDIATE takes the write lock first, so two workers can't read the same slot
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = self._conn.execute("SELECT next_time FROM rate_limit WHERE name = ?", [self.name]).fetchone()
+            next_time = row[0] if row else 0.0
+            wait = next_time - now
+            if wait <= self.max_wait:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO rate_limit (name, next_time) VALUES (?, ?)",
+                    [self.name, max(now, next_time) + self.min_interval]
+                )
+            self._conn.execute("COMMIT")
+        except Exception:
+            self._conn.execute("ROLLBACK")
+            raise
+        return wait
+
+    def acquire(self):
+        with self._lock:
+            # wall clock, as the time is compared across processes
+            wait = self.reserve(time.time())
+        if wait > self.max_wait:
+            return False
+        if wait > 0:
+            time.sleep(wait)
+        return True
+
+_gazetteer = None
+_cache = None
+_rate_limiter = None
+
+def get_gazetteer():
+    global _gazetteer
+    if _gazetteer is None:
+        _gazetteer = Gazetteer()
+    return _gazetteer
+
+def get_rate_limiter():
+    # shares the geocode cache's sqlite file, which every worker already opens
+    global _rate_limiter
+    if _rate_limiter is None:
+        _rate_limiter = RateLimiter(path = GEOCODE_CACHE_PATH or None)
+    return _rate_limiter
+
+def get_geocode_cache():
+    global _cache
+    if _cache is None and GEOCODE_CACHE_PATH:
+        _cache = DiskCache(GEOCODE_CACHE_PATH, max_entries = GEOCODE_CACHE_MAX_ENTRIES, ttl_seconds = GEOCODE_CACHE_TTL_SECONDS)
+    return _cache
+
+def geocode_remote(location_query):
+    """
+    Nominatim lookup, rate limited and with a timeout
+
+    Returns:
+    [lat, lon] or None if Nominatim doesn't know the location; raises
+    GeocodingUnavailable if it was throttled or failed
+    """
+    if not get_rate_limiter().acquire():
+        stats["remote_throttled"] += 1
+        logger.warning("geocoding rate limit reached, skipping: %s", location_query)
+        raise GeocodingUnavailable(f"too many location lookups right now, try again shortly: {location_query}")
+
+    stats["remote_calls"] += 1
+    try:
+        # add a user-agent to comply with usage policy
+        response = requests.get(
+            NOMINATIM_URL,
+            params = {"q": location_query, "format": "json", "limit": 1},
+            headers = {"User-Agent": "ClinicalTrialsSearchApp/1.0"},
+            timeout = NOMINATIM_TIMEOUT_SECONDS
+        )
+        response.raise_for_status()
+        results = response.json()
+    except Exception as e:
+        stats["remote_failures"] += 1
+        logger.warning("error geocoding location %r: %s", location_query, e)
+        raise GeocodingUnavailable(f"could not look up location, try again shortly: {location_query}") from e
+    if results:
+        return [float(results[0]["lat"]), float(results[0]["lon"])]
+    return None
+
+def geocode(location_query):
+    """
+    Get [lat, lon] for a location string: from the local gazetteer, then the
+    cache of earlier remote lookups, then Nominatim
+
+    Returns:
+    [lat, lon] or None if location not found; raises GeocodingUnavailable
+    when Nominatim is needed but throttled or failing
+    """
+    location = normalize_location(location_query)
+    coordinates = get_gazetteer().lookup(location)
+    if coordinates:
+        stats["gazetteer_hits"] += 1
+        return coordinates
+
+    cache = get_geocode_cache()
+    if cache is not None:
+        cached = cache.get(location)
+        if cached is not None:
+            stats["cache_hits"] += 1
+            return json.loads(cached)
+
+    coordinates = geocode_remote(location_query)
+    if cache is not None:
+        # misses are cached too, so a bad location doesn't hit nominatim on every search
+        cache.set(location, json.dumps(coordinates).encode("utf-8"))
+    if coordinates is None:
+        stats["not_found"] += 1
+    return coordinates
+
+def geocoding_stats():
+    lookups = stats["gazetteer_hits"] + stats["cache_hits"] + stats["remote_calls"] + stats["remote_throttled"]
+    return {
+        **stats,
+        "lookups": lookups,
+        "local_hit_rate": (stats["gazetteer_hits"] + stats["cache_hits"]) / lookups if lookups else 0.0
+    }
@@ -1,36 +1,79 @@
+import os
+import json
+import datetime
 import requests
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
-# to update:
-# - decide how to incrementally add studies (e.g. by first_post_date or last_update_date)
-def get_clinical_trials(
-        location = "United States", 
-        status = "RECRUITING|NOT_YET_RECRUITING", 
-        min_date = "MIN", 
-        max_date = "MAX"
-        ):
+# point at benchmarks/ctgov_fixture_server.py to run offline
+API_URL = os.getenv("CLINICALTRIALS_API_URL", "https://clinicaltrials.gov/api/v2/studies")
 
-    print(f"getting clinical trials in {location} first posted from {min_date} to {max_date}")
-    base_url = "https://clinicaltrials.gov/api/v2/studies"
+def get_session(max_retries = 5, pool_size = 8):
+    """
+    requests session with pooled connections, retrying connection errors,
+    rate limits and 5xx responses with exponential backoff
+    """
+    retry = Retry(
+        total = max_retries,
+        backoff_factor = 1,
+        status_forcelist = [429, 500, 502, 503, 504],
+        allowed_methods = ["GET"]
+        )
+    adapter = HTTPAdapter(max_retries = retry, pool_connections = pool_size, pool_maxsize = pool_size)
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+def get_params(location, status, min_date, max_date, date_field, page_size = 100):
     params = {
         "query.locn": location,
         "filter.overallStatus": status, 
-        "filter.advanced": f"AREA[StudyFirstPostDate]RANGE[{min_date}, {max_date}]",
+        "filter.advanced": f"AREA[{date_field}]RANGE[{min_date}, {max_date}]",
         # "filter.ids": "NCT02665065", # test case
         "countTotal": "true",
-        "pageSize": 100
+        "pageSize": page_size
         }
+    if status is None:
+        del params["filter.overallStatus"]
+    return params
+
+# incremental updates by last_update_date live in sync_clinical_trials.py
+def get_clinical_trials(
+        location = "United States", 
+        status = "RECRUITING|NOT_YET_RECRUITING", 
+        min_date = "MIN", 
+        max_date = "MAX",
+        date_field = "StudyFirstPostDate",
+        session = None
+        ):
+    """
+    Get studies whose date_field (e.g. StudyFirstPostDate or LastUpdatePostDate)
+    falls between min_date and max_date, inclusive. status = None returns all statuses
+
+    Keeps every study in memory, so it is meant for small pulls (e.g. a nightly
+    sync); full refreshes go through fetch_clinical_trials
+    """
+
+    print(f"getting clinical trials in {location} with {date_field} from {min_date} to {max_date}")
+    session = session or get_session()
+    params = get_params(location, status, min_date, max_date, date_field)
 
     studies = []
+    total_count = 0
 
     while True:
-        data = requests.get(url = base_url, params = params).json()
+        data = session.get(url = API_URL, params = params, timeout = 60).json()
 
         if data.get("totalCount"): 
             total_count = data.get("totalCount")
 
         studies.extend(data["studies"])
-        print(f"progress: {round(len(studies)/total_count*100)}% out of {total_count}")
+        print(f"progress: {round(len(studies)/max(total_count, 1)*100)}% out of {total_count}")
 
         if data.get("nextPageToken"):
             params["pageToken"] = data.get("nextPageToken")
@@ -40,54 +83,245 @@ def get_clinical_trials(
     
     return studies
 
-studies = get_clinical_trials(location = "United States")
+def shard_date_range(min_date = "MIN", max_date = "MAX", first_year = 2000):
+    """
+    Split [min_date, max_date] into non-overlapping, inclusive (start, end) ranges:
+    one for everything before first_year, then one per year
+
+    Parameters:
+    min_date, max_date: YYYY-MM-DD, or MIN/MAX for open ends
+    """
+    today = datetime.date.today()
+    start = datetime.date(first_year - 1, 12, 31) if min_date == "MIN" else datetime.date.fromisoformat(min_date)
+    end = today if max_date == "MAX" else datetime.date.fromisoformat(max_date)
+
+    shards = []
+    if min_date == "MIN":
+        shards.append(("MIN", start.isoformat()))
+        start = start + datetime.timedelta(days = 1)
+    while start <= end:
+        shard_end = min(datetime.date(start.year, 12, 31), end)
+        shards.append((start.isoformat(), shard_end.isoformat()))
+        start = shard_end + datetime.timedelta(days = 1)
+    if not shards:
+        shards.append((min_date, max_date))
+    elif max_date == "MAX":
+        # anything dated after today
+        shards[-1] = (shards[-1][0], "MAX")
+    return shards
+
+def write_json_atomic(path, data):
+    with open(path + ".tmp", "w") as f:
+        json.dump(data, f)
+    os.replace(path + ".tmp", path)
+
+def fetch_shard(session, params, shard_dir):
+    """
+    Follow nextPageToken for one shard, writing each page to shard_dir as
+    page_NNNNN.jsonl (one study per line) and checkpointing the next page token
+    after every page, so an interrupted shard picks up where it stopped
+
+    Returns:
+    number of studies in the shard
+    """
+    os.makedirs(shard_dir, exist_ok = True)
+    checkpoint_path = os.path.join(shard_dir, "checkpoint.json")
+    checkpoint = {"page_token": None, "pages": 0, "studies": 0, "done": False}
+    if os.path.exists(checkpoint_path):
+        with open(checkpoint_path) as f:
+            checkpoint = json.load(f)
+
+    params = dict(params)
+    while not checkpoint["done"]:
+        if checkpoint["page_token"]:
+            params["pageToken"] = checkpoint["page_token"]
+        response = session.get(url = API_URL, params = params, timeout = 60)
+        response.raise_for_status()
+        data = response.json()
+
+        page_path = os.path.join(shard_dir, f"page_{checkpoint['pages']:05d}.jsonl")
+        with open(page_path + ".tmp", "w") as f:
+            for study in data["studies"]:
+                f.write(json.dumps(study) + "\n")
+        os.replace(page_path + ".tmp", page_path)
+
+        checkpoint = {
+            "page_token": data.get("nextPageToken"),
+            "pages": checkpoint["pages"] + 1,
+            "studies": checkpoint["studies"] + len(data["studies"]),
+            "done": not data.get("nextPageToken")
+            }
+        write_json_atomic(checkpoint_path, checkpoint)
+
+    return checkpoint["studies"]
+
+def fetch_clinical_trials(
+        out_dir = "studies_pages",
+        location = "United States", 
+        status = "RECRUITING|NOT_YET_RECRUITING", 
+        min_date = "MIN", 
+        max_date = "MAX",
+        date_field = "StudyFirstPostDate",
+        max_workers = 4,
+        page_size = 1000
+        ):
+    """
+    Same studies as get_clinical_trials, but the date range is split into
+    shards that are fetched concurrently over one pooled session, and pages
+    are streamed to out_dir instead of held in memory. Rerunning with the same
+    out_dir resumes an interrupted fetch; read the studies back with iter_studies
+    """
+    shards = shard_date_range(min_date, max_date)
+    print(f"getting clinical trials in {location} with {date_field} from {min_date} to {max_date} in {len(shards)} shards")
+
+    session = get_session(pool_size = max_workers)
+    with ThreadPoolExecutor(max_workers = max_workers) as executor:
+        futures = [
+            executor.submit(
+                fetch_shard,
+                session,
+                get_params(location, status, shard_start, shard_end, date_field, page_size),
+                os.path.join(out_dir, f"{shard_start}_{shard_end}")
+                )
+            for shard_start, shard_end in shards
+            ]
+        total_count = 0
+        for n_done, future in enumerate(futures, start = 1):
+            total_count += future.result()
+            print(f"progress: {n_done}/{len(shards)} shards, {total_count} studies")
+
+    print("progress: finished")
+    return out_dir
+
+def iter_studies(out_dir = "studies_pages"):
+    """
+    Yield the studies written by fetch_clinical_trials, one at a time, in shard and page order
+    """
+    for shard in sorted(os.listdir(out_dir)):
+        shard_dir = os.path.join(out_dir, shard)
+        if not os.path.isdir(shard_dir):
+            continue
+        for page in sorted(os.listdir(shard_dir)):
+            if page.endswith(".jsonl"):
+                with open(os.path.join(shard_dir, page)) as f:
+                    for line in f:
+                        yield json.loads(line)
 
 # to update:
 # - add arm, intervention and outcomes, under treatment
-studies_df = pd.DataFrame([{
-    # what is the status of the study? 
-    "nct_id": study["protocolSection"]["identificationModule"].get("nctId", ""),
-    "status": study["protocolSection"]["statusModule"].get("overallStatus", ""),
-    "start_date": study["protocolSection"]["statusModule"].get("startDateStruct", {}).get("date", ""),
-    "completion_date": study["protocolSection"]["statusModule"].get("completionDateStruct", {}).get("date", ""),
-    "first_post_date": study["protocolSection"]["statusModule"].get("studyFirstPostDateStruct", {}).get("date", ""),
-    "last_update_date": study["protocolSection"]["statusModule"].get("lastUpdatePostDateStruct", {}).get("date", ""),
-    # who's running the study?
-    "contact": list(
-        set([contact["name"] for contact in study["protocolSection"]["contactsLocationsModule"].get("centralContacts", {})]) |
-        set([pi["name"] for pi in study["protocolSection"]["contactsLocationsModule"].get("overallOfficials", {})])
-        ),
-    "sponsor": study["protocolSection"]["sponsorCollaboratorsModule"].get("leadSponsor", {}).get("name", ""),
-    "collaborators": [collab["name"] for collab in study["protocolSection"]["sponsorCollaboratorsModule"].get("collaborators", "")],
-    "lat_lon": [
-        [location["geoPoint"]["lat"], location["geoPoint"]["lon"]]
-        for location in study["protocolSection"]["contactsLocationsModule"].get("locations", [])
-        if location.get("geoPoint") and "lat" in location["geoPoint"] and "lon" in location["geoPoint"]
-        ],
-    # what is the study about?
-    "brief_title": study["protocolSection"]["identificationModule"].get("briefTitle", ""),
-    "official_title": study["protocolSection"]["identificationModule"].get("officialTitle", ""),
-    "purpose": study["protocolSection"]["descriptionModule"].get("briefSummary", ""),
-    "description": study["protocolSection"]["descriptionModule"].get("detailedDescription", ""),
-    "conditions_treated": study["protocolSection"]["conditionsModule"].get("conditions", ""),
-    # how is the study conducted? 
-    "type": study["protocolSection"]["designModule"].get("studyType", ""),
-    "phase": study["protocolSection"]["designModule"].get("phases", ""),
-    # who is eligibility?
-    "criteria_overall": study["protocolSection"]["eligibilityModule"].get("eligibilityCriteria", ""),
-    "criteria_sex": study["protocolSection"]["eligibilityModule"].get("sex", ""),
-    "criteria_age": study["protocolSection"]["eligibilityModule"].get("stdAges", "")
-    } for study in studies])
-
-studies_df["keywords"] = studies_df.apply(lambda x: f"""
-# Title:\n\n{x["official_title"]}\n
-# Purpose:\n\n{x["purpose"]}\n
-# Description:\n\n{x["description"]}
-""", axis = 1)
-studies_df["start_date"] = [date + "-01" if len(date) == 7 else date for date in studies_df["start_date"]]
-studies_df["completion_date"] = [date + "-01" if len(date) == 7 else date for date in studies_df["completion_date"]]
-studies_df["first_post_date"] = [date + "-01" if len(date) == 7 else date for date in studies_df["first_post_date"]]
-studies_df["last_update_date"] = [date + "-01" if len(date) == 7 else date for date in studies_df["last_update_date"]]
-
-studies_df.to_csv("studies_looking_for_participants_20250518.csv")
-print("wrote to studies_looking_for_participants_20250518.csv")
+def study_to_record(study):
+    """
+    Flatten a study from the API into one row of the studies table
+    """
+    protocol = study["protocolSection"]
+    return {
+        # what is the status of the study? 
+        "nct_id": protocol["identificationModule"].get("nctId", ""),
+        "status": protocol["statusModule"].get("overallStatus", ""),
+        "start_date": protocol["statusModule"].get("startDateStruct", {}).get("date", ""),
+        "completion_date": protocol["statusModule"].get("completionDateStruct", {}).get("date", ""),
+        "first_post_date": protocol["statusModule"].get("studyFirstPostDateStruct", {}).get("date", ""),
+        "last_update_date": protocol["statusModule"].get("lastUpdatePostDateStruct", {}).get("date", ""),
+        # who's running the study?
+        "contact": list(
+            set([contact["name"] for contact in protocol["contactsLocationsModule"].get("centralContacts", {})]) |
+            set([pi["name"] for pi in protocol["contactsLocationsModule"].get("overallOfficials", {})])
+            ),
+        "sponsor": protocol["sponsorCollaboratorsModule"].get("leadSponsor", {}).get("name", ""),
+        "collaborators": [collab["name"] for collab in protocol["sponsorCollaboratorsModule"].get("collaborators", [])],
+        "lat_lon": [
+            [location["geoPoint"]["lat"], location["geoPoint"]["lon"]]
+            for location in protocol["contactsLocationsModule"].get("locations", [])
+            if location.get("geoPoint") and "lat" in location["geoPoint"] and "lon" in location["geoPoint"]
+            ],
+        # what is the study about?
+        "brief_title": protocol["identificationModule"].get("briefTitle", ""),
+        "official_title": protocol["identificationModule"].get("officialTitle", ""),
+        "purpose": protocol["descriptionModule"].get("briefSummary", ""),
+        "description": protocol["descriptionModule"].get("detailedDescription", ""),
+        "conditions_treated": protocol["conditionsModule"].get("conditions", []),
+        # how is the study conducted? 
+        "type": protocol["designModule"].get("studyType", ""),
+        "phase": protocol["designModule"].get("phases", []),
+        # who is eligibility?
+        "criteria_overall": protocol["eligibilityModule"].get("eligibilityCriteria", ""),
+        "criteria_sex": protocol["eligibilityModule"].get("sex", ""),
+        "criteria_age": protocol["eligibilityModule"].get("stdAges", [])
+        }
+
+STUDIES_SCHEMA = pa.schema([
+    ("nct_id", pa.string()),
+    ("status", pa.string()),
+    ("start_date", pa.string()),
+    ("completion_date", pa.string()),
+    ("first_post_date", pa.string()),
+    ("last_update_date", pa.string()),
+    ("contact", pa.list_(pa.string())),
+    ("sponsor", pa.string()),
+    ("collaborators", pa.list_(pa.string())),
+    ("lat_lon", pa.list_(pa.list_(pa.float64()))),
+    ("brief_title", pa.string()),
+    ("official_title", pa.string()),
+    ("purpose", pa.string()),
+    ("description", pa.string()),
+    ("conditions_treated", pa.list_(pa.string())),
+    ("type", pa.string()),
+    ("phase", pa.list_(pa.string())),
+    ("criteria_overall", pa.string()),
+    ("criteria_sex", pa.string()),
+    ("criteria_age", pa.list_(pa.string())),
+    ("keywords", pa.string()),
+])
+LIST_COLUMNS = [field.name for field in STUDIES_SCHEMA if pa.types.is_list(field.type)]
+DATE_COLUMNS = ["start_date", "completion_date", "first_post_date", "last_update_date"]
+
+def studies_to_df(studies):
+    studies_df = pd.DataFrame([study_to_record(study) for study in studies], columns = STUDIES_SCHEMA.names[:-1])
+
+    studies_df["keywords"] = (
+        "\n# Title:\n\n" + studies_df["official_title"] +
+        "\n\n# Purpose:\n\n" + studies_df["purpose"] +
+        "\n\n# Description:\n\n" + studies_df["description"] + "\n"
+        )
+    # dates with only a month (YYYY-MM) start on the 1st
+    for column in DATE_COLUMNS:
+        studies_df[column] = studies_df[column].where(studies_df[column].str.len() != 7, studies_df[column] + "-01")
+
+    return studies_df
+
+def write_studies_parquet(studies, path, chunk_size = 5000):
+    """
+    Stream studies (e.g. from iter_studies) into a parquet file, chunk_size
+    rows at a time, so memory stays flat however many studies there are
+
+    Returns:
+    number of studies written
+    """
+    n_studies = 0
+    with pq.ParquetWriter(path, STUDIES_SCHEMA) as writer:
+        chunk = []
+        for study in studies:
+            chunk.append(study)
+            if len(chunk) == chunk_size:
+                writer.write_table(pa.Table.from_pandas(studies_to_df(chunk), schema = STUDIES_SCHEMA, preserve_index = False))
+                n_studies += len(chunk)
+                chunk = []
+        if chunk:
+            writer.write_table(pa.Table.from_pandas(studies_to_df(chunk), schema = STUDIES_SCHEMA, preserve_index = False))
+            n_studies += len(chunk)
+    return n_studies
+
+def read_studies_parquet(path):
+    """
+    Read a file written by write_studies_parquet, with list columns as python lists
+    """
+    table = pq.read_table(path)
+    studies_df = table.drop_columns(LIST_COLUMNS).to_pandas()
+    for column in LIST_COLUMNS:
+        studies_df[column] = table.column(column).to_pylist()
+    return studies_df[table.column_names]
+
+if __name__ == "__main__":
+    pages_dir = fetch_clinical_trials(out_dir = "studies_pages_20250518", location = "United States")
+    n_studies = write_studies_parquet(iter_studies(pages_dir), "studies_looking_for_participants_20250518.parquet")
+    print(f"wrote {n_studies} studies to studies_looking_for_participants_20250518.parquet")
@@ -0,0 +1,359 @@
+"""
+In-process vector index, an alternative to searching the hosted Qdrant collection
+
+An index is a directory of .npy files, memory-mapped on load so gunicorn
+workers on one machine share the vectors through the page cache:
+- vectors.npy: float32, L2-normalized, used to rescore the candidates; one
+  row per chunk of a trial, a trial's rows from vector_offsets[i] to vector_offsets[i + 1]
+- vectors_int8.npy + int8_scale.npy: int8 quantized vectors (4x smaller)
+- vectors_binary.npy: sign bits, packed (32x smaller)
+- ids.npy, sites.npy, site_offsets.npy: point ids and trial sites for geo filters
+- payloads.json: the Qdrant payloads (without the "locations" geo points)
+- hnsw.bin: optional HNSW graph over the float32 vectors (needs `pip install hnswlib`)
+
+search() and query_points() take the same arguments as the QdrantClient
+methods, filters included, and return the same ScoredPoints, so the index
+can stand in for the client. A trial with several vectors scores as its best
+one, like Qdrant's max-sim multivectors.
+
+usage:
+    python local_index.py --parquet studies_looking_for_participants_20250518_with_embedding.parquet
+    python local_index.py --qdrant-url http://localhost:6333 --hnsw
+"""
+import os
+import json
+import argparse
+import numpy as np
+from qdrant_client import models
+from qdrant_client.http.models import QueryResponse
+from geo_distance import haversine_many
+
+LOCAL_INDEX_PATH = os.getenv("LOCAL_INDEX_PATH", "local_index")
+METERS_PER_MILE = 1609.344
+MILES_PER_DEGREE_LAT = 69.0
+HNSW_MIN_FILTERED_FRACTION = 0.1
+SCAN_CHUNK_ROWS = 4096
+# bits set in each byte, for hamming distances on numpy < 2 (no np.bitwise_count)
+POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype = np.uint8)
+
+def normalize(vectors):
+    vectors = np.asarray(vectors, dtype = np.float32)
+    norms = np.linalg.norm(vectors, axis = -1, keepdims = True)
+    return vectors / np.maximum(norms, 1e-12)
+
+def pack_signs(vectors):
+    """
+    Sign bits of the vectors, packed into uint64 words for hamming distances
+    """
+    bits = np.packbits(np.atleast_2d(vectors) > 0, axis = 1)
+    bits = np.pad(bits, ((0, 0), (0, -bits.shape[1] % 8)))
+    return np.ascontiguousarray(bits).view(np.uint64)
+
+def hamming(words, query_words):
+    xor = np.bitwise_xor(words, query_words)
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(xor).sum(axis = 1, dtype = np.int32)
+    return POPCOUNT[xor.view(np.uint8)].sum(axis = 1, dtype = np.int32)
+
+def write_local_index(path, ids, vectors, payloads, hnsw = False, payload_fields = None):
+    """
+    Write an index directory
+
+    Parameters:
+    ids: point ids (int)
+    vectors: embeddings, one per id, or a list of chunk embeddings per id
+    payloads: Qdrant payloads, one per id
+    hnsw: also build an HNSW graph
+    payload_fields: the payload fields to keep (all if None), e.g. only the
+    ones searches return or filter on, since every worker holds them in memory
+    """
+    os.makedirs(path, exist_ok = True)
+    vectors = [np.atleast_2d(np.asarray(v, dtype = np.float32)) for v in vectors]
+    counts = [len(v) for v in vectors]
+    vectors = normalize(np.concatenate(vectors))
+    # per-dimension symmetric scale, so each int8 column uses its full range
+    scale = np.maximum(np.abs(vectors).max(axis = 0), 1e-12) / 127
+    np.save(os.path.join(path, "vectors.npy"), vectors)
+    np.save(os.path.join(path, "vectors_int8.npy"), np.round(vectors / scale).astype(np.int8))
+    np.save(os.path.join(path, "int8_scale.npy"), scale.astype(np.float32))
+    np.save(os.path.join(path, "vectors_binary.npy"), pack_signs(vectors))
+    np.save(os.path.join(path, "vector_offsets.npy"), np.concatenate([[0], np.cumsum(counts)]).astype(np.int64))
+    np.save(os.path.join(path, "ids.npy"), np.asarray(ids, dtype = np.int64))
+
+    sites_per_trial = [payload.get("lat_lon") or [] for payload in payloads]
+    counts = np.array([len(sites) for sites in sites_per_trial], dtype = np.int64)
+    sites = np.array([site for sites in sites_per_trial for site in sites], dtype = np.float64).reshape(-1, 2)
+    np.save(os.path.join(path, "sites.npy"), sites)
+    np.save(os.path.join(path, "site_offsets.npy"), np.concatenate([[0], np.cumsum(counts)]))
+
+    with open(os.path.join(path, "payloads.json"), "w") as f:
+        json.dump(
+            [
+                {k: v for k, v in payload.items() if k != "locations" and (payload_fields is None or k in payload_fields)}
+                for payload in payloads
+            ], f,
+            default = lambda value: value.tolist()
+        )
+
+    if hnsw:
+        import hnswlib
+        index = hnswlib.Index(space = "ip", dim = vectors.shape[1])
+        index.init_index(max_elements = len(vectors), ef_construction = 200, M = 16)
+        index.add_items(vectors, np.arange(len(vectors)))
+        index.save_index(os.path.join(path, "hnsw.bin"))
+
+class LocalIndex:
+    """
+    Parameters:
+    path: index directory written by write_local_index
+    quantization: "binary", "int8" or None (exact float32 scan)
+    rescore_multiplier: candidates kept per result from the quantized scan (or HNSW), rescored exactly
+
+    int8 (the default) reads 4x less memory than float32 and keeps recall@10 at
+    1.0 on benchmarks/local_index.py; numpy has no int8 matrix product, so
+    unfiltered it scores slower than float32, but filtered searches are faster.
+    binary scans 32x less and is the fastest, but its recall@10 there is about
+    0.4, so use it only with a much larger rescore_multiplier
+    use_hnsw: search the HNSW graph instead of scanning (needs hnsw.bin)
+    payload_fields: the payload fields to keep in memory (all if None), for
+    indexes written with every field
+    """
+    def __init__(self, path = LOCAL_INDEX_PATH, quantization = "int8", rescore_multiplier = 10, use_hnsw = False, hnsw_ef = 128, payload_fields = None):
+        load = lambda name: np.load(os.path.join(path, name), mmap_mode = "r")
+        self.vectors = load("vectors.npy")
+        self.vectors_int8 = load("vectors_int8.npy")
+        self.int8_scale = np.load(os.path.join(path, "int8_scale.npy"))
+        self.vectors_binary = load("vectors_binary.npy")
+        self.ids = np.load(os.path.join(path, "ids.npy"))
+        # indexes written before chunking have one vector per trial
+        offsets_path = os.path.join(path, "vector_offsets.npy")
+        self.vector_offsets = np.load(offsets_path) if os.path.exists(offsets_path) else np.arange(len(self.ids) + 1)
+        self.row_trials = np.repeat(np.arange(len(self.ids)), np.diff(self.vector_offsets))
+        self.sites = np.load(os.path.join(path, "sites.npy"))
+        self.site_offsets = np.load(os.path.join(path, "site_offsets.npy"))
+        with open(os.path.join(path, "payloads.json")) as f:
+            self.payloads = json.load(f)
+        if payload_fields is not None:
+            self.payloads = [{k: v for k, v in payload.items() if k in payload_fields} for payload in self.payloads]
+
+        if quantization not in ("int8", "binary", None):
+            raise ValueError(f"unknown quantization: {quantization}")
+        self.quantization = quantization
+        self.rescore_multiplier = rescore_multiplier
+        self.hnsw = None
+        if use_hnsw:
+            import hnswlib
+            self.hnsw = hnswlib.Index(space = "ip", dim = self.vectors.shape[1])
+            self.hnsw.load_index(os.path.join(path, "hnsw.bin"))
+            self.hnsw.set_ef(hnsw_ef)
+        self._match_masks = {}
+
+    def __len__(self):
+        return len(self.ids)
+
+    def match_mask(self, key, values):
+        """
+        Trials whose payload key (a value or a list of values) has any of values,
+        like MatchAny; cached, as the same few filters come back on every query
+        """
+        cache_key = (key, tuple(sorted(values)))
+        if cache_key not in self._match_masks:
+            values = set(values)
+            self._match_masks[cache_key] = np.fromiter(
+                (
+                    bool(values.intersection(v)) if isinstance(v, list) else v in values
+                    for v in (payload.get(key) for payload in self.payloads)
+                ),
+                dtype = bool, count = len(self.payloads)
+            )
+        return self._match_masks[cache_key]
+
+    def geo_mask(self, geo_radius):
+        """
+        Trials with any site within the radius
+        """
+        center = [geo_radius.center.lat, geo_radius.center.lon]
+        miles = geo_radius.radius / METERS_PER_MILE
+        # cheap latitude band first, haversine only on the sites inside it
+        near = np.flatnonzero(np.abs(self.sites[:, 0] - center[0]) <= miles / MILES_PER_DEGREE_LAT)
+        within = near[haversine_many(center, self.sites[near]) <= miles]
+        mask = np.zeros(len(self.ids), dtype = bool)
+        mask[np.searchsorted(self.site_offsets, within, side = "right") - 1] = True
+        return mask
+
+    def condition_mask(self, condition):
+        if isinstance(condition, models.Filter):
+            return self.filter_mask(condition)
+        if condition.geo_radius is not None:
+            return self.geo_mask(condition.geo_radius)
+        if isinstance(condition.match, models.MatchAny):
+            return self.match_mask(condition.key, condition.match.any)
+        if isinstance(condition.match, models.MatchValue):
+            return self.match_mask(condition.key, [condition.match.value])
+        raise ValueError(f"unsupported filter condition: {condition}")
+
+    def filter_mask(self, query_filter):
+        mask = np.ones(len(self.ids), dtype = bool)
+        for condition in query_filter.must or []:
+            mask &= self.condition_mask(condition)
+        if query_filter.should:
+            mask &= np.logical_or.reduce([self.condition_mask(condition) for condition in query_filter.should])
+        for condition in query_filter.must_not or []:
+            mask &= ~self.condition_mask(condition)
+        return mask
+
+    def trial_rows(self, trials):
+        """
+        Rows of the trials' vectors, trial after trial, and where each trial's rows start
+        """
+        counts = self.vector_offsets[trials + 1] - self.vector_offsets[trials]
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]]).astype(np.int64)
+        rows = np.arange(counts.sum()) + np.repeat(self.vector_offsets[trials] - starts, counts)
+        return rows, starts
+
+    def candidates(self, query_vector, trials, k):
+        """
+        Top k candidate trials (positions into the index) by approximate score
+        """
+        # like qdrant's query planner: restrictive filters scan their few matches instead of the graph
+        if self.hnsw is not None and (trials is None or len(trials) > HNSW_MIN_FILTERED_FRACTION * len(self)):
+            allowed = None if trials is None else set(self.trial_rows(trials)[0].tolist())
+            labels, _ = self.hnsw.knn_query(
+                query_vector, k = min(k, len(self.vectors) if allowed is None else len(allowed)),
+                filter = None if allowed is None else allowed.__contains__
+            )
+            return np.unique(self.row_trials[labels[0]])
+
+        if trials is None:
+            trials, rows, starts = np.arange(len(self)), slice(None), self.vector_offsets[:-1]
+        else:
+            rows, starts = self.trial_rows(trials)
+        if self.quantization == "binary":
+            scores = -hamming(self.vectors_binary[rows], pack_signs(query_vector))
+        elif self.quantization == "int8":
+            # in chunks, so the float32 copies stay small
+            query_scaled = query_vector * self.int8_scale
+            positions = np.arange(len(self.vectors))[rows]
+            scores = np.concatenate([
+                self.vectors_int8[positions[start:start + SCAN_CHUNK_ROWS]].astype(np.float32) @ query_scaled
+                for start in range(0, len(positions), SCAN_CHUNK_ROWS)
+            ])
+        else:
+            scores = self.vectors[rows] @ query_vector
+        # a trial scores as its best chunk
+        scores = np.maximum.reduceat(scores, starts)
+        if k < len(scores):
+            top = np.argpartition(-scores, k)[:k]
+            return trials[top]
+        return trials
+
+    def search(self, collection_name = None, query_vector = None, limit = 10, offset = 0, query_filter = None, with_payload = True, **kwargs):
+        """
+        Same arguments and results as QdrantClient.search (collection_name is
+        ignored); with_payload can be a list of the payload fields to return
+        """
+        query_vector = normalize(query_vector)
+        trials = None
+        if query_filter is not None:
+            trials = np.flatnonzero(self.filter_mask(query_filter))
+            if not len(trials):
+                return []
+
+        # quantization (or HNSW) narrows down to a few candidates, which are rescored exactly
+        k = limit + (offset or 0)
+        exact = self.quantization is None and self.hnsw is None
+        trials = self.candidates(query_vector, trials, k if exact else k * self.rescore_multiplier)
+        trials = np.sort(trials)  # sequential reads from the memory map
+        rows, starts = self.trial_rows(trials)
+        scores = np.maximum.reduceat(self.vectors[rows] @ query_vector, starts)
+        order = np.argsort(-scores)[offset or 0:k]
+        return [
+            models.ScoredPoint(
+                id = int(self.ids[trials[i]]),
+                version = 0,
+                score = float(scores[i]),
+                payload = self.project(self.payloads[trials[i]], with_payload)
+            )
+            for i in order
+        ]
+
+    def query_points(self, collection_name = None, query = None, limit = 10, offset = 0, query_filter = None, with_payload = True, **kwargs):
+        """
+        Same arguments and results as QdrantClient.query_points, for a dense
+        query vector or a multivector query of one vector
+        """
+        query = np.asarray(query, dtype = np.float32)
+        if query.ndim == 2:
+            if len(query) != 1:
+                raise ValueError("multivector queries of more than one vector are not supported")
+            query = query[0]
+        return QueryResponse(points = self.search(
+            query_vector = query, limit = limit, offset = offset, query_filter = query_filter, with_payload = with_payload
+        ))
+
+    def query_batch_points(self, collection_name = None, requests = (), **kwargs):
+        """
+        Same arguments and results as QdrantClient.query_batch_points
+        """
+        return [
+            self.query_points(
+                query = request.query, limit = request.limit or 10, offset = request.offset,
+                query_filter = request.filter, with_payload = request.with_payload
+            )
+            for request in requests
+        ]
+
+    @staticmethod
+    def project(payload, with_payload):
+        if with_payload is True:
+            return payload
+        if not with_payload:
+            return None
+        return {key: payload[key] for key in with_payload if key in payload}
+
+def iter_qdrant_points(client, collection_name, batch_size = 1000):
+    offset = None
+    while True:
+        points, offset = client.scroll(
+            collection_name = collection_name, limit = batch_size, offset = offset,
+            with_payload = True, with_vectors = True
+        )
+        yield from points
+        if offset is None:
+            break
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "build an in-process vector index")
+    parser.add_argument("--path", default = LOCAL_INDEX_PATH)
+    parser.add_argument("--parquet", help = "trials with keywords_embeddings, from put_clinical_trials_into_qdrant_db.py")
+    parser.add_argument("--qdrant-url", help = "copy the points of a qdrant collection instead")
+    parser.add_argument("--qdrant-api-key", default = os.getenv("QDRANT_API_KEY"))
+    parser.add_argument("--collection", default = "clinical_trials")
+    parser.add_argument("--hnsw", action = "store_true")
+    args = parser.parse_args()
+
+    if args.parquet:
+        import pandas as pd
+        from put_clinical_trials_into_qdrant_db import nct_id_to_point_id, trial_payload
+        df = pd.read_parquet(args.parquet)
+        ids = [nct_id_to_point_id(nct_id) for nct_id in df["nct_id"]]
+        # a list of chunk embeddings per trial comes back as an array of arrays
+        vectors = [np.stack(list(v)) if v.dtype == object else v for v in df["keywords_embeddings"]]
+        # parquet reads list columns back as arrays
+        payloads = [
+            {k: v.tolist() if isinstance(v, np.ndarray) else v for k, v in trial_payload(row).items()}
+            for row in df.assign(lat_lon = df["lat_lon"].map(lambda sites: [list(site) for site in sites])).to_dict("records")
+        ]
+    elif args.qdrant_url:
+        from qdrant_client import QdrantClient
+        client = QdrantClient(url = args.qdrant_url, api_key = args.qdrant_api_key)
+        points = list(iter_qdrant_points(client, args.collection))
+        ids = [point.id for point in points]
+        vectors = [point.vector for point in points]
+        payloads = [point.payload for point in points]
+    else:
+        parser.error("one of --parquet or --qdrant-url is needed")
+
+    from query_clinical_trials import LOCAL_INDEX_PAYLOAD_FIELDS
+    write_local_index(args.path, ids, vectors, payloads, hnsw = args.hnsw, payload_fields = LOCAL_INDEX_PAYLOAD_FIELDS)
+    print(f"wrote {len(ids)} trials to {args.path}")
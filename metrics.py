@@ -0,0 +1,100 @@
+"""
+In-process metrics in the Prometheus text format, for app.py's /metrics
+
+Metrics are per process: with several gunicorn workers, each scrape sees
+the worker that served it (run one worker per port, or scrape through a
+sidecar, to see them all)
+"""
+import time
+import threading
+from contextlib import contextmanager
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+COUNT_BUCKETS = (0, 1, 5, 10, 25, 50, 100, 250)
+
+_lock = threading.Lock()
+_metrics = []
+_collectors = []
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+class Counter:
+    type = "counter"
+
+    def __init__(self, name, help):
+        self.name, self.help = name, help
+        self.values = {}
+        _metrics.append(self)
+
+    def inc(self, amount = 1, **labels):
+        key = tuple(sorted(labels.items()))
+        with _lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self):
+        return [f"{self.name}{format_labels(labels)} {value}" for labels, value in sorted(self.values.items())]
+
+class Histogram:
+    type = "histogram"
+
+    def __init__(self, name, help, buckets = LATENCY_BUCKETS):
+        self.name, self.help = name, help
+        self.buckets = buckets
+        # labels -> [count per bucket..., count, sum]
+        self.values = {}
+        _metrics.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with _lock:
+            values = self.values.setdefault(key, [0] * (len(self.buckets) + 1) + [0.0])
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    values[i] += 1
+            values[-2] += 1
+            values[-1] += value
+
+    def render(self):
+        lines = []
+        for labels, values in sorted(self.values.items()):
+            for bound, count in zip(self.buckets + ("+Inf",), values):
+                lines.append(f"{self.name}_bucket{format_labels(labels + (('le', bound),))} {count}")
+            lines.append(f"{self.name}_count{format_labels(labels)} {values[-2]}")
+            lines.append(f"{self.name}_sum{format_labels(labels)} {values[-1]}")
+        return lines
+
+def register_collector(collect):
+    """
+    collect() returns (name, help, type, {labels dict as tuple: value}) tuples,
+    read at scrape time, for stats kept elsewhere (e.g. cache hit counts)
+    """
+    _collectors.append(collect)
+
+def render():
+    lines = []
+    for metric in _metrics:
+        lines += [f"# HELP {metric.name} {metric.help}", f"# TYPE {metric.name} {metric.type}"] + metric.render()
+    for collect in _collectors:
+        for name, help, type, values in collect():
+            lines += [f"# HELP {name} {help}", f"# TYPE {name} {type}"]
+            lines += [f"{name}{format_labels(labels)} {value}" for labels, value in values.items()]
+    return "\n".join(lines) + "\n"
+
+STAGE_SECONDS = Histogram("search_stage_seconds", "time spent in each stage of a search")
+SEARCHES = Counter("searches_total", "searches, by endpoint and outcome")
+RESULTS = Histogram("search_results", "results returned per search", buckets = COUNT_BUCKETS)
+RESULTS_REQUESTED = Counter("search_results_requested_total", "results asked of the vector search")
+RESULTS_RETURNED = Counter("search_results_returned_total", "results the vector search returned (returned / requested is the fetch yield)")
+INTENT_CACHE = Counter("intent_cache_requests_total", "intent cache lookups, by result")
+FAILURES = Counter("search_failures_total", "failed lookups that degraded a search, by kind")
+
+@contextmanager
+def timed(stage):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_SECONDS.observe(time.perf_counter() - start, stage = stage)
@@ -1,18 +1,286 @@
+"""
+Copy the clinical_trials collection from the local Qdrant to the cloud, with no downtime
+
+Searches use the name "clinical_trials", which on the cloud is an alias for
+a versioned collection (clinical_trials_YYYYMMDD_HHMMSS). A migration
+builds the next version next to the live one, checks it, and then
+repoints the alias in one atomic operation. The previous version is kept
+for rollback (--keep).
+
+- incremental (the default): the new version starts as a server-side copy
+  of the live one, and only the points that changed are uploaded. A point
+  has changed if the hash of its payload and vector differs from the
+  content_hash stored in its payload. Points missing from the source are
+  deleted.
+- --snapshot: ship a snapshot of the whole local collection instead (e.g.
+  after re-embedding every trial), then label each point with its hash.
+
+Each new version is checked before the swap: the point count, a checksum
+over every point's content_hash, and a sample of points compared
+field-by-field with the source.
+
+usage:
+    python migrate_qdrant_db_from_local_to_cloud.py --dry-run
+    python migrate_qdrant_db_from_local_to_cloud.py
+    python migrate_qdrant_db_from_local_to_cloud.py --snapshot
+
+The first run against a cloud collection that is not an alias yet deletes
+that collection just before creating the alias, so searches fail for a
+moment, once.
+"""
 import os
-from qdrant_client import QdrantClient
+import json
+import time
+import random
+import hashlib
+import argparse
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import requests
+from qdrant_client import QdrantClient, models
 from dotenv import load_dotenv, find_dotenv
+from local_index import iter_qdrant_points
 
 _ = load_dotenv(find_dotenv())
 QDRANT_API_KEY = os.getenv("QDRANT_API_KEY")
+QDRANT_URL = os.getenv("QDRANT_URL", "https://09ded390-e5ee-4905-80a4-0de54ed1ddd3.us-east4-0.gcp.cloud.qdrant.io:6333")
+
+ALIAS = "clinical_trials"
+HASH_FIELD = "content_hash"
+
+def content_hash(payload, vector):
+    payload = {key: value for key, value in payload.items() if key != HASH_FIELD}
+    digest = hashlib.sha256(json.dumps(payload, sort_keys = True, default = str).encode("utf-8"))
+    digest.update(np.asarray(vector, dtype = np.float32).tobytes())
+    return digest.hexdigest()
+
+def checksum(hashes):
+    """
+    One hash over {point id: content hash}, independent of point order
+    """
+    digest = hashlib.sha256()
+    for point_id in sorted(hashes):
+        digest.update(f"{point_id}:{hashes[point_id]}\n".encode("utf-8"))
+    return digest.hexdigest()
+
+def read_hashes(client, collection_name, batch_size = 10000):
+    hashes, offset = {}, None
+    while True:
+        points, offset = client.scroll(
+            collection_name = collection_name, limit = batch_size, offset = offset,
+            with_payload = [HASH_FIELD], with_vectors = False
+        )
+        hashes.update({point.id: (point.payload or {}).get(HASH_FIELD) for point in points})
+        if offset is None:
+            return hashes
+
+def get_live_collection(client, alias = ALIAS):
+    """
+    Returns:
+    (collection behind the alias, or a plain collection with the alias' name, or None;
+    whether it is behind an alias)
+    """
+    for description in client.get_aliases().aliases:
+        if description.alias_name == alias:
+            return description.collection_name, True
+    if client.collection_exists(alias):
+        return alias, False
+    return None, False
+
+def version_name():
+    return f"{ALIAS}_{time.strftime('%Y%m%d_%H%M%S')}"
+
+def create_version(source, dest, source_collection, init_from = None):
+    """
+    A new versioned collection on dest, with the source's vector config and
+    payload indexes, holding a server-side copy of init_from if given
+    """
+    name = version_name()
+    info = source.get_collection(source_collection)
+    dest.create_collection(
+        collection_name = name,
+        vectors_config = info.config.params.vectors,
+        init_from = models.InitFrom(collection = init_from) if init_from else None,
+        timeout = 600
+    )
+    for field_name, schema in info.payload_schema.items():
+        dest.create_payload_index(collection_name = name, field_name = field_name, field_schema = schema.data_type)
+    return name
+
+def copy_changed_points(source, dest, source_collection, dest_collection, dest_hashes, batch_size = 256, max_workers = 8, dry_run = False):
+    """
+    Stream the source's points and upsert, in parallel batches, the ones
+    whose hash isn't in dest_hashes, then delete the points the source no
+    longer has
+
+    Returns:
+    {point id: content hash} of the source
+    """
+    source_hashes, batch, in_flight = {}, [], deque()
+    n_changed = 0
+    with ThreadPoolExecutor(max_workers = max_workers) as executor:
+        def submit(points):
+            # a bounded number of batches in flight, so memory stays flat however many points changed
+            if len(in_flight) >= max_workers * 2:
+                in_flight.popleft().result()
+            in_flight.append(executor.submit(dest.upsert, collection_name = dest_collection, points = points, wait = True))
+
+        for point in iter_qdrant_points(source, source_collection):
+            source_hashes[point.id] = content_hash(point.payload, point.vector)
+            if dest_hashes.get(point.id) == source_hashes[point.id]:
+                continue
+            n_changed += 1
+            if dry_run:
+                continue
+            batch.append(models.PointStruct(id = point.id, vector = point.vector, payload = {**point.payload, HASH_FIELD: source_hashes[point.id]}))
+            if len(batch) == batch_size:
+                submit(batch)
+                batch = []
+        if batch:
+            submit(batch)
+        while in_flight:
+            in_flight.popleft().result()
+
+    deleted = [point_id for point_id in dest_hashes if point_id not in source_hashes]
+    print(f"{len(source_hashes)} points in source: {n_changed} new or changed, {len(deleted)} deleted, {len(source_hashes) - n_changed} unchanged")
+    if deleted and not dry_run:
+        for start in range(0, len(deleted), 1000):
+            dest.delete(collection_name = dest_collection, points_selector = models.PointIdsList(points = deleted[start:start + 1000]))
+    return source_hashes
+
+def copy_snapshot(source, dest, source_url, dest_url, source_collection, dest_collection, batch_size = 1000):
+    """
+    Full copy through a snapshot of the source collection, uploaded to dest
+    as dest_collection, then the content_hash of every point set
+
+    Returns:
+    {point id: content hash} of the source
+    """
+    snapshot = source.create_snapshot(collection_name = source_collection, wait = True)
+    snapshot_url = f"{source_url}/collections/{source_collection}/snapshots/{snapshot.name}"
+    path = os.path.join(os.getcwd(), snapshot.name)
+    try:
+        start_time = time.time()
+        with requests.get(snapshot_url, stream = True, timeout = 60) as response:
+            response.raise_for_status()
+            with open(path, "wb") as f:
+                for chunk in response.iter_content(chunk_size = 1 << 20):
+                    f.write(chunk)
+        with open(path, "rb") as f:
+            response = requests.post(
+                f"{dest_url}/collections/{dest_collection}/snapshots/upload",
+                params = {"priority": "snapshot", "wait": "true"},
+                headers = {"api-key": QDRANT_API_KEY} if QDRANT_API_KEY else {},
+                files = {"snapshot": (snapshot.name, f)},
+                timeout = 3600
+            )
+        response.raise_for_status()
+        print(f"shipped snapshot of {os.path.getsize(path) / 1e6:.0f} MB in {time.time() - start_time:.0f}s")
+    finally:
+        if os.path.exists(path):
+            os.remove(path)
+        source.delete_snapshot(collection_name = source_collection, snapshot_name = snapshot.name)
+
+    source_hashes = {point.id: content_hash(point.payload, point.vector) for point in iter_qdrant_points(source, source_collection)}
+    point_ids = list(source_hashes)
+    for start in range(0, len(point_ids), batch_size):
+        dest.batch_update_points(
+            collection_name = dest_collection,
+            update_operations = [
+                models.SetPayloadOperation(set_payload = models.SetPayload(payload = {HASH_FIELD: source_hashes[point_id]}, points = [point_id]))
+                for point_id in point_ids[start:start + batch_size]
+            ]
+        )
+    return source_hashes
+
+def verify(source, dest, source_collection, dest_collection, source_hashes, n_sample = 100):
+    """
+    Raise if dest_collection doesn't hold exactly the source's points
+    """
+    dest_count = dest.count(collection_name = dest_collection, exact = True).count
+    if dest_count != len(source_hashes):
+        raise RuntimeError(f"{dest_collection} has {dest_count} points, source has {len(source_hashes)}")
+
+    dest_hashes = read_hashes(dest, dest_collection)
+    if checksum(dest_hashes) != checksum(source_hashes):
+        n_wrong = sum(dest_hashes.get(point_id) != h for point_id, h in source_hashes.items())
+        raise RuntimeError(f"checksum mismatch: {n_wrong} points of {dest_collection} differ from the source")
+
+    # the hashes were written by this tool, so also compare some points' actual contents
+    sample = random.sample(list(source_hashes), min(n_sample, len(source_hashes)))
+    expected = {point.id: point for point in source.retrieve(collection_name = source_collection, ids = sample, with_vectors = True)}
+    for point in dest.retrieve(collection_name = dest_collection, ids = sample, with_vectors = True):
+        payload = {key: value for key, value in point.payload.items() if key != HASH_FIELD}
+        if payload != expected[point.id].payload or not np.allclose(point.vector, expected[point.id].vector, atol = 1e-6):
+            raise RuntimeError(f"point {point.id} of {dest_collection} differs from the source")
+    print(f"verified {dest_collection}: {dest_count} points, checksum {checksum(dest_hashes)[:16]}, {len(sample)} points compared")
+
+def swap_alias(dest, new_collection, live_collection, is_alias, alias = ALIAS):
+    if live_collection and not is_alias:
+        # first migration: the live collection has the alias' name and has to go first
+        dest.delete_collection(live_collection)
+    operations = [models.CreateAliasOperation(create_alias = models.CreateAlias(collection_name = new_collection, alias_name = alias))]
+    if is_alias:
+        operations.insert(0, models.DeleteAliasOperation(delete_alias = models.DeleteAlias(alias_name = alias)))
+    dest.update_collection_aliases(change_aliases_operations = operations)
+    print(f"{alias} -> {new_collection}")
+
+def drop_old_versions(dest, keep, previous_collection = None, alias = ALIAS):
+    """
+    Delete all but keep versions: the live one, then previous_collection (the
+    one it replaced, to roll back to), then the newest of the rest. Versions
+    that failed verification are newer than the rollback target, so they go first
+    """
+    live_collection, _ = get_live_collection(dest, alias)
+    versions = sorted((
+        collection.name for collection in dest.get_collections().collections
+        if collection.name.startswith(f"{alias}_") and collection.name != live_collection
+    ), reverse = True)
+    if previous_collection in versions:
+        versions.remove(previous_collection)
+        versions.insert(0, previous_collection)
+    for name in versions[max(keep - 1, 0):]:
+        dest.delete_collection(name)
+        print(f"deleted old version {name}")
+
+def migrate(source, dest, source_url, dest_url, source_collection = ALIAS, snapshot = False, max_workers = 8, keep = 2, dry_run = False):
+    start_time = time.time()
+    live_collection, is_alias = get_live_collection(dest)
+    print(f"live collection: {live_collection or 'none'}{' (alias)' if is_alias else ''}")
+
+    if dry_run:
+        dest_hashes = read_hashes(dest, live_collection) if live_collection else {}
+        copy_changed_points(source, dest, source_collection, None, dest_hashes, dry_run = True)
+        return
+
+    if snapshot:
+        new_collection = version_name()
+        source_hashes = copy_snapshot(source, dest, source_url, dest_url, source_collection, new_collection)
+    else:
+        new_collection = create_version(source, dest, source_collection, init_from = live_collection)
+        dest_hashes = read_hashes(dest, new_collection) if live_collection else {}
+        source_hashes = copy_changed_points(source, dest, source_collection, new_collection, dest_hashes, max_workers = max_workers)
+
+    try:
+        verify(source, dest, source_collection, new_collection, source_hashes)
+    except Exception:
+        print(f"verification failed, {ALIAS} still points to {live_collection}; {new_collection} kept for inspection")
+        raise
+    swap_alias(dest, new_collection, live_collection, is_alias)
+    drop_old_versions(dest, keep, previous_collection = live_collection)
+    print(f"migrated in {time.time() - start_time:.0f}s")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "copy the local clinical_trials collection to the cloud behind an alias")
+    parser.add_argument("--source-url", default = "http://localhost:6333")
+    parser.add_argument("--dest-url", default = QDRANT_URL)
+    parser.add_argument("--snapshot", action = "store_true", help = "ship a full snapshot instead of the changed points")
+    parser.add_argument("--max-workers", type = int, default = 8, help = "upserts in flight at once")
+    parser.add_argument("--keep", type = int, default = 2, help = "versions to keep, including the live one")
+    parser.add_argument("--dry-run", action = "store_true", help = "only count the points that would be copied")
+    args = parser.parse_args()
 
-cloud_client = QdrantClient(
-    url = "https://09ded390-e5ee-4905-80a4-0de54ed1ddd3.us-east4-0.gcp.cloud.qdrant.io:6333", 
-    api_key = QDRANT_API_KEY
-)
-local_client = QdrantClient("localhost", port = 6333)
-
-local_client.migrate(
-    dest_client = cloud_client, 
-    collection_names = ["clinical_trials"],
-    batch_size = 100,
-    recreate_on_collision = True)
+    source = QdrantClient(url = args.source_url)
+    dest = QdrantClient(url = args.dest_url, api_key = QDRANT_API_KEY, timeout = 60)
+    migrate(source, dest, args.source_url, args.dest_url, snapshot = args.snapshot, max_workers = args.max_workers, keep = args.keep, dry_run = args.dry_run)
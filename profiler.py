@@ -0,0 +1,50 @@
+"""
+Sampling profiler for slow requests, with no dependencies
+
+A background thread records the stacks of the other threads every few
+milliseconds. Stacks are written in the "folded" format that flamegraph.pl
+and speedscope read. Searches run on a shared thread pool, so a profile
+also holds samples from requests running at the same time.
+"""
+import os
+import sys
+import threading
+from collections import Counter
+
+class SamplingProfiler:
+    def __init__(self, interval = 0.005):
+        self.interval = interval
+        self.samples = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target = self._run, daemon = True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        return self.samples
+
+    def _run(self):
+        own_id = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                # idle threads sit in threading.py waiting for work
+                if thread_id != own_id and not frame.f_code.co_filename.endswith("threading.py"):
+                    self.samples[fold(frame)] += 1
+
+def fold(frame):
+    stack = []
+    while frame is not None:
+        stack.append(f"{os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_name}:{frame.f_lineno}")
+        frame = frame.f_back
+    return ";".join(reversed(stack))
+
+def write_folded(samples, path):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok = True)
+    with open(path, "w") as f:
+        for stack, count in samples.most_common():
+            f.write(f"{stack} {count}\n")
+    return path
@@ -1,78 +1,168 @@
 import os
-import pandas as pd
+import time
 from tqdm.autonotebook import tqdm
 from qdrant_client import QdrantClient, models
 from dotenv import load_dotenv, find_dotenv
-from utils import get_token, get_embedding
+from utils import tokenize, get_chunk_embeddings, get_embedding_backend
+from get_clinical_trials import read_studies_parquet
 
 _ = load_dotenv(find_dotenv())
 QDRANT_API_KEY = os.getenv("QDRANT_API_KEY")
 
-df = pd.read_csv("studies_looking_for_participants_20250518.csv")
-
-# to update:
-# - improve embedding model
-tqdm.pandas(desc = "counting tokens")
-df["keywords_tokens"] = df["keywords"].progress_apply(lambda x: len(get_token(x)))
-tqdm.pandas(desc = "generating embeddings")
-df["keywords_embeddings"] = df["keywords"].progress_apply(lambda x: get_embedding(x))
-
-df.to_csv('studies_looking_for_participants_20250518_with_embedding.csv', index=False)
-
-client = QdrantClient("localhost", port = 6333)
-# client = QdrantClient(
-#     url = "https://09ded390-e5ee-4905-80a4-0de54ed1ddd3.us-east4-0.gcp.cloud.qdrant.io:6333", 
-#     api_key = QDRANT_API_KEY
-# )
-if not client.collection_exists(collection_name = "clinical_trials"):
-    client.create_collection(
-        collection_name = "clinical_trials",
-        vectors_config = models.VectorParams(
-            size = 1536,
-            distance = models.Distance.COSINE
-        )
-    )
+COLLECTION_NAME = "clinical_trials"
+# filterable fields, stored as normalized keyword arrays with payload indexes
+KEYWORD_FIELDS = ["type", "criteria_sex", "criteria_age", "status", "phase"]
+
+def nct_id_to_point_id(nct_id):
+    return int(nct_id.replace("NCT", ""))
 
-# Process records in batches
-BATCH_SIZE = 100
-total_records = len(df)
-
-for start_idx in tqdm(range(0, total_records, BATCH_SIZE), desc="Upserting records"):
-    end_idx = min(start_idx + BATCH_SIZE, total_records)
-    batch_df = df.iloc[start_idx:end_idx]
-    
-    client.upsert(
-        collection_name = "clinical_trials",
-        points = [
-            models.PointStruct(
-                id = int(row["nct_id"].replace("NCT", "")),
-                vector = row["keywords_embeddings"],
-                payload = {
-                "nct_id": row["nct_id"],
-                "status": row["status"],
-                "start_date": row["start_date"],
-                "completion_date": row["completion_date"],
-                "first_post_date": row["first_post_date"],
-                "last_update_date": row["last_update_date"],
-                "contact": row["contact"],
-                "sponsor": row["sponsor"],
-                "collaborators": row["collaborators"],
-                "lat_lon": row["lat_lon"],
-                "brief_title": row["brief_title"],
-                "official_title": row["official_title"],
-                "purpose": row["purpose"],
-                "description": row["description"],
-                "conditions_treated": row["conditions_treated"],
-                "type": row["type"],
-                "phase": row["phase"],
-                "criteria_overall": row["criteria_overall"],
-                "criteria_sex": row["criteria_sex"],
-                "criteria_age": row["criteria_age"],
-                "keywords_tokens": row["keywords_tokens"],
-                }
+# EMBEDDING_BACKEND=local embeds on the CPU instead of the openai API
+def add_embeddings(df):
+    """
+    keywords_tokens: token count of each trial's keywords, from one batched pass
+    keywords_embeddings: a list of vectors per trial, one per chunk of as many
+    tokens as the embedding model reads (a single one for all but the longest
+    trials with openai; several for many trials with a local model)
+    """
+    start_time = time.time()
+    token_lists = tokenize(df["keywords"].tolist())
+    df["keywords_tokens"] = [len(tokens) for tokens in token_lists]
+    print(f"counted {df['keywords_tokens'].sum()} tokens in {time.time() - start_time:.1f}s")
+
+    start_time = time.time()
+    df["keywords_embeddings"] = get_chunk_embeddings(df["keywords"].tolist(), max_workers = 4, token_lists = token_lists)
+    elapsed = time.time() - start_time
+    print(f"generated embeddings for {len(df)} trials in {elapsed:.1f}s ({len(df)/max(elapsed, 1e-9):.1f} trials/sec)")
+    return df
+
+def create_collection(client, collection_name = COLLECTION_NAME):
+    """
+    Create the collection if it's missing; raises ValueError if it exists
+    with vectors that upsert_trials can't write, so ingest stops before
+    paying for the embeddings
+    """
+    dimension = get_embedding_backend().dimension
+    if client.collection_exists(collection_name = collection_name):
+        vectors = client.get_collection(collection_name).config.params.vectors
+        if getattr(vectors, "multivector_config", None) is None or vectors.size != dimension:
+            raise ValueError(
+                f"{collection_name} doesn't hold {dimension}-d multivectors (a vector per chunk of each trial), "
+                f"e.g. it was built before chunking or with another embedding model: ingest into a new collection "
+                f"and move searches to it with migrate_qdrant_db_from_local_to_cloud.py, or delete it first"
+            )
+    else:
+        client.create_collection(
+            collection_name = collection_name,
+            # a trial is one vector per chunk, scored by its best chunk
+            vectors_config = models.VectorParams(
+                size = dimension,
+                distance = models.Distance.COSINE,
+                multivector_config = models.MultiVectorConfig(comparator = models.MultiVectorComparator.MAX_SIM)
             )
-            for _, row in batch_df.iterrows()
-        ]
+        )
+    # radius searches filter on the trial sites server-side
+    client.create_payload_index(
+        collection_name = collection_name,
+        field_name = "locations",
+        field_schema = models.PayloadSchemaType.GEO
     )
+    # so filtered searches look up matching trials instead of scanning payloads
+    for field_name in KEYWORD_FIELDS:
+        client.create_payload_index(
+            collection_name = collection_name,
+            field_name = field_name,
+            field_schema = models.PayloadSchemaType.KEYWORD
+        )
+
+def to_geo_points(lat_lon):
+    return [{"lat": lat, "lon": lon} for lat, lon in lat_lon]
+
+def to_keywords(value):
+    """
+    A value or list of values as sorted, distinct, upper-case keywords,
+    without blanks and "NA" (e.g. " Phase2" -> ["PHASE2"], ["NA"] -> [])
+    """
+    values = [value] if isinstance(value, str) else list(value if value is not None else [])
+    keywords = {v.strip().upper() for v in values if v}
+    return sorted(keywords - {"", "NA"})
+
+def trial_payload(row):
+    """
+    list columns (lat_lon, phase, criteria_age, ...) go into the payloads as
+    native lists, so the query side never has to parse them, and the
+    KEYWORD_FIELDS as keyword lists, so one MatchAny filters any of them
+    """
+    return {
+        "nct_id": row["nct_id"],
+        "status": to_keywords(row["status"]),
+        "start_date": row["start_date"],
+        "completion_date": row["completion_date"],
+        "first_post_date": row["first_post_date"],
+        "last_update_date": row["last_update_date"],
+        "contact": row["contact"],
+        "sponsor": row["sponsor"],
+        "collaborators": row["collaborators"],
+        "lat_lon": row["lat_lon"],
+        "locations": to_geo_points(row["lat_lon"]),
+        "brief_title": row["brief_title"],
+        "official_title": row["official_title"],
+        "purpose": row["purpose"],
+        "description": row["description"],
+        "conditions_treated": row["conditions_treated"],
+        "type": to_keywords(row["type"]),
+        "phase": to_keywords(row["phase"]),
+        "criteria_overall": row["criteria_overall"],
+        "criteria_sex": to_keywords(row["criteria_sex"]),
+        "criteria_age": to_keywords(row["criteria_age"]),
+        "keywords_tokens": int(row["keywords_tokens"]),
+    }
+
+def upsert_trials(client, df, collection_name = COLLECTION_NAME, batch_size = 100):
+    # Process records in batches
+    total_records = len(df)
+
+    for start_idx in tqdm(range(0, total_records, batch_size), desc="Upserting records"):
+        end_idx = min(start_idx + batch_size, total_records)
+        batch_df = df.iloc[start_idx:end_idx]
+
+        client.upsert(
+            collection_name = collection_name,
+            points = [
+                models.PointStruct(
+                    id = nct_id_to_point_id(row["nct_id"]),
+                    vector = row["keywords_embeddings"],
+                    payload = trial_payload(row)
+                )
+                for _, row in batch_df.iterrows()
+            ]
+        )
+
+def delete_trials(client, nct_ids, collection_name = COLLECTION_NAME):
+    if nct_ids:
+        client.delete(
+            collection_name = collection_name,
+            points_selector = models.PointIdsList(points = [nct_id_to_point_id(nct_id) for nct_id in nct_ids])
+        )
+
+if __name__ == "__main__":
+    from sync_clinical_trials import write_watermark
+
+    client = QdrantClient("localhost", port = 6333)
+    # client = QdrantClient(
+    #     url = "https://09ded390-e5ee-4905-80a4-0de54ed1ddd3.us-east4-0.gcp.cloud.qdrant.io:6333",
+    #     api_key = QDRANT_API_KEY
+    # )
+    # before embedding, so a collection of the wrong kind fails fast
+    create_collection(client)
+
+    df = read_studies_parquet("studies_looking_for_participants_20250518.parquet")
+    df = add_embeddings(df)
+
+    df.to_parquet("studies_looking_for_participants_20250518_with_embedding.parquet", index = False)
+
+    upsert_trials(client, df)
+
+    # later runs of sync_clinical_trials.py only fetch what changed after this snapshot
+    write_watermark(df["last_update_date"].max())
 
-print(f"end: collection size of {client.get_collection("clinical_trials").points_count}")
+    print(f"end: collection size of {client.get_collection(COLLECTION_NAME).points_count}")
@@ -1,24 +1,36 @@
 import os
+import re
 import json
-import ast
-import math
-import requests
+import base64
+import sqlite3
+import queue
+import asyncio
+import logging
+import threading
+import functools
+from concurrent.futures import ThreadPoolExecutor
+import httpx
 from qdrant_client import QdrantClient, models
-import openai
 from pydantic import BaseModel
-from dotenv import load_dotenv, find_dotenv
-from utils import get_embedding
+from utils import get_embedding, get_embeddings, get_embedding_backend, get_embedding_cache, get_openai_client, get_encoder
+from cache import DiskCache, hash_key, pack_vector, unpack_vector
+from geo_distance import nearest_site_distances
+from geocoding import GeocodingUnavailable, geocode, geocoding_stats, get_gazetteer, get_geocode_cache
+import metrics
+
+logger = logging.getLogger(__name__)
 
-_ = load_dotenv(find_dotenv())
-openai.api_key = os.getenv("OPENAI_API_KEY")
 QDRANT_API_KEY = os.getenv("QDRANT_API_KEY")
+# e.g. QDRANT_URL=http://localhost:6333 for a local server (docker run -p 6333:6333 qdrant/qdrant)
+QDRANT_URL = os.getenv("QDRANT_URL", "https://09ded390-e5ee-4905-80a4-0de54ed1ddd3.us-east4-0.gcp.cloud.qdrant.io:6333")
+QDRANT_TIMEOUT_SECONDS = int(os.getenv("QDRANT_TIMEOUT_SECONDS", 10))
+COLLECTION_NAME = "clinical_trials"
 
-# client = QdrantClient("localhost", port = 6333)
-client = QdrantClient(
-    url = "https://09ded390-e5ee-4905-80a4-0de54ed1ddd3.us-east4-0.gcp.cloud.qdrant.io:6333", 
-    api_key = QDRANT_API_KEY
-)
-print(f"number of trials in database: {client.get_collection('clinical_trials').points_count}")
+# SEARCH_BACKEND=local searches an in-process, memory-mapped copy of the
+# collection built by local_index.py, instead of the hosted cluster
+SEARCH_BACKEND = os.getenv("SEARCH_BACKEND", "qdrant")
+_search_client = None
+_multivector = None
 
 # UPDATED SYSTEM PROMPT - More explicit about extracting age/sex from query
 SEARCH_INTENT_SYSTEM_PROMPT = """
@@ -59,6 +71,36 @@ Only include values that are explicitly mentioned in the query.
 If a location is mentioned but no distance, use 50 miles as the default.
 """
 
+METERS_PER_MILE = 1609.344
+FILTER_FIELDS = ["type", "criteria_sex", "criteria_age", "status", "phase"]
+# values a filter accepts besides its own: trials open to all sexes match either sex
+FILTER_VALUES = {
+    "criteria_sex": {"FEMALE": ["ALL", "FEMALE"], "MALE": ["ALL", "MALE"]},
+}
+# the payload fields format_results uses, so searches don't ship descriptions and criteria
+RESULT_PAYLOAD_FIELDS = [
+    "nct_id", "brief_title", "conditions_treated", "start_date", "status", "type",
+    "phase", "sponsor", "criteria_age", "criteria_sex", "lat_lon"
+]
+# all the local index keeps of each payload: what searches return or filter on
+LOCAL_INDEX_PAYLOAD_FIELDS = list(dict.fromkeys(RESULT_PAYLOAD_FIELDS + FILTER_FIELDS))
+SEARCH_TIMEOUT_SECONDS = float(os.getenv("SEARCH_TIMEOUT_SECONDS", 20))
+SEARCH_BATCH_TIMEOUT_SECONDS = float(os.getenv("SEARCH_BATCH_TIMEOUT_SECONDS", 300))
+# LLM parses in flight at once for a batch
+SEARCH_BATCH_CONCURRENCY = int(os.getenv("SEARCH_BATCH_CONCURRENCY", 16))
+SEARCH_THREADS = int(os.getenv("SEARCH_THREADS", 32))
+# shared by every request's pipeline, so concurrent searches reuse threads
+_executor = ThreadPoolExecutor(max_workers = SEARCH_THREADS)
+# keep-alive connections to Qdrant, enough for every search thread to have one
+QDRANT_POOL_SIZE = int(os.getenv("QDRANT_POOL_SIZE", SEARCH_THREADS))
+
+# parsed intents (and their embeddings) for repeated queries, shared by all workers on the machine;
+# set INTENT_CACHE_PATH to "" to turn the cache off
+INTENT_CACHE_PATH = os.getenv("INTENT_CACHE_PATH", "intent_cache.sqlite3")
+INTENT_CACHE_TTL_SECONDS = int(os.getenv("INTENT_CACHE_TTL_SECONDS", 7 * 24 * 3600))
+INTENT_CACHE_MAX_ENTRIES = int(os.getenv("INTENT_CACHE_MAX_ENTRIES", 50000))
+_intent_cache = None
+
 class RESPONSE_FORMAT(BaseModel):
     type: str
     criteria_sex: str
@@ -68,83 +110,179 @@ class RESPONSE_FORMAT(BaseModel):
     semantic_phrases: str
 
 def clean_value(value):
-    if value is None or value == "['NA']":
+    if value is None or value == ["NA"]:
         return ""
-    try:
-        parsed_value = ast.literal_eval(value)
-        if isinstance(parsed_value, list):
-            return ", ".join([str(v) for v in parsed_value])
-        return str(parsed_value)
-    except (ValueError, SyntaxError):
-        return value
+    if isinstance(value, list):
+        return ", ".join([str(v) for v in value])
+    return str(value)
 
-def haversine(coord1, coord2):
+def get_coordinates_from_location(location_query):
     """
-    Calculate the great-circle distance between two coordinates
-    in miles using the Haversine formula
+    Get [lat, lon] for a location string, from the local gazetteer and
+    geocoding cache first, falling back to OpenStreetMap Nominatim
     
     Parameters:
-    coord1, coord2: [lat, lon] coordinates
+    location_query: String representing location (e.g., "Boston, MA")
     
     Returns:
-    Distance in miles
+    [lat, lon] or None if location not found; raises GeocodingUnavailable
+    if it couldn't be looked up just now, so the search fails instead of
+    dropping its radius
     """
-    lat1, lon1 = coord1
-    lat2, lon2 = coord2
-    
-    # Convert decimal degrees to radians
-    lat1, lon1, lat2, lon2 = map(math.radians, [lat1, lon1, lat2, lon2])
-    
-    # Haversine formula
-    dlon = lon2 - lon1
-    dlat = lat2 - lat1
-    a = math.sin(dlat/2)**2 + math.cos(lat1) * math.cos(lat2) * math.sin(dlon/2)**2
-    c = 2 * math.asin(math.sqrt(a))
-    r = 3956  # Radius of earth in miles
-    
-    return c * r
+    try:
+        coordinates = geocode(location_query)
+    except GeocodingUnavailable:
+        metrics.FAILURES.inc(kind = "geocode_unavailable")
+        raise
+    if coordinates is None:
+        metrics.FAILURES.inc(kind = "geocode")
+        logger.warning("could not geocode location: %s", location_query)
+    return coordinates
 
-def get_coordinates_from_location(location_query):
+def get_search_client():
+    """
+    The vector search client, created on first use rather than at import, so
+    workers start without touching the network: the local index with
+    SEARCH_BACKEND=local, otherwise a Qdrant client with a pool of
+    QDRANT_POOL_SIZE keep-alive connections
+    """
+    global _search_client
+    if _search_client is None:
+        if SEARCH_BACKEND == "local":
+            from local_index import LocalIndex
+            _search_client = LocalIndex(
+                quantization = os.getenv("LOCAL_INDEX_QUANTIZATION", "int8") or None,
+                use_hnsw = os.getenv("LOCAL_INDEX_HNSW") == "1",
+                payload_fields = LOCAL_INDEX_PAYLOAD_FIELDS
+            )
+        else:
+            _search_client = QdrantClient(
+                url = QDRANT_URL,
+                api_key = QDRANT_API_KEY,
+                timeout = QDRANT_TIMEOUT_SECONDS,
+                limits = httpx.Limits(max_connections = QDRANT_POOL_SIZE, max_keepalive_connections = QDRANT_POOL_SIZE)
+            )
+    return _search_client
+
+def uses_multivectors(refresh = False):
+    """
+    Whether the collection holds a vector per chunk of each trial (see
+    add_embeddings), searched with a multivector query; collections built
+    before chunking hold one plain vector per trial. Checked once per process,
+    and again when a search fails (see retry_on_collection_change)
+    """
+    global _multivector
+    if _multivector is None or refresh:
+        # the local index takes both kinds of query
+        _multivector = SEARCH_BACKEND == "local" or get_search_client().get_collection(COLLECTION_NAME).config.params.vectors.multivector_config is not None
+    return _multivector
+
+def as_query(query_vector):
+    return [query_vector] if uses_multivectors() else query_vector
+
+def retry_on_collection_change(f):
+    """
+    f(), retried once if it failed because the collection changed between
+    plain and multivector, as when the migration tool repoints the alias
+    under running workers; Qdrant rejects a query of the other kind
+    """
+    try:
+        return f()
+    except Exception:
+        was_multivector = _multivector
+        try:
+            changed = SEARCH_BACKEND != "local" and uses_multivectors(refresh = True) != was_multivector
+        except Exception:
+            changed = False
+        if not changed:
+            raise
+    logger.info("%s is now %s, retrying the search", COLLECTION_NAME, "multivector" if _multivector else "plain vector")
+    return f()
+
+def search(collection_name, query_vector, limit = 10, offset = 0, query_filter = None, with_payload = True):
+    # through the query API, which scores a trial by its best chunk (max-sim)
+    return retry_on_collection_change(lambda: get_search_client().query_points(
+        collection_name = collection_name,
+        query = as_query(query_vector),
+        limit = limit,
+        offset = offset,
+        query_filter = query_filter,
+        with_payload = with_payload
+    ).points)
+
+def search_batch(collection_name, requests):
     """
-    Get [lat, lon] for a location string using OpenStreetMap Nominatim API
-    
     Parameters:
-    location_query: String representing location (e.g., "Boston, MA")
-    
+    requests: QueryRequests with plain query vectors, sent in the collection's query shape
+    """
+    return retry_on_collection_change(lambda: [
+        response.points for response in get_search_client().query_batch_points(
+            collection_name = collection_name,
+            requests = [request.model_copy(update = {"query": as_query(request.query)}) for request in requests]
+        )
+    ])
+
+def count_trials():
+    """
+    Number of trials in the collection; raises if the search backend is unreachable
+    """
+    client = get_search_client()
+    if SEARCH_BACKEND == "local":
+        return len(client)
+    return client.get_collection(COLLECTION_NAME).points_count
+
+def warm_up():
+    """
+    Create the clients, caches and tokenizer ahead of the first search (and
+    load the local embedding model, if that is the backend), then check the
+    collection is reachable
+
     Returns:
-    [lat, lon] or None if location not found
+    number of trials in the collection
     """
-    try:
-        # Use Nominatim API for geocoding (add a user-agent to comply with usage policy)
-        url = f"https://nominatim.openstreetmap.org/search?q={location_query}&format=json&limit=1"
-        headers = {"User-Agent": "ClinicalTrialsSearchApp/1.0"}
-        response = requests.get(url, headers=headers)
-        
-        if response.status_code == 200:
-            results = response.json()
-            if results:
-                lat = float(results[0]["lat"])
-                lon = float(results[0]["lon"])
-                return [lat, lon]
-        
-        print(f"Could not geocode location: {location_query}")
-        return None
-    except Exception as e:
-        print(f"Error geocoding location: {str(e)}")
-        return None
-
-def get_clinical_trials(
-    user_message,  
-    search_intent_system_prompt = SEARCH_INTENT_SYSTEM_PROMPT, 
-    n_results = 10,
-    model = "gpt-4.1-nano", 
-    temperature = 0, 
-    max_tokens = 500, 
-    response_format = RESPONSE_FORMAT,
-    geo_buffer_factor = 10  # Factor to increase initial results for geo filtering
+    get_encoder()
+    get_openai_client()
+    backend = get_embedding_backend()
+    if hasattr(backend, "encoder"):
+        backend.encoder
+    get_embedding_cache()
+    get_intent_cache()
+    get_geocode_cache()
+    get_gazetteer()
+    uses_multivectors()
+    n_trials = count_trials()
+    logger.info("warmed up, %d trials in %s", n_trials, "local index" if SEARCH_BACKEND == "local" else COLLECTION_NAME)
+    return n_trials
+
+def get_intent_cache():
+    global _intent_cache
+    if _intent_cache is None and INTENT_CACHE_PATH:
+        _intent_cache = DiskCache(INTENT_CACHE_PATH, max_entries = INTENT_CACHE_MAX_ENTRIES, ttl_seconds = INTENT_CACHE_TTL_SECONDS)
+    return _intent_cache
+
+def normalize_query(user_message):
+    return re.sub(r"\s+", " ", user_message.lower()).strip(" ?!.")
+
+def intent_cache_key(user_message, search_intent_system_prompt, model, temperature, response_format):
+    return hash_key(
+        normalize_query(user_message),
+        hash_key(search_intent_system_prompt),
+        json.dumps(response_format.model_json_schema(), sort_keys = True),
+        model, temperature, get_embedding_backend().model
+    )
+
+def parse_search_intent(
+    user_message,
+    search_intent_system_prompt = SEARCH_INTENT_SYSTEM_PROMPT,
+    model = "gpt-4.1-nano",
+    temperature = 0,
+    max_tokens = 500,
+    response_format = RESPONSE_FORMAT
 ):
-    # Parse the user query to extract search parameters
-    llm_response = openai.beta.chat.completions.parse(
+    """
+    Parse the user query into structured filters and semantic phrases with the LLM
+    """
+    llm_response = get_openai_client().beta.chat.completions.parse(
         messages = [
             {"role": "system","content": search_intent_system_prompt},
             {"role": "user", "content": user_message}
@@ -154,163 +292,475 @@ def get_clinical_trials(
         max_tokens = max_tokens,
         response_format = response_format
     )
+    return json.loads(llm_response.choices[0].message.content)
 
-    structured_query = json.loads(llm_response.choices[0].message.content)
-    semantic = structured_query["semantic_phrases"]
-    
-    search_params = {
+def get_search_params(structured_query):
+    return {
         "type": structured_query["type"],
         "criteria_sex": structured_query["criteria_sex"],
         "criteria_age": structured_query["criteria_age"],
         "location": structured_query["location"],
         "distance_miles": structured_query["distance_miles"] if structured_query["location"] else 0,
-        "semantic_phrases": semantic
-    }
-    
-    filters = {k: v for k, v in structured_query.items() if k in ["type", "criteria_sex", "criteria_age"]}
-    
-    # DEBUG: Print parsed query to see what's happening
-    print(f"\n=== DEBUG: Query Parsing ===")
-    print(f"Original query: {user_message}")
-    print(f"Parsed structured filters: {filters}")
-    print(f"Parsed semantic search phrases: {semantic}")
-    print(f"Location: {structured_query['location']}, distance: {structured_query['distance_miles']} miles")
-    
-    TYPE_MAP = {
-        "": ["INTERVENTIONAL", "OBSERVATIONAL"],
-        "INTERVENTIONAL": ["INTERVENTIONAL"],
-        "OBSERVATIONAL": ["OBSERVATIONAL"],
-    }
-
-    SEX_MAP = {
-        "": ["ALL", "FEMALE", "MALE"],
-        "FEMALE":["ALL", "FEMALE"],
-        "MALE": ["ALL", "MALE"],
-    }
-
-    AGE_VARIANTS = [
-        "['CHILD']",
-        "['ADULT']",
-        "['OLDER_ADULT']",
-        "['CHILD, ADULT']",
-        "['ADULT, OLDER_ADULT']",
-        "['CHILD', 'ADULT', 'OLDER_ADULT']",
-    ]
-    AGE_MAP = {
-        "": AGE_VARIANTS,
-        "CHILD": [v for v in AGE_VARIANTS if "CHILD" in v],
-        "ADULT": [v for v in AGE_VARIANTS if "ADULT" in v],
-        "OLDER_ADULT": [v for v in AGE_VARIANTS if "OLDER_ADULT" in v],
+        "semantic_phrases": structured_query["semantic_phrases"]
     }
 
+def get_qdrant_filter(search_params, user_location = None):
+    """
+    Qdrant filter for the structured filters, plus a radius around
+    user_location when the query has one
+    """
+    # the filter fields are keyword lists in the payloads (and indexed), so a
+    # MatchAny matches when any of the trial's values is accepted
     qdrant_filters = []
-    for key, value in filters.items():
+    for key in FILTER_FIELDS:
+        value = (search_params.get(key) or "").strip().upper()
         # Only add filter if value is not empty
         if value:
             qdrant_filters.append(
                 models.FieldCondition(
                     key = key,
-                    match = models.models.MatchAny(any = (
-                        TYPE_MAP.get(value) if key == "type"
-                        else SEX_MAP.get(value) if key == "criteria_sex"
-                        else AGE_MAP.get(value) if key == "criteria_age"
-                        else ValueError("error")
-                        )
-                    )
+                    match = models.MatchAny(any = FILTER_VALUES.get(key, {}).get(value, [value]))
                 )
             )
-    
-    # DEBUG: Print Qdrant filters
-    print(f"Qdrant filters being applied: {qdrant_filters}")
-        
-    # Determine if we need to do geo-filtering
-    do_geo_filtering = search_params["location"] and search_params["distance_miles"] > 0
-    
-    # Get more initial results if we need to do geo-filtering
-    initial_limit = n_results * geo_buffer_factor if do_geo_filtering else n_results
-    
-    # Get semantic search results
-    results = client.search(
-        collection_name = "clinical_trials",
-        query_vector = get_embedding(semantic),
-        limit = initial_limit,
-        query_filter = models.Filter(must = qdrant_filters) if qdrant_filters else None
+
+    # Geo-filtering happens in Qdrant, on the indexed "locations" geo points:
+    # a trial matches if any of its sites is within the radius
+    if user_location:
+        qdrant_filters.append(
+            models.FieldCondition(
+                key = "locations",
+                geo_radius = models.GeoRadius(
+                    center = models.GeoPoint(lat = user_location[0], lon = user_location[1]),
+                    radius = search_params["distance_miles"] * METERS_PER_MILE
+                )
+            )
+        )
+
+    logger.debug("qdrant filters: %s", qdrant_filters)
+    return models.Filter(must = qdrant_filters) if qdrant_filters else None
+
+def format_results(results, user_location = None, sort_by_distance = False):
+    # Distance to the nearest site of each trial, to show and optionally rerank by
+    nearest_miles = [None] * len(results)
+    if user_location:
+        with metrics.timed("geo_filtering"):
+            distances = nearest_site_distances(user_location, [result.payload.get("lat_lon") or [] for result in results])
+            nearest_miles = [round(float(d), 1) if d != float("inf") else None for d in distances]
+            if sort_by_distance:
+                order = sorted(range(len(results)), key = lambda i: distances[i])
+                results = [results[i] for i in order]
+                nearest_miles = [nearest_miles[i] for i in order]
+
+    with metrics.timed("formatting"):
+        return [format_result(result, nearest_site_miles) for result, nearest_site_miles in zip(results, nearest_miles)]
+
+def format_result(result, nearest_site_miles):
+    # Format the results for the frontend
+    # Handle missing lat_lon gracefully
+    lat_lon_value = result.payload.get("lat_lon") or []
+
+    return {
+        "id": result.payload["nct_id"],
+        "rank": result.score,
+        "brief_title": result.payload["brief_title"],
+        "conditions_treated": clean_value(result.payload["conditions_treated"]),
+        "start_date": result.payload["start_date"],
+        "status": clean_value(result.payload["status"]),
+        "type": clean_value(result.payload["type"]),
+        "phase": clean_value(result.payload["phase"]),
+        "sponsor": result.payload["sponsor"],
+        "criteria_age": clean_value(result.payload["criteria_age"]),
+        "criteria_sex": clean_value(result.payload["criteria_sex"]),
+        "lat_lon": lat_lon_value,
+        "nearest_site_miles": nearest_site_miles
+    }
+
+def encode_cursor(structured_query, offset, user_location = None):
+    """
+    Opaque "load more" token: the parsed query, where the next page starts
+    and the geocoded location, so later pages skip the LLM parse and geocoding
+    """
+    cursor = {"structured_query": structured_query, "offset": offset, "user_location": user_location}
+    return base64.urlsafe_b64encode(json.dumps(cursor, separators = (",", ":")).encode("utf-8")).decode("ascii")
+
+def decode_cursor(cursor):
+    try:
+        cursor = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+        structured_query = {key: cursor["structured_query"][key] for key in RESPONSE_FORMAT.model_fields}
+        return structured_query, int(cursor["offset"]), cursor.get("user_location")
+    except (ValueError, TypeError, KeyError, AttributeError) as e:
+        raise ValueError("invalid cursor") from e
+
+def run_blocking(f, *args, **kwargs):
+    """
+    Run a blocking (network-bound) call on the shared thread pool, as an awaitable
+    """
+    return asyncio.get_running_loop().run_in_executor(_executor, functools.partial(f, *args, **kwargs))
+
+def run_stage(stage, f, *args, **kwargs):
+    """
+    run_blocking, with the time f takes recorded under stage in the metrics
+    """
+    def timed():
+        with metrics.timed(stage):
+            return f(*args, **kwargs)
+    return run_blocking(timed)
+
+def read_intent_cache(cache, keys):
+    """
+    Cached intents for keys; a broken cache counts as a miss rather than failing the search
+    """
+    try:
+        cached = cache.get_many(keys)
+    except sqlite3.Error as e:
+        metrics.FAILURES.inc(kind = "intent_cache")
+        logger.warning("intent cache read failed: %s", e)
+        cached = {}
+    metrics.INTENT_CACHE.inc(len(cached), result = "hit")
+    metrics.INTENT_CACHE.inc(len(keys) - len(cached), result = "miss")
+    return cached
+
+def pack_intent(structured_query, vector):
+    """
+    An intent cache entry: the parsed query as JSON, a newline (escaped
+    inside JSON, so it only appears here), then the vector as float32 bytes,
+    about 6 KB where the vector as JSON text took 29 KB
+    """
+    return json.dumps(structured_query).encode("utf-8") + b"\n" + pack_vector(vector)
+
+def unpack_intent(value):
+    structured_query, _, vector = value.partition(b"\n")
+    if not vector:
+        # entries written before the vectors were packed
+        intent = json.loads(value)
+        return intent["structured_query"], intent["embedding"]
+    return json.loads(structured_query), unpack_vector(vector)
+
+def write_intent_cache_later(cache, items):
+    """
+    write_intent_cache off the request path, once the search is under way
+    """
+    _executor.submit(write_intent_cache, cache, items)
+
+def write_intent_cache(cache, items):
+    try:
+        cache.set_many(items)
+    except sqlite3.Error as e:
+        metrics.FAILURES.inc(kind = "intent_cache")
+        logger.warning("intent cache write failed: %s", e)
+
+async def get_clinical_trials_async(
+    user_message,  
+    search_intent_system_prompt = SEARCH_INTENT_SYSTEM_PROMPT, 
+    n_results = 10,
+    model = "gpt-4.1-nano", 
+    temperature = 0, 
+    max_tokens = 500, 
+    response_format = RESPONSE_FORMAT,
+    sort_by_distance = False,
+    speculative_embedding = False,
+    cursor = None,
+    on_intent = None
+):
+    """
+    Search pipeline that overlaps the network-bound stages:
+    - a cached intent skips the LLM parse and the embedding altogether
+    - otherwise the LLM parse runs, alongside (with speculative_embedding) an
+      embedding of the raw query, used when the semantic phrases turn out to be
+      the query itself. Off by default: the parse strips demographics and places
+      from most queries, and an embedding already running can't be cancelled,
+      so the guess usually costs a second embedding call and a cache entry
+    - geocoding starts as soon as the parse returns the location, alongside
+      the embedding of the semantic phrases
+    - the Qdrant search starts once the vector and the location are known
+
+    A cursor from a previous response fetches the next page: its parsed query
+    and location are reused, and the embedding comes from the embedding cache
+
+    on_intent, if given, is called with {"search_params", "search_location"}
+    as soon as the query is parsed and geocoded, before the search finishes
+
+    Returns:
+    {"search_params", "search_location", "results", "next_cursor"}, next_cursor None on the last page
+    """
+    offset = 0
+    geocode_task = None
+    embedding_task = None
+    user_location = None
+    cache_key = None
+    if cursor is not None:
+        structured_query, offset, user_location = decode_cursor(cursor)
+        search_params = get_search_params(structured_query)
+        do_geo_filtering = False
+        embedding_task = run_stage("embedding", get_embedding, search_params["semantic_phrases"])
+    else:
+        cache = get_intent_cache()
+        cached = None
+        if cache is not None:
+            key = intent_cache_key(user_message, search_intent_system_prompt, model, temperature, response_format)
+            cached = (await run_blocking(read_intent_cache, cache, [key])).get(key)
+
+        if cached is not None:
+            structured_query, query_vector = unpack_intent(cached)
+            search_params = get_search_params(structured_query)
+        else:
+            parse_task = run_stage(
+                "llm_parse", parse_search_intent, user_message, search_intent_system_prompt, model, temperature, max_tokens, response_format
+            )
+            speculative_task = run_stage("embedding", get_embedding, user_message) if speculative_embedding else None
+            try:
+                structured_query = await parse_task
+            except BaseException:
+                if speculative_task:
+                    speculative_task.cancel()
+                raise
+            search_params = get_search_params(structured_query)
+
+            if speculative_task and search_params["semantic_phrases"].strip() == user_message.strip():
+                embedding_task = speculative_task
+            else:
+                if speculative_task:
+                    speculative_task.cancel()
+                embedding_task = run_stage("embedding", get_embedding, search_params["semantic_phrases"])
+            cache_key = key if cache is not None else None
+
+        do_geo_filtering = search_params["location"] and search_params["distance_miles"] > 0
+        geocode_task = run_stage("geocoding", get_coordinates_from_location, search_params["location"]) if do_geo_filtering else None
+
+    # the location usually resolves before the embedding, so the intent goes out first
+    if geocode_task:
+        user_location = await geocode_task
+    if on_intent is not None:
+        on_intent(search_intent_response(structured_query, user_location))
+    if embedding_task is not None:
+        query_vector = await embedding_task
+
+    logger.debug("query: %r, parsed search params: %s", user_message, search_params)
+    if do_geo_filtering and not user_location:
+        logger.warning("could not geocode location %r, skipping geo-filtering", search_params["location"])
+
+    # Get semantic search results, with only the payload fields the results show
+    results = await run_stage(
+        "qdrant_search", search,
+        collection_name = COLLECTION_NAME,
+        query_vector = query_vector,
+        limit = n_results,
+        offset = offset,
+        query_filter = get_qdrant_filter(search_params, user_location),
+        with_payload = RESULT_PAYLOAD_FIELDS
     )
     
-    # DEBUG: Print number of results before filtering
-    print(f"Number of results from Qdrant: {len(results)}")
-
-    # Apply geo-filtering if location and distance are specified
-    if do_geo_filtering:
-        user_location = get_coordinates_from_location(search_params["location"])
-        if user_location:
-            filtered_results = []
-            max_distance = search_params["distance_miles"]
-            
-            for result in results:
-                # Parse the lat_lon field which contains arrays of [lat, lon]
-                try:
-                    # Handle string representation of array of coordinates
-                    locations_str = result.payload["lat_lon"]
-                    locations = json.loads(locations_str.replace("'", "\""))
-                    
-                    # Check if the locations is itself an array of arrays
-                    if locations and isinstance(locations, list):
-                        if isinstance(locations[0], list):
-                            # It's already an array of [lat, lon] pairs
-                            pass
-                        elif isinstance(locations[0], (int, float)):
-                            # It's a single [lat, lon] pair
-                            locations = [locations]
-                        else:
-                            # Invalid format
-                            continue
-                    
-                    # Check if any location is within the specified distance
-                    within_distance = False
-                    for location in locations:
-                        if len(location) == 2:  # Make sure it's a valid [lat, lon] pair
-                            distance = haversine(user_location, location)
-                            if distance <= max_distance:
-                                within_distance = True
-                                break
-                    
-                    if within_distance:
-                        filtered_results.append(result)
-                except (json.JSONDecodeError, ValueError, KeyError, TypeError) as e:
-                    print(f"Error parsing locations for trial {result.payload.get('nct_id')}: {str(e)}")
-                    continue
-            
-            # Replace results with geo-filtered results
-            results = filtered_results[:n_results]
-            print(f"Found {len(results)} trials within {max_distance} miles of {search_params['location']}")
+    logger.debug("number of results from qdrant: %d", len(results))
+    record_results(n_results, [results])
+    if cache_key is not None:
+        write_intent_cache_later(cache, [(cache_key, pack_intent(structured_query, query_vector))])
+
+    return search_response(results, structured_query, user_location, offset, n_results, sort_by_distance)
+
+def record_results(n_results, results_per_search):
+    for results in results_per_search:
+        metrics.RESULTS.observe(len(results))
+        metrics.RESULTS_REQUESTED.inc(n_results)
+        metrics.RESULTS_RETURNED.inc(len(results))
+
+def search_intent_response(structured_query, user_location):
+    """
+    The parsed query, and where the radius filter was centered (None if the
+    query has no location or it couldn't be geocoded), so clients can draw
+    the search area without geocoding it again
+    """
+    search_params = get_search_params(structured_query)
+    search_location = None
+    if user_location and search_params["distance_miles"] > 0:
+        search_location = {"lat": user_location[0], "lon": user_location[1], "radius_miles": search_params["distance_miles"]}
+    return {"search_params": search_params, "search_location": search_location}
+
+def search_response(results, structured_query, user_location, offset, n_results, sort_by_distance = False):
+    return {
+        **search_intent_response(structured_query, user_location),
+        "results": format_results(results, user_location, sort_by_distance),
+        "next_cursor": encode_cursor(structured_query, offset + n_results, user_location) if len(results) == n_results else None
+    }
+
+def get_clinical_trials(user_message = "", timeout = SEARCH_TIMEOUT_SECONDS, **kwargs):
+    """
+    Blocking entry point to get_clinical_trials_async, with a deadline for
+    the whole search (raises TimeoutError when it runs out)
+    """
+    return run_search("search", get_clinical_trials_async(user_message, **kwargs), timeout)
+
+def stream_clinical_trials(user_message = "", timeout = SEARCH_TIMEOUT_SECONDS, **kwargs):
+    """
+    get_clinical_trials as events, for rendering progressively: {"event": "intent",
+    "search_params", "search_location"} once the query is parsed and geocoded,
+    then {"event": "results", "results", "next_cursor"}. Errors (e.g. TimeoutError)
+    are raised from the generator
+    """
+    events = queue.Queue()
+
+    def run():
+        try:
+            response = run_search(
+                "search",
+                get_clinical_trials_async(user_message, on_intent = lambda intent: events.put({"event": "intent", **intent}), **kwargs),
+                timeout
+            )
+            events.put({"event": "results", "results": response["results"], "next_cursor": response["next_cursor"]})
+        except Exception as e:
+            events.put(e)
+        finally:
+            events.put(None)
+
+    # its own thread, not the search pool, which the pipeline's stages need
+    threading.Thread(target = run, daemon = True).start()
+    while (event := events.get()) is not None:
+        if isinstance(event, Exception):
+            raise event
+        yield event
+
+def run_search(endpoint, search_coroutine, timeout):
+    """
+    Run a search to completion, recording its total time and outcome in the metrics
+    """
+    outcome = "error"
+    try:
+        with metrics.timed(f"{endpoint}_total"):
+            response = asyncio.run(asyncio.wait_for(search_coroutine, timeout))
+        outcome = "ok"
+        return response
+    except asyncio.TimeoutError as e:
+        # before python 3.11 asyncio has its own TimeoutError; callers catch the built-in one
+        outcome = "timeout"
+        raise TimeoutError(f"search took longer than {timeout}s") from e
+    finally:
+        metrics.SEARCHES.inc(endpoint = endpoint, outcome = outcome)
+
+async def get_clinical_trials_batch_async(
+    user_messages,
+    search_intent_system_prompt = SEARCH_INTENT_SYSTEM_PROMPT,
+    n_results = 10,
+    model = "gpt-4.1-nano",
+    temperature = 0,
+    max_tokens = 500,
+    response_format = RESPONSE_FORMAT,
+    sort_by_distance = False,
+    concurrency = SEARCH_BATCH_CONCURRENCY
+):
+    """
+    Many searches at once, sharing the work between them:
+    - repeated queries are searched once, and cached intents skip the LLM
+    - the other queries are parsed by the LLM, up to concurrency at a time
+    - all semantic phrases are embedded in one batched call
+    - each distinct location is geocoded once (a query whose location can't
+      be looked up just now gets an error, like a failed parse)
+    - all searches go to Qdrant in a single batched query
+
+    Returns:
+    one response per query, in order, like get_clinical_trials_async's;
+    a query whose parse or geocoding failed gets {"error": message} instead
+    """
+    queries = list(dict.fromkeys(user_messages))
+    structured_queries = {}
+
+    cache = get_intent_cache()
+    keys = {query: intent_cache_key(query, search_intent_system_prompt, model, temperature, response_format) for query in queries}
+    cached = await run_blocking(read_intent_cache, cache, list(keys.values())) if cache is not None else {}
+    vectors = {}
+    for query in queries:
+        if keys[query] in cached:
+            structured_queries[query], vectors[query] = unpack_intent(cached[keys[query]])
+
+    semaphore = asyncio.Semaphore(concurrency)
+    async def parse(query):
+        async with semaphore:
+            return await run_stage(
+                "llm_parse", parse_search_intent, query, search_intent_system_prompt, model, temperature, max_tokens, response_format
+            )
+
+    to_parse = [query for query in queries if query not in structured_queries]
+    errors = {}
+    for query, parsed in zip(to_parse, await asyncio.gather(*[parse(query) for query in to_parse], return_exceptions = True)):
+        if isinstance(parsed, Exception):
+            metrics.FAILURES.inc(kind = "llm_parse")
+            logger.warning("could not parse %r: %s", query, parsed)
+            errors[query] = str(parsed)
         else:
-            print(f"Warning: Could not geocode location '{search_params['location']}', skipping geo-filtering")
-            results = results[:n_results]
-    else:
-        # If no geo-filtering, just take the top n results
-        results = results[:n_results]
+            structured_queries[query] = parsed
 
-    # Format the results for the frontend
-    results_formatted = []
-    for result in results:
-        # Handle missing lat_lon gracefully
-        lat_lon_value = result.payload.get("lat_lon", "[]")
-        
-        results_formatted.append({
-            "id": result.payload["nct_id"],
-            "rank": result.score,
-            "brief_title": result.payload["brief_title"],
-            "conditions_treated": clean_value(result.payload["conditions_treated"]),
-            "start_date": result.payload["start_date"],
-            "status": result.payload["status"],
-            "type": result.payload["type"],
-            "phase": clean_value(result.payload["phase"]),
-            "sponsor": result.payload["sponsor"],
-            "criteria_age": clean_value(result.payload["criteria_age"]),
-            "criteria_sex": result.payload["criteria_sex"],
-            "lat_lon": str(lat_lon_value),
-            "search_params": search_params
-        })
-
-    return results_formatted
\ No newline at end of file
+    # embeddings for the new intents in one call, alongside the geocoding of every distinct location
+    to_embed = [query for query in structured_queries if query not in vectors]
+    embed_task = run_stage("embedding", get_embeddings, [structured_queries[query]["semantic_phrases"] for query in to_embed], quiet = True) if to_embed else None
+    search_params = {query: get_search_params(structured_query) for query, structured_query in structured_queries.items()}
+    locations = list({params["location"] for params in search_params.values() if params["location"] and params["distance_miles"] > 0})
+    geocoded = await asyncio.gather(*[run_stage("geocoding", get_coordinates_from_location, location) for location in locations], return_exceptions = True)
+    coordinates = {}
+    for location, result in zip(locations, geocoded):
+        if isinstance(result, GeocodingUnavailable):
+            # the queries near this location fail, rather than search without their radius
+            errors.update({
+                query: str(result) for query, params in search_params.items()
+                if params["location"] == location and params["distance_miles"] > 0
+            })
+        elif isinstance(result, BaseException):
+            raise result
+        else:
+            coordinates[location] = result
+    if embed_task:
+        vectors.update(zip(to_embed, await embed_task))
+
+    searched = [query for query in structured_queries if query not in errors]
+    user_locations = {
+        query: coordinates.get(params["location"]) if params["distance_miles"] > 0 else None
+        for query, params in search_params.items()
+    }
+    batch_results = await run_stage(
+        "qdrant_search", search_batch,
+        collection_name = COLLECTION_NAME,
+        requests = [
+            models.QueryRequest(
+                query = vectors[query],
+                filter = get_qdrant_filter(search_params[query], user_locations[query]),
+                limit = n_results,
+                with_payload = RESULT_PAYLOAD_FIELDS
+            )
+            for query in searched
+        ]
+    ) if searched else []
+    record_results(n_results, batch_results)
+    if cache is not None and to_embed:
+        write_intent_cache_later(cache, [(keys[query], pack_intent(structured_queries[query], vectors[query])) for query in to_embed])
+
+    responses = {
+        query: search_response(results, structured_queries[query], user_locations[query], 0, n_results, sort_by_distance)
+        for query, results in zip(searched, batch_results)
+    }
+    responses.update({query: {"error": error} for query, error in errors.items()})
+    return [responses[query] for query in user_messages]
+
+def get_clinical_trials_batch(user_messages, timeout = SEARCH_BATCH_TIMEOUT_SECONDS, **kwargs):
+    """
+    Blocking entry point to get_clinical_trials_batch_async, with a deadline for the whole batch
+    """
+    return run_search("search_batch", get_clinical_trials_batch_async(user_messages, **kwargs), timeout)
+
+def collect_stats():
+    """
+    Hit counts of the caches and geocoding sources, for the metrics endpoint
+    """
+    caches = {"intent": get_intent_cache(), "embedding": get_embedding_cache()}
+    caches = {name: cache.stats() for name, cache in caches.items() if cache is not None}
+    geocoding = geocoding_stats()
+    return [
+        ("cache_hits_total", "cache lookups that hit", "counter", {(("cache", name),): stats["hits"] for name, stats in caches.items()}),
+        ("cache_misses_total", "cache lookups that missed", "counter", {(("cache", name),): stats["misses"] for name, stats in caches.items()}),
+        ("cache_entries", "entries in each cache", "gauge", {(("cache", name),): stats["entries"] for name, stats in caches.items()}),
+        ("geocode_lookups_total", "geocoding lookups, by where the answer came from", "counter", {
+            (("source", source),): geocoding[key]
+            for source, key in [("gazetteer", "gazetteer_hits"), ("cache", "cache_hits"), ("nominatim", "remote_calls"), ("throttled", "remote_throttled")]
+        }),
+        ("geocode_failures_total", "geocoding lookups that failed, by kind", "counter", {
+            (("kind", kind),): geocoding[kind] for kind in ["remote_failures", "not_found"]
+        }),
+    ]
+
+metrics.register_collector(collect_stats)
@@ -13,6 +13,11 @@ document.addEventListener('DOMContentLoaded', function() {
     let searchLocationMarker = null;
     let searchRadiusCircle = null;
     
+    // Pagination state: the next_cursor of the last page loaded
+    let currentQuery = '';
+    let nextCursor = null;
+    let resultCount = 0;
+    
     // Pool of search suggestions
     const suggestionPool = [
         {
@@ -319,25 +324,6 @@ document.addEventListener('DOMContentLoaded', function() {
         return 4;
     }
 
-    // Function to geocode location using Nominatim
-    function geocodeLocation(locationQuery) {
-        const url = `https://nominatim.openstreetmap.org/search?q=${encodeURIComponent(locationQuery)}&format=json&limit=1`;
-        const headers = {"User-Agent": "ClinicalTrialsSearchApp/1.0"};
-        
-        return fetch(url, { headers })
-            .then(response => response.json())
-            .then(results => {
-                if (results && results.length > 0) {
-                    return [parseFloat(results[0].lat), parseFloat(results[0].lon)];
-                }
-                return null;
-            })
-            .catch(error => {
-                console.error('Geocoding error:', error);
-                return null;
-            });
-    }
-
     // Handle recent searches
     function saveRecentSearch(query) {
         let recentSearches = JSON.parse(localStorage.getItem('recentSearches') || '[]');
@@ -363,72 +349,199 @@ document.addEventListener('DOMContentLoaded', function() {
         // Show loading indicator
         resultsList.innerHTML = '<div class="loading">Searching...</div>';
         resultsContainer.classList.remove('hidden');
+        currentQuery = query;
+        resultCount = 0;
+        nextCursor = null;
         
-        // Make API request to backend
-        fetch('/search', {
+        // Stream the search: the parsed query and search area arrive first, then the results
+        let intent = {};
+        streamSearch({ query: query, stream: true }, {
+            intent: data => {
+                intent = data;
+                // Initialize map before drawing anything
+                initMap();
+                clearMap();
+                showSearchArea(data);
+            },
+            results: data => {
+                displayResults({ ...intent, ...data });
+                
+                // Update recent searches display
+                displayRecentSearches();
+            }
+        })
+        .catch(error => {
+            // e.g. the location lookup is busy: searching again shortly will work
+            if (error.retryable) {
+                resultsList.innerHTML = '<div class="no-results"></div>';
+                resultsList.firstChild.textContent = error.message;
+                return;
+            }
+            resultsList.innerHTML = `<div class="no-results">None found: please ask about another clinical trial</div>`;
+        });
+    }
+
+    function clearMap() {
+        // Clear existing markers and overlays
+        if (markerLayerGroup) {
+            markerLayerGroup.clearLayers();
+            markers = [];
+        }
+        if (searchLocationMarker) {
+            map.removeLayer(searchLocationMarker);
+            searchLocationMarker = null;
+        }
+        if (searchRadiusCircle) {
+            map.removeLayer(searchRadiusCircle);
+            searchRadiusCircle = null;
+        }
+    }
+
+    // POST a streaming search and call handlers[event.event] for each NDJSON line as it arrives
+    async function streamSearch(body, handlers) {
+        const response = await fetch('/search', {
             method: 'POST',
             headers: {
                 'Content-Type': 'application/json',
             },
-            body: JSON.stringify({ query: query }),
+            body: JSON.stringify(body),
+        });
+        if (!response.ok) {
+            throw new Error('Search request failed');
+        }
+        
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = '';
+        while (true) {
+            const { done, value } = await reader.read();
+            buffer += decoder.decode(value || new Uint8Array(), { stream: !done });
+            const lines = buffer.split('\n');
+            buffer = lines.pop();
+            for (const line of lines) {
+                if (!line.trim()) continue;
+                const event = JSON.parse(line);
+                if (event.event === 'error') {
+                    const error = new Error(event.error);
+                    error.retryable = Boolean(event.retryable);
+                    throw error;
+                }
+                if (handlers[event.event]) {
+                    handlers[event.event](event);
+                }
+            }
+            if (done) break;
+        }
+    }
+
+    function fetchSearch(body) {
+        return fetch('/search', {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json',
+            },
+            body: JSON.stringify(body),
         })
         .then(response => {
             if (!response.ok) {
                 throw new Error('Search request failed');
             }
             return response.json();
-        })
+        });
+    }
+
+    // Fetch the next page with the cursor, which skips re-parsing the query on the server
+    function loadMore() {
+        const button = document.getElementById('load-more');
+        if (!nextCursor) return;
+        button.disabled = true;
+        button.textContent = 'Loading...';
+        
+        fetchSearch({ query: currentQuery, cursor: nextCursor })
         .then(data => {
-            // Initialize map before displaying results
-            initMap();
-            
-            // Clear existing markers and overlays
-            if (markerLayerGroup) {
-                markerLayerGroup.clearLayers();
-                markers = [];
-            }
-            if (searchLocationMarker) {
-                map.removeLayer(searchLocationMarker);
-                searchLocationMarker = null;
-            }
-            if (searchRadiusCircle) {
-                map.removeLayer(searchRadiusCircle);
-                searchRadiusCircle = null;
-            }
-            
-            displayResults(data);
-            
-            // Update recent searches display
-            displayRecentSearches();
+            appendResults(data.results, resultCount);
+            updateSummary(data.search_params);
+            updateLoadMore(data.next_cursor);
         })
         .catch(error => {
-            resultsList.innerHTML = `<div class="no-results">None found: please ask about another clinical trial</div>`;
+            console.error('Load more error:', error);
+            button.disabled = false;
+            button.textContent = 'Load more';
         });
     }
 
-    function parseLatLon(latLonStr) {
-        if (!latLonStr || latLonStr === "[]") return [];
+    function updateLoadMore(cursor) {
+        nextCursor = cursor;
+        let button = document.getElementById('load-more');
+        if (!button) {
+            button = document.createElement('button');
+            button.id = 'load-more';
+            button.className = 'load-more';
+            button.addEventListener('click', loadMore);
+        }
+        // Keep the button after the last result
+        resultsList.appendChild(button);
+        button.disabled = false;
+        button.textContent = 'Load more';
+        button.classList.toggle('hidden', !cursor);
+    }
+
+    function parseLatLon(latLon) {
+        // lat_lon comes back from the server as an array of [lat, lon] pairs
+        if (!Array.isArray(latLon) || latLon.length === 0) return [];
+        
+        // If it's a single [lat, lon] pair
+        if (latLon.length === 2 && !Array.isArray(latLon[0])) {
+            return [latLon];
+        }
+        
+        return latLon;
+    }
+
+    // Center the map on the search location and draw the radius, from the
+    // coordinates the server geocoded (search_location is null without a location)
+    function showSearchArea(data) {
+        const searchParams = data.search_params;
+        const searchLocation = data.search_location;
         
-        try {
-            // Safely parse the string representation of arrays
-            // Handle both single arrays and arrays of arrays
-            const parsed = JSON.parse(latLonStr.replace(/'/g, '"'));
+        if (searchLocation) {
+            const searchCoords = [searchLocation.lat, searchLocation.lon];
             
-            // If it's a single [lat, lon] pair
-            if (Array.isArray(parsed) && parsed.length === 2 && !Array.isArray(parsed[0])) {
-                return [parsed];
-            }
+            // Center map on search location with appropriate zoom
+            const zoomLevel = getZoomLevelFromRadius(searchLocation.radius_miles);
+            map.setView(searchCoords, zoomLevel);
+            
+            // Add a marker for the search location
+            searchLocationMarker = L.marker(searchCoords, {
+                icon: L.icon({
+                    iconUrl: 'data:image/svg+xml;base64,PHN2ZyB4bWxucz0iaHR0cDovL3d3dy53My5vcmcvMjAwMC9zdmciIHdpZHRoPSIyNCIgaGVpZ2h0PSIyNCIgdmlld0JveD0iMCAwIDI0IDI0IiBmaWxsPSJub25lIiBzdHJva2U9ImN1cnJlbnRDb2xvciIgc3Ryb2tlLXdpZHRoPSIyIiBzdHJva2UtbGluZWNhcD0icm91bmQiIHN0cm9rZS1saW5lam9pbj0icm91bmQiPjxwYXRoIGQ9Ik0yMSAxMGMwIDctOSAxMy05IDEzcy05LTYtOS0xM2E5IDkgMCAwIDEgMTggMHoiLz48Y2lyY2xlIGN4PSIxMiIgY3k9IjEwIiByPSIzIi8+PC9zdmc+',
+                    iconSize: [30, 30],
+                    iconAnchor: [15, 30],
+                    popupAnchor: [0, -30]
+                })
+            }).addTo(map);
+            
+            searchLocationMarker.bindPopup(`<strong>Search Location:</strong><br>${searchParams.location}`);
             
-            // If it's an array of [lat, lon] pairs
-            return parsed;
-        } catch (e) {
-            console.error('Error parsing lat_lon:', e);
-            return [];
+            // Add a circle to show the search radius
+            searchRadiusCircle = L.circle(searchCoords, {
+                radius: searchLocation.radius_miles * 1609.34, // Convert miles to meters
+                color: '#2962ff',
+                fillColor: '#2962ff',
+                fillOpacity: 0.1,
+                weight: 2
+            }).addTo(map);
         }
+        
+        // Show what is being searched for while the results load
+        updateSummary(searchParams);
     }
 
-    async function displayResults(results) {
+    function displayResults(data) {
+        const results = data.results;
         resultsList.innerHTML = '';
+        resultCount = 0;
+        nextCursor = null;
         
         if (results.length === 0) {
             resultsList.innerHTML = '<div class="no-results">None found: please ask about another clinical trial</div>';
@@ -439,95 +552,55 @@ document.addEventListener('DOMContentLoaded', function() {
         // Sort by rank (descending)
         results.sort((a, b) => b.rank - a.rank);
         
-        // Get search parameters from the first result
-        const searchParams = results.length > 0 ? results[0].search_params : null;
+        // Search parameters come once per response
+        const searchParams = data.search_params;
         
-        // Handle map centering based on search location
-        if (searchParams && searchParams.location && searchParams.distance_miles > 0) {
-            // Geocode the search location
-            const searchCoords = await geocodeLocation(searchParams.location);
-            
-            if (searchCoords) {
-                // Center map on search location with appropriate zoom
-                const zoomLevel = getZoomLevelFromRadius(searchParams.distance_miles);
-                map.setView(searchCoords, zoomLevel);
-                
-                // Add a marker for the search location
-                searchLocationMarker = L.marker(searchCoords, {
-                    icon: L.icon({
-                        iconUrl: 'data:image/svg+xml;base64,PHN2ZyB4bWxucz0iaHR0cDovL3d3dy53My5vcmcvMjAwMC9zdmciIHdpZHRoPSIyNCIgaGVpZ2h0PSIyNCIgdmlld0JveD0iMCAwIDI0IDI0IiBmaWxsPSJub25lIiBzdHJva2U9ImN1cnJlbnRDb2xvciIgc3Ryb2tlLXdpZHRoPSIyIiBzdHJva2UtbGluZWNhcD0icm91bmQiIHN0cm9rZS1saW5lam9pbj0icm91bmQiPjxwYXRoIGQ9Ik0yMSAxMGMwIDctOSAxMy05IDEzcy05LTYtOS0xM2E5IDkgMCAwIDEgMTggMHoiLz48Y2lyY2xlIGN4PSIxMiIgY3k9IjEwIiByPSIzIi8+PC9zdmc+',
-                        iconSize: [30, 30],
-                        iconAnchor: [15, 30],
-                        popupAnchor: [0, -30]
-                    })
-                }).addTo(map);
-                
-                searchLocationMarker.bindPopup(`<strong>Search Location:</strong><br>${searchParams.location}`);
-                
-                // Add a circle to show the search radius
-                searchRadiusCircle = L.circle(searchCoords, {
-                    radius: searchParams.distance_miles * 1609.34, // Convert miles to meters
-                    color: '#2962ff',
-                    fillColor: '#2962ff',
-                    fillOpacity: 0.1,
-                    weight: 2
-                }).addTo(map);
-            }
-        }
+        // Add trial markers
+        appendResults(results, 0);
+        updateSummary(searchParams);
         
-        // Show search summary banner
-        if (searchParams) {
-            // Build a human-readable summary
-            let summary = `Showing the top ${results.length} matching `;
-            
-            // Trial type
-            if (searchParams.type) {
-                summary += searchParams.type.toLowerCase() + " ";
-            }
-            
-            // Disease/condition - UPDATED to include the original query
-            if (searchParams.semantic_phrases) {
-                summary += `trials on ${searchParams.semantic_phrases}`;
-            } else {
-                summary += "trials";
-            }
-            
-            // Patient criteria - UPDATED to properly show in summary
-            let patientCriteria = [];
-            if (searchParams.criteria_sex === 'FEMALE') {
-                patientCriteria.push("for women");
-            } else if (searchParams.criteria_sex === 'MALE') {
-                patientCriteria.push("for men");
-            }
-            
-            if (searchParams.criteria_age === 'CHILD') {
-                patientCriteria.push("for children");
-            } else if (searchParams.criteria_age === 'ADULT') {
-                patientCriteria.push("for adults");
-            } else if (searchParams.criteria_age === 'OLDER_ADULT') {
-                patientCriteria.push("for older adults");
-            }
+        // Add event listener for popup links (using event delegation)
+        map.on('popupopen', function(e) {
+            const popup = e.popup;
+            const container = popup.getContent();
             
-            // Add patient criteria to summary
-            if (patientCriteria.length > 0) {
-                summary += " " + patientCriteria.join(" ");
+            if (container instanceof HTMLElement) {
+                const link = container.querySelector('.popup-link');
+                if (link) {
+                    link.addEventListener('click', function(e) {
+                        e.preventDefault();
+                        const trialId = this.getAttribute('data-trial-id');
+                        scrollToResult(trialId);
+                    });
+                }
             }
+        });
+        
+        // If there is no search area, fit bounds to all markers
+        if (!data.search_location) {
+            const allLocations = [];
+            markers.forEach(marker => {
+                allLocations.push(marker.getLatLng());
+            });
             
-            // Location and distance
-            if (searchParams.location) {
-                summary += ` that are within ${searchParams.distance_miles} miles of ${searchParams.location}`;
+            if (allLocations.length > 0) {
+                try {
+                    const bounds = L.latLngBounds(allLocations);
+                    map.fitBounds(bounds, { padding: [50, 50] });
+                } catch (e) {
+                    console.error('Error setting bounds:', e);
+                    // Fallback to US view
+                    map.setView([39.8283, -98.5795], 4);
+                }
             }
-            
-            // Display the summary
-            const summaryBanner = document.getElementById('search-summary-banner');
-            document.getElementById('search-summary-text').textContent = summary;
-            summaryBanner.classList.remove('hidden');
-        } else {
-            document.getElementById('search-summary-banner').classList.add('hidden');
         }
         
-        // Add trial markers
-        results.forEach((trial, index) => {
+        updateLoadMore(data.next_cursor);
+    }
+
+    function appendResults(results, startIndex) {
+        results.forEach((trial, i) => {
+            const index = startIndex + i;
             const resultItem = document.createElement('div');
             resultItem.className = 'result-item';
             resultItem.dataset.trialId = trial.id;
@@ -547,6 +620,7 @@ document.addEventListener('DOMContentLoaded', function() {
                     <div class="result-field"><span class="field-label">Sex Eligibility:</span> ${trial.criteria_sex}</div>
                     <div class="result-field"><span class="field-label">Start Date:</span> ${trial.start_date}</div>
                     <div class="result-field"><span class="field-label">Sponsor:</span> ${trial.sponsor}</div>
+                    ${trial.nearest_site_miles != null ? `<div class="result-field"><span class="field-label">Nearest Site:</span> ${trial.nearest_site_miles} miles</div>` : ''}
                 </div>
             `;
             
@@ -597,40 +671,59 @@ document.addEventListener('DOMContentLoaded', function() {
             });
         });
         
-        // Add event listener for popup links (using event delegation)
-        map.on('popupopen', function(e) {
-            const popup = e.popup;
-            const container = popup.getContent();
+        resultCount += results.length;
+    }
+
+    function updateSummary(searchParams) {
+        // Show search summary banner
+        if (searchParams) {
+            // Build a human-readable summary ("Searching for" until the results are in)
+            let summary = resultCount ? `Showing the top ${resultCount} matching ` : 'Searching for ';
             
-            if (container instanceof HTMLElement) {
-                const link = container.querySelector('.popup-link');
-                if (link) {
-                    link.addEventListener('click', function(e) {
-                        e.preventDefault();
-                        const trialId = this.getAttribute('data-trial-id');
-                        scrollToResult(trialId);
-                    });
-                }
+            // Trial type
+            if (searchParams.type) {
+                summary += searchParams.type.toLowerCase() + " ";
             }
-        });
-        
-        // If no search location was specified, fit bounds to all markers
-        if (!searchParams || !searchParams.location || searchParams.distance_miles === 0) {
-            const allLocations = [];
-            markers.forEach(marker => {
-                allLocations.push(marker.getLatLng());
-            });
             
-            if (allLocations.length > 0) {
-                try {
-                    const bounds = L.latLngBounds(allLocations);
-                    map.fitBounds(bounds, { padding: [50, 50] });
-                } catch (e) {
-                    console.error('Error setting bounds:', e);
-                    // Fallback to US view
-                    map.setView([39.8283, -98.5795], 4);
-                }
+            // Disease/condition - UPDATED to include the original query
+            if (searchParams.semantic_phrases) {
+                summary += `trials on ${searchParams.semantic_phrases}`;
+            } else {
+                summary += "trials";
             }
+            
+            // Patient criteria - UPDATED to properly show in summary
+            let patientCriteria = [];
+            if (searchParams.criteria_sex === 'FEMALE') {
+                patientCriteria.push("for women");
+            } else if (searchParams.criteria_sex === 'MALE') {
+                patientCriteria.push("for men");
+            }
+            
+            if (searchParams.criteria_age === 'CHILD') {
+                patientCriteria.push("for children");
+            } else if (searchParams.criteria_age === 'ADULT') {
+                patientCriteria.push("for adults");
+            } else if (searchParams.criteria_age === 'OLDER_ADULT') {
+                patientCriteria.push("for older adults");
+            }
+            
+            // Add patient criteria to summary
+            if (patientCriteria.length > 0) {
+                summary += " " + patientCriteria.join(" ");
+            }
+            
+            // Location and distance
+            if (searchParams.location) {
+                summary += ` that are within ${searchParams.distance_miles} miles of ${searchParams.location}`;
+            }
+            
+            // Display the summary
+            const summaryBanner = document.getElementById('search-summary-banner');
+            document.getElementById('search-summary-text').textContent = summary;
+            summaryBanner.classList.remove('hidden');
+        } else {
+            document.getElementById('search-summary-banner').classList.add('hidden');
         }
     }
     
@@ -0,0 +1,87 @@
+import os
+import json
+import argparse
+from qdrant_client import QdrantClient
+from dotenv import load_dotenv, find_dotenv
+from get_clinical_trials import get_clinical_trials, studies_to_df
+from put_clinical_trials_into_qdrant_db import add_embeddings, create_collection, upsert_trials, delete_trials
+
+_ = load_dotenv(find_dotenv())
+QDRANT_API_KEY = os.getenv("QDRANT_API_KEY")
+
+WATERMARK_PATH = "sync_watermark.json"
+RECRUITING_STATUSES = ["RECRUITING", "NOT_YET_RECRUITING"]
+
+def read_watermark(path = WATERMARK_PATH):
+    """
+    Returns:
+    last_update_date (YYYY-MM-DD) already synced, or None if never synced
+    """
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)["last_update_date"]
+
+def write_watermark(last_update_date, path = WATERMARK_PATH):
+    with open(path, "w") as f:
+        json.dump({"last_update_date": last_update_date}, f)
+    print(f"watermark set to {last_update_date}")
+
+def get_changes(since, until = "MAX", location = "United States"):
+    """
+    Get studies updated from since to until (inclusive, by LastUpdatePostDate),
+    whatever their status
+
+    Returns:
+    (DataFrame of recruiting studies to upsert, list of nct_ids to delete, latest last_update_date seen)
+    """
+    studies = get_clinical_trials(
+        location = location,
+        status = None,
+        min_date = since,
+        max_date = until,
+        date_field = "LastUpdatePostDate"
+        )
+    if not studies:
+        return None, [], None
+
+    df = studies_to_df(studies)
+
+    is_recruiting = df["status"].isin(RECRUITING_STATUSES)
+    upserts = df[is_recruiting].reset_index(drop = True)
+    deletes = df.loc[~is_recruiting, "nct_id"].tolist()
+    return upserts, deletes, df["last_update_date"].max()
+
+def sync(client, since = None, watermark_path = WATERMARK_PATH):
+    """
+    Apply the studies changed since the watermark to the collection in place:
+    upsert the ones still recruiting, delete the ones that stopped
+    """
+    since = since or read_watermark(watermark_path)
+    if since is None:
+        raise ValueError(f"no watermark in {watermark_path}: run a full refresh first, or pass since")
+
+    # the range is inclusive, so studies updated on the watermark date are fetched again, which is harmless
+    upserts, deletes, latest = get_changes(since)
+    print(f"sync since {since}: {0 if upserts is None else len(upserts)} upserts, {len(deletes)} deletes")
+
+    create_collection(client)
+    if upserts is not None and len(upserts):
+        upsert_trials(client, add_embeddings(upserts))
+    delete_trials(client, deletes)
+
+    if latest:
+        write_watermark(max(latest, since), watermark_path)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "incrementally sync recruiting studies into qdrant")
+    parser.add_argument("--since", help = "YYYY-MM-DD, overrides the watermark")
+    args = parser.parse_args()
+
+    client = QdrantClient("localhost", port = 6333)
+    # client = QdrantClient(
+    #     url = "https://09ded390-e5ee-4905-80a4-0de54ed1ddd3.us-east4-0.gcp.cloud.qdrant.io:6333",
+    #     api_key = QDRANT_API_KEY
+    # )
+    sync(client, since = args.since)
+    print(f"end: collection size of {client.get_collection('clinical_trials').points_count}")
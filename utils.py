@@ -1,17 +1,365 @@
 import os
+import time
+import random
+import logging
+import functools
 import tiktoken
 import openai
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from dotenv import load_dotenv, find_dotenv
+from cache import DiskCache, hash_key, pack_vector, unpack_vector
 
 _ = load_dotenv(find_dotenv())
-openai.api_key = os.getenv('OPENAI_API_KEY')
+logger = logging.getLogger(__name__)
+
+# per-request timeout of OpenAI calls, in seconds
+OPENAI_TIMEOUT_SECONDS = float(os.getenv("OPENAI_TIMEOUT_SECONDS", 60))
+_openai_client = None
+
+# per-input limit of the embedding models, and openai's per-request caps
+EMBEDDING_MAX_TOKENS = 8191
+EMBEDDING_MAX_BATCH_INPUTS = 2048
+EMBEDDING_MAX_BATCH_TOKENS = 300000
+# longer trials are split into chunks the embedding model reads whole (its
+# max_tokens), one vector each, overlapping so a phrase cut at a boundary is
+# whole in one of them; EMBEDDING_CHUNK_TOKENS makes the chunks smaller still
+EMBEDDING_CHUNK_TOKENS = int(os.getenv("EMBEDDING_CHUNK_TOKENS", 0))
+EMBEDDING_CHUNK_OVERLAP_TOKENS = int(os.getenv("EMBEDDING_CHUNK_OVERLAP_TOKENS", 200))
+# USD per million input tokens, for the cost estimates printed while embedding
+EMBEDDING_PRICES = {"text-embedding-3-small": 0.02, "text-embedding-3-large": 0.13, "text-embedding-ada-002": 0.10}
+
+# "openai" or "local"; the collection must be built with the backend used for queries
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "openai")
+OPENAI_EMBEDDING_MODEL = os.getenv("OPENAI_EMBEDDING_MODEL", "text-embedding-3-small")
+# vector size of each openai model, which sizes the collection; other models are asked once
+OPENAI_EMBEDDING_DIMENSIONS = {"text-embedding-3-small": 1536, "text-embedding-3-large": 3072, "text-embedding-ada-002": 1536}
+LOCAL_EMBEDDING_MODEL = os.getenv("LOCAL_EMBEDDING_MODEL", "BAAI/bge-small-en-v1.5")
+# "torch" or "onnx" (onnx needs `pip install optimum[onnxruntime]`)
+LOCAL_EMBEDDING_RUNTIME = os.getenv("LOCAL_EMBEDDING_RUNTIME", "torch")
+# texts are counted in tiktoken tokens, and a wordpiece model splits the same
+# text into more tokens, so chunks are counted short to leave a margin
+TIKTOKEN_TOKENS_PER_MODEL_TOKEN = 0.75
+
+# set EMBEDDING_CACHE_PATH to "" to turn the cache off
+EMBEDDING_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH", "embedding_cache.sqlite3")
+EMBEDDING_CACHE_MAX_ENTRIES = int(os.getenv("EMBEDDING_CACHE_MAX_ENTRIES", 100000))
+_embedding_cache = None
+_embedding_backends = {}
+
+def get_embedding_cache():
+    global _embedding_cache
+    if _embedding_cache is None and EMBEDDING_CACHE_PATH:
+        _embedding_cache = DiskCache(EMBEDDING_CACHE_PATH, max_entries = EMBEDDING_CACHE_MAX_ENTRIES)
+    return _embedding_cache
+
+def get_openai_client():
+    """
+    The OpenAI client, created on first use (from OPENAI_API_KEY and
+    OPENAI_BASE_URL) and shared, so calls reuse its pooled connections
+    """
+    global _openai_client
+    if _openai_client is None:
+        _openai_client = openai.OpenAI(timeout = OPENAI_TIMEOUT_SECONDS)
+    return _openai_client
+
+@functools.lru_cache(maxsize = None)
+def get_encoder(model = "cl100k_base"):
+    return tiktoken.get_encoding(model)
 
 def get_token(text, model = "cl100k_base"):
-    return tiktoken.get_encoding(model).encode(text)
+    return get_encoder(model).encode(text)
+
+def tokenize(texts, max_workers = 4, model = "cl100k_base"):
+    """
+    Tokens of many texts in one pass; tiktoken encodes a batch on
+    max_workers threads, outside the GIL
+    """
+    return get_encoder(model).encode_batch(list(texts), num_threads = max_workers, disallowed_special = ())
+
+def chunk_tokens(tokens, max_tokens = EMBEDDING_MAX_TOKENS, overlap = EMBEDDING_CHUNK_OVERLAP_TOKENS):
+    """
+    Split tokens into windows of at most max_tokens, each starting overlap
+    tokens before the end of the previous one; short inputs stay whole
+    """
+    if len(tokens) <= max_tokens:
+        return [tokens]
+    step = max_tokens - overlap
+    return [tokens[start:start + max_tokens] for start in range(0, len(tokens) - overlap, step)]
+
+def batch_by_tokens(token_counts, max_inputs = EMBEDDING_MAX_BATCH_INPUTS, max_tokens = EMBEDDING_MAX_BATCH_TOKENS):
+    """
+    Group inputs into batches that fit in a single embeddings request
+
+    Parameters:
+    token_counts: number of tokens of each input, in order
+    max_inputs, max_tokens: caps per request
+
+    Returns:
+    list of batches, each a list of indices into token_counts
+    """
+    batches = []
+    batch, batch_tokens = [], 0
+    for i, n_tokens in enumerate(token_counts):
+        if batch and (len(batch) >= max_inputs or batch_tokens + n_tokens > max_tokens):
+            batches.append(batch)
+            batch, batch_tokens = [], 0
+        batch.append(i)
+        batch_tokens += n_tokens
+    if batch:
+        batches.append(batch)
+    return batches
+
+def create_embeddings(texts, model = "text-embedding-3-small", max_retries = 6):
+    """
+    One embeddings request, retried with exponential backoff (and jitter)
+    on rate limits and transient server/connection errors
+    """
+    for attempt in range(max_retries + 1):
+        try:
+            response = get_openai_client().embeddings.create(input = texts, model = model)
+            return [d.embedding for d in sorted(response.data, key = lambda d: d.index)]
+        except (openai.RateLimitError, openai.APIConnectionError, openai.APITimeoutError, openai.InternalServerError) as e:
+            if attempt == max_retries:
+                raise
+            delay = min(60, 2 ** attempt) * (0.5 + random.random() / 2)
+            logger.warning("embedding request failed (%s), retrying in %.1fs", type(e).__name__, delay)
+            time.sleep(delay)
+
+def run_batches(embed_batch, texts, batches, max_workers, on_batch = None):
+    """
+    Embed texts in batches on a thread pool (a single batch runs inline)
+
+    Parameters:
+    embed_batch: function from a list of texts to their embeddings
+    batches: lists of indices into texts
+    on_batch: called with (batch, embeddings) as each batch completes
+
+    Returns:
+    list of embeddings, in the same order as texts
+    """
+    embeddings = [None] * len(texts)
+
+    def done(batch, batch_embeddings):
+        for i, embedding in zip(batch, batch_embeddings):
+            embeddings[i] = embedding
+        if on_batch:
+            on_batch(batch, batch_embeddings)
+
+    if len(batches) == 1:
+        done(batches[0], embed_batch([texts[i] for i in batches[0]]))
+        return embeddings
+
+    with ThreadPoolExecutor(max_workers = max_workers) as executor:
+        futures = {executor.submit(embed_batch, [texts[i] for i in batch]): batch for batch in batches}
+        for future in as_completed(futures):
+            done(futures[future], future.result())
+    return embeddings
+
+class OpenAIEmbeddingBackend:
+    """
+    Embeddings from the openai API, packed into as few requests as possible
+    under the per-request limits
+    """
+    def __init__(self, model = OPENAI_EMBEDDING_MODEL, max_tokens = EMBEDDING_MAX_TOKENS):
+        self.model = model
+        self.max_tokens = max_tokens
+        self._dimension = OPENAI_EMBEDDING_DIMENSIONS.get(model)
+
+    @property
+    def dimension(self):
+        if self._dimension is None:
+            self._dimension = len(create_embeddings(["dimension"], self.model)[0])
+        return self._dimension
+
+    def embed(self, texts, token_counts, max_workers = 4, max_batch_tokens = EMBEDDING_MAX_BATCH_TOKENS, on_batch = None):
+        batches = batch_by_tokens(token_counts, max_tokens = max_batch_tokens)
+        return run_batches(lambda batch: create_embeddings(batch, self.model), texts, batches, max_workers, on_batch)
+
+class LocalEmbeddingBackend:
+    """
+    Embeddings from a sentence-transformers model on the CPU, with no API
+    calls, rate limits or per-token cost. The model is loaded on first use;
+    needs `pip install sentence-transformers`
+    """
+    def __init__(self, model = LOCAL_EMBEDDING_MODEL, runtime = LOCAL_EMBEDDING_RUNTIME, batch_size = 64):
+        self.model = model
+        self.runtime = runtime
+        self.batch_size = batch_size
+        self._encoder = None
 
-def get_embedding(text, model = "text-embedding-3-small"):
-    max_tokens = 8191
+    @property
+    def encoder(self):
+        if self._encoder is None:
+            try:
+                from sentence_transformers import SentenceTransformer
+            except ImportError as e:
+                raise ImportError("EMBEDDING_BACKEND=local needs `pip install sentence-transformers`") from e
+            self._encoder = SentenceTransformer(self.model, device = "cpu", backend = self.runtime)
+        return self._encoder
+
+    @property
+    def dimension(self):
+        return self.encoder.get_sentence_embedding_dimension()
+
+    @property
+    def max_tokens(self):
+        """
+        Longest input, in tiktoken tokens, the model reads without truncating
+        (max_seq_length counts its own tokens, [CLS] and [SEP] included)
+        """
+        return int((self.encoder.max_seq_length - 2) * TIKTOKEN_TOKENS_PER_MODEL_TOKEN)
+
+    def embed_batch(self, texts):
+        # normalized, so cosine in qdrant matches the model's similarity
+        return self.encoder.encode(texts, batch_size = self.batch_size, normalize_embeddings = True).tolist()
+
+    def embed(self, texts, token_counts, max_workers = 4, max_batch_tokens = None, on_batch = None):
+        # torch / onnxruntime release the GIL, so a few threads keep all cores busy
+        batches = [list(range(start, min(start + self.batch_size, len(texts)))) for start in range(0, len(texts), self.batch_size)]
+        return run_batches(self.embed_batch, texts, batches, max_workers, on_batch)
+
+def get_embedding_backend(name = None):
+    """
+    The embedding backend named by EMBEDDING_BACKEND (or name), created once per process
+    """
+    name = name or EMBEDDING_BACKEND
+    if name not in _embedding_backends:
+        if name == "openai":
+            _embedding_backends[name] = OpenAIEmbeddingBackend()
+        elif name == "local":
+            _embedding_backends[name] = LocalEmbeddingBackend()
+        else:
+            raise ValueError(f"unknown embedding backend: {name}")
+    return _embedding_backends[name]
+
+def get_embedding(text, backend = None, use_cache = True):
+    backend = backend or get_embedding_backend()
+    max_tokens = EMBEDDING_MAX_TOKENS
     tokens = get_token(text)
     if len(tokens) > max_tokens:
-        text = tiktoken.get_encoding("cl100k_base").decode(tokens[:max_tokens])
-    return openai.embeddings.create(input = [text], model = model).data[0].embedding
+        tokens = tokens[:max_tokens]
+        text = get_encoder().decode(tokens)
+
+    cache = get_embedding_cache() if use_cache else None
+    if cache is not None:
+        key = hash_key(backend.model, text)
+        cached = cache.get(key)
+        if cached is not None:
+            return unpack_vector(cached)
+
+    embedding = backend.embed([text], [len(tokens)])[0]
+    if cache is not None:
+        cache.set(key, pack_vector(embedding))
+    return embedding
+
+def get_embeddings(texts, backend = None, max_workers = 4, max_batch_tokens = EMBEDDING_MAX_BATCH_TOKENS, use_cache = True, token_lists = None, quiet = False):
+    """
+    Embed many texts with as few requests as possible
+
+    Texts are truncated like in get_embedding, and only those not already in
+    the embedding cache are embedded, in batches with up to max_workers
+    batches in flight at once.
+    Point OPENAI_BASE_URL at benchmarks/fake_openai_server.py to run offline.
+
+    Parameters:
+    token_lists: the texts' tokens, if already known (see tokenize)
+    quiet: log the cache hits, progress and cost at debug level instead of
+    printing them, for calls on a request path
+
+    Returns:
+    list of embeddings, in the same order as texts
+    """
+    backend = backend or get_embedding_backend()
+    report = logger.debug if quiet else print
+    texts = list(texts)
+    token_lists = token_lists if token_lists is not None else tokenize(texts, max_workers)
+    token_counts = []
+    for i, tokens in enumerate(token_lists):
+        if len(tokens) > EMBEDDING_MAX_TOKENS:
+            tokens = tokens[:EMBEDDING_MAX_TOKENS]
+            texts[i] = get_encoder().decode(tokens)
+        token_counts.append(len(tokens))
+
+    embeddings = [None] * len(texts)
+    cache = get_embedding_cache() if use_cache else None
+    if cache is not None:
+        keys = [hash_key(backend.model, text) for text in texts]
+        cached = cache.get_many(keys)
+        for i, key in enumerate(keys):
+            if key in cached:
+                embeddings[i] = unpack_vector(cached[key])
+
+    missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+    if cache is not None:
+        report(f"embedding cache: {len(texts) - len(missing)} hits, {len(missing)} to embed")
+    if not missing:
+        return embeddings
+
+    n_done = 0
+    def on_batch(batch, batch_embeddings):
+        nonlocal n_done
+        # cache each batch as it lands, so an interrupted run keeps its progress
+        if cache is not None:
+            cache.set_many([(keys[missing[j]], pack_vector(embedding)) for j, embedding in zip(batch, batch_embeddings)])
+        n_done += len(batch)
+        if n_done < len(missing):
+            report(f"progress: {n_done}/{len(missing)} texts embedded")
+
+    start_time = time.time()
+    new_embeddings = backend.embed(
+        [texts[i] for i in missing],
+        [token_counts[i] for i in missing],
+        max_workers = max_workers,
+        max_batch_tokens = max_batch_tokens,
+        on_batch = on_batch
+    )
+    for i, embedding in zip(missing, new_embeddings):
+        embeddings[i] = embedding
+
+    elapsed = max(time.time() - start_time, 1e-9)
+    n_tokens = sum(token_counts[i] for i in missing)
+    # local models have no price, so cost nothing
+    cost = n_tokens / 1e6 * EMBEDDING_PRICES.get(backend.model, 0.0)
+    report(f"embedded {len(missing)} texts, {n_tokens} tokens in {elapsed:.1f}s ({n_tokens / elapsed:.0f} tokens/sec), about ${cost:.4f}")
+    return embeddings
+
+def get_chunk_embeddings(texts, backend = None, max_workers = 4, use_cache = True, token_lists = None, max_tokens = None, overlap = EMBEDDING_CHUNK_OVERLAP_TOKENS, quiet = False):
+    """
+    Embed each text as one vector per chunk (see chunk_tokens) instead of
+    truncating it, so a long text is searchable to its end; a search scores
+    the text by its best chunk (max-sim)
+
+    Parameters:
+    max_tokens: chunk size, at most the backend's max_tokens (the default,
+    unless EMBEDDING_CHUNK_TOKENS is set)
+    overlap: tokens shared by consecutive chunks, at most a quarter of a chunk
+    quiet: log instead of printing, like get_embeddings
+
+    Returns:
+    list of lists of embeddings, one list per text, in the same order as texts
+    """
+    backend = backend or get_embedding_backend()
+    report = logger.debug if quiet else print
+    max_tokens = min(max_tokens or EMBEDDING_CHUNK_TOKENS or backend.max_tokens, backend.max_tokens)
+    overlap = min(overlap, max_tokens // 4)
+    texts = list(texts)
+    token_lists = token_lists if token_lists is not None else tokenize(texts, max_workers)
+    chunk_texts, chunk_token_lists, n_chunks = [], [], []
+    encoding = get_encoder()
+    for text, tokens in zip(texts, token_lists):
+        chunks = chunk_tokens(tokens, max_tokens, overlap)
+        # a text that fits is embedded as is, without decoding it back
+        chunk_texts += [text] if len(chunks) == 1 else encoding.decode_batch(chunks)
+        chunk_token_lists += chunks
+        n_chunks.append(len(chunks))
+
+    n_split = sum(n > 1 for n in n_chunks)
+    if n_split:
+        report(f"{n_split} texts over {max_tokens} tokens split into {sum(n for n in n_chunks if n > 1)} chunks")
+    embeddings = get_embeddings(chunk_texts, backend, max_workers, use_cache = use_cache, token_lists = chunk_token_lists, quiet = quiet)
+
+    grouped, start = [], 0
+    for n in n_chunks:
+        grouped.append(embeddings[start:start + n])
+        start += n
+    return grouped